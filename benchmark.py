@@ -0,0 +1,338 @@
+from __future__ import print_function, division
+from argparse import ArgumentParser
+from bisect import bisect
+from contextlib import contextmanager
+from random import Random
+from typing import Dict, Optional
+import csv
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+
+import recommendmovie
+
+try:
+    import resource
+except ImportError:
+    # peak memory is only reported where the resource module is available
+    resource = None
+
+# The genres of the MovieLens datasets and roughly how common each one is
+GENRES = {'Drama': 25, 'Comedy': 16, 'Thriller': 8, 'Romance': 7, 'Action': 7, 'Horror': 5, 'Documentary': 5,
+          'Crime': 5, 'Adventure': 4, 'Sci-Fi': 4, 'Mystery': 3, 'Children': 3, 'Animation': 3, 'Fantasy': 3,
+          'War': 2, 'Western': 1, 'Musical': 1, 'Film-Noir': 1, 'IMAX': 1}
+
+# The version of the layout of the results file
+RESULTS_VERSION = 2
+
+
+def init_parser():
+    """Initialize and return the ArgumentParser object"""
+    parser = ArgumentParser(description="Generate a synthetic MovieLens-shaped dataset and time each phase of "
+                                        "recommendmovie.py against it, writing the results as JSON.")
+    parser.add_argument('-d', '--dir', default='benchmark-data',
+                        help="The directory to generate the dataset in and run from. The dataset is written to its "
+                             "ml-latest subdirectory and is only regenerated if the scale or seed change "
+                             "(default: benchmark-data).")
+    parser.add_argument('-n', '--ratings', type=int, default=100000,
+                        help="The number of ratings to generate, e.g. 100000 to 100000000 (default: 100000).")
+    parser.add_argument('--users', type=int,
+                        help="The number of users to generate (default: one per 100 ratings, as in MovieLens).")
+    parser.add_argument('--movies', type=int,
+                        help="The number of movies to generate (default: about 10,000 for 100,000 ratings and "
+                             "60,000 for 25 million, as in MovieLens).")
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help="The seed for the generator and for sampling (default: 0).")
+    parser.add_argument('--generate-only', action='store_true',
+                        help="Generate the dataset and exit.")
+    parser.add_argument('--sample-users', type=int, default=20,
+                        help="The number of users to gather neighbours, compute similarities and predict for "
+                             "(default: 20).")
+    parser.add_argument('--movies-per-user', type=int, default=10,
+                        help="The number of movies to predict for each sampled user (default: 10).")
+    parser.add_argument('-r', '--rmse', metavar='percent', type=float, default=1,
+                        help="The percent of users for the cross-validation routine, 0 to skip it (default: 1).")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="The number of worker processes for the cross-validation routine (default: 1).")
+    parser.add_argument('-o', '--output',
+                        help="The file to write the results to (default: standard output).")
+    parser.add_argument('--compare', metavar='RESULTS',
+                        help="A results file of an earlier run to compare the timings of each phase against.")
+    return parser
+
+
+def main():
+    parser = init_parser()
+    args = parser.parse_args()
+    if args.ratings < 1000:
+        parser.error("generate at least 1000 ratings.")
+    n_users = args.users or max(args.ratings // 100, 10)
+    n_movies = args.movies or max(int(170 * args.ratings ** 0.35), 100)
+    output = os.path.abspath(args.output) if args.output else None
+    compare_with = os.path.abspath(args.compare) if args.compare else None
+    os.makedirs(os.path.join(args.dir, 'ml-latest'), exist_ok=True)
+    # recommendmovie.py reads its datasets relative to the working directory
+    os.chdir(args.dir)
+    dataset = generate_if_needed(args.ratings, n_users, n_movies, args.seed)
+    if args.generate_only:
+        print(json.dumps(dataset, indent=2))
+        return
+    results = {'version': RESULTS_VERSION, 'started': datetime.datetime.now().isoformat(timespec='seconds'),
+               'environment': environment(), 'dataset': dataset,
+               'parameters': {'sample_users': args.sample_users, 'movies_per_user': args.movies_per_user,
+                              'rmse_percent': args.rmse, 'workers': args.workers, 'seed': args.seed},
+               'phases': run_benchmark(args.sample_users, args.movies_per_user, args.rmse, args.workers, args.seed)}
+    results['peak_memory'] = peak_memory_mb()
+    data = json.dumps(results, indent=2)
+    if output:
+        with open(output, 'w') as file:
+            file.write(data + '\n')
+    else:
+        print(data)
+    if args.compare:
+        with open(compare_with) as file:
+            compare(json.load(file)['phases'], results['phases'])
+
+
+def generate_if_needed(n_ratings: int, n_users: int, n_movies: int, seed: int) -> dict:
+    """Generate the dataset into ml-latest unless it was already generated with the same parameters. Returns the
+    description of the dataset that is saved next to it."""
+    marker = recommendmovie.dataset_file('generated.json', True)
+    parameters = {'requested_ratings': n_ratings, 'users': n_users, 'movies': n_movies, 'seed': seed}
+    try:
+        with open(marker) as file:
+            dataset = json.load(file)
+        if dataset['parameters'] == parameters:
+            return dataset
+    except (OSError, ValueError, KeyError):
+        pass
+    began = time.perf_counter()
+    ratings = generate_dataset(n_ratings, n_users, n_movies, seed)
+    dataset = {'parameters': parameters, 'ratings': ratings, 'generate_seconds': time.perf_counter() - began}
+    with open(marker, 'w') as file:
+        json.dump(dataset, file, indent=2)
+    return dataset
+
+
+def generate_dataset(n_ratings: int, n_users: int, n_movies: int, seed: int) -> int:
+    """Write ratings.csv, movies.csv and links.csv of a synthetic dataset in the MovieLens layout to ml-latest and
+    return the number of ratings written. The same arguments always give the same files.
+
+    User activity follows a Pareto distribution with every user rating at least a few movies, scaled to about
+    n_ratings in total, and the movies each user rates are drawn by popularity, which follows Zipf's law (mixed with
+    a uniform share so that heavy users reach the long tail). A rating is a global mean plus a user bias, a movie
+    bias and noise, rounded to half stars."""
+    rng = Random(seed)
+    movie_ids = sorted(rng.sample(range(1, 2 * n_movies + 1), n_movies))
+    genres = list(GENRES)
+    genre_weights = list(GENRES.values())
+    with open(recommendmovie.dataset_file('movies.csv', True), 'w', encoding="utf8", newline='') as file:
+        writer = csv.writer(file, lineterminator='\n')
+        writer.writerow(['movieId', 'title', 'genres'])
+        for mid in movie_ids:
+            picked = set(rng.choices(genres, genre_weights, k=rng.choice((1, 1, 2, 2, 3))))
+            writer.writerow([mid, "Synthetic Movie {}, The ({})".format(mid, rng.randrange(1920, 2020)),
+                             '|'.join(sorted(picked))])
+    with open(recommendmovie.dataset_file('links.csv', True), 'w', encoding="utf8", newline='') as file:
+        file.write('movieId,imdbId,tmdbId\n')
+        file.writelines('{},{:07d},{}\n'.format(mid, 100000 + 7 * mid, 1000 + 3 * mid) for mid in movie_ids)
+
+    # Popularity: a random order of the movies, then Zipf's law mixed with a uniform share, as a cumulative table
+    ranked = list(range(n_movies))
+    rng.shuffle(ranked)
+    harmonic = sum(1 / (rank + 1) for rank in range(n_movies))
+    weights = [0.0] * n_movies
+    for rank, m in enumerate(ranked):
+        weights[m] = 0.8 / ((rank + 1) * harmonic) + 0.2 / n_movies
+    cumulative = []
+    total = 0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    movie_bias = [rng.gauss(0, 0.5) for _ in range(n_movies)]
+
+    # Activity: at least 5 ratings each, heavy-tailed, scaled to the requested total and capped at a quarter of
+    # the movies
+    activity = [rng.paretovariate(1.25) for _ in range(n_users)]
+    cap = max(n_movies // 4, 5)
+    scale = max(n_ratings - 5 * n_users, 0) / sum(activity)
+    for _ in range(8):
+        # the cap cuts off the heaviest users, so scale the rest up until the total is close to the one requested
+        counts = [min(5 + int(a * scale), cap) for a in activity]
+        below = sum(count - 5 for count in counts if count < cap)
+        if not below or abs(sum(counts) - n_ratings) < n_ratings / 200:
+            break
+        scale *= (n_ratings - sum(counts) + below) / below
+
+    written = 0
+    with open(recommendmovie.dataset_file('ratings.csv', True), 'w', encoding="utf8") as file:
+        file.write('userId,movieId,rating,timestamp\n')
+        for u, count in enumerate(counts):
+            rated = set()
+            while len(rated) < count:
+                rated.add(min(bisect(cumulative, rng.random() * total), n_movies - 1))
+            user_bias = rng.gauss(0, 0.4)
+            timestamp = 1000000000 + 1000 * u
+            lines = []
+            for m in sorted(rated):
+                rating = min(max(round((3.5 + user_bias + movie_bias[m] + rng.gauss(0, 0.9)) * 2) / 2, 0.5), 5.0)
+                lines.append('{},{},{},{}\n'.format(u + 1, movie_ids[m], rating, timestamp + m))
+            file.write(''.join(lines))
+            written += count
+    return written
+
+
+def environment() -> dict:
+    """Describe the machine and software the benchmark ran on"""
+    return {'python': platform.python_version(), 'implementation': platform.python_implementation(),
+            'numpy': recommendmovie.np.__version__ if recommendmovie.np is not None else None,
+            'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def peak_memory_mb() -> Dict[str, float]:
+    """Return the peak resident set size over the lifetime of this process and of its finished worker processes,
+    in MB"""
+    if resource is None:
+        return {}
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 / 1024 / 1024 if sys.platform == 'darwin' else 1 / 1024
+    return {'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+            'children_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit}
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident set size of this process, which only Linux allows. Returns whether it was reset."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Return the peak resident set size of this process since it was last reset, in MB, or None off Linux"""
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+@contextmanager
+def phase(phases: Dict[str, dict], name: str):
+    """Time the enclosed block as one phase and, where the peak memory can be reset, record the phase's own peak.
+    The block can add its own fields to the dictionary it is given."""
+    record = {}
+    measured = reset_peak_rss()
+    began = time.perf_counter()
+    yield record
+    record['seconds'] = time.perf_counter() - began
+    if measured:
+        record['peak_rss_mb'] = peak_rss_mb()
+    phases[name] = record
+    print("{:<32} {:10.3f} s".format(name, record['seconds']), file=sys.stderr)
+
+
+def run_benchmark(sample_users: int, movies_per_user: int, rmse_percent: float, workers: int,
+                  seed: int) -> Dict[str, dict]:
+    """Time each phase of predicting ratings against the generated dataset: loading it, gathering the neighbours
+    of a sample of users, computing their similarities with each measure and backend, predicting, training the
+    matrix factorisation model and the cross-validation routine. Returns the phases by name."""
+    phases = {}
+    with phase(phases, 'load/compile_ratings_csv') as record:
+        recommendmovie.compile_rating_store(True)
+    with phase(phases, 'load/map_store') as record:
+        recommendmovie._rating_stores.clear()
+        store = recommendmovie.load_rating_store(True)
+        record.update(users=store.n_users, movies=store.n_movies, ratings=store.n_ratings)
+    with phase(phases, 'load/catalogue'):
+        movies = recommendmovie.get_movies_from_ids(None, True, True)
+    with phase(phases, 'load/genre_matrix'):
+        genre_matrix = recommendmovie.load_genre_matrix(store, movies)
+
+    rng = Random(seed)
+    users = [str(store.user_ids[u]) for u in rng.sample(range(store.n_users), min(sample_users, store.n_users))]
+    requests = [(uid, rng.sample(store.movie_keys, min(movies_per_user, store.n_movies))) for uid in users]
+
+    gathered = []
+    with phase(phases, 'neighbours/gather') as record:
+        for uid, mids in requests:
+            gathered.append(recommendmovie.get_relevant_users(store, uid, mids))
+        record['mean_neighbours'] = sum(len(others) for _, others in gathered) / len(gathered)
+
+    measures = ['cosine', 'pearson', 'euclidean']
+    for measure in measures:
+        with phase(phases, 'similarity/python/' + measure):
+            for our_index, others in gathered:
+                ours, our_stats = store.user_vector(our_index), store.user_stats(our_index)
+                for v in others:
+                    theirs, stats = store.user_vector(v), store.user_stats(v)
+                    if measure == 'cosine':
+                        recommendmovie.cosine_similarity(ours, theirs, our_stats.norm, stats.norm)
+                    elif measure == 'euclidean':
+                        recommendmovie.euclidean_distance(ours, theirs)
+                    else:
+                        recommendmovie.pearson_correlation(ours, theirs, our_stats.mean, stats.mean,
+                                                           our_stats.centered_ss, stats.centered_ss)
+        if recommendmovie.np is not None:
+            with phase(phases, 'similarity/numpy/' + measure):
+                for our_index, others in gathered:
+                    our_stats = store.user_stats(our_index)
+                    recommendmovie.vectorized_similarities(store, store.user_vector(our_index), our_stats.mean,
+                                                           others, measure, our_stats)
+    backends = ['python'] + (['numpy'] if recommendmovie.np is not None else [])
+    for backend in backends:
+        with phase(phases, 'similarity/{}/genre'.format(backend)):
+            for our_index, others in gathered:
+                genre_matrix.weights(genre_matrix.row(our_index), others, False, False, backend=backend)
+
+    for backend in backends:
+        for measure in measures + ['genre']:
+            with phase(phases, 'prediction/{}/{}'.format(backend, measure)) as record:
+                predicted = 0
+                for uid, mids in requests:
+                    predicted += len(recommendmovie.predict_ratings(
+                        store, movies, uid, mids, measure == 'genre', True, measure == 'cosine',
+                        measure == 'euclidean', backend))
+                record['predictions'] = predicted
+
+    if recommendmovie.np is not None:
+        with phase(phases, 'factors/train'):
+            recommendmovie.build_factor_model(True, recommendmovie.FACTOR_RANK, recommendmovie.FACTOR_ITERATIONS,
+                                              recommendmovie.FACTOR_REGULARIZATION, workers)
+        with phase(phases, 'prediction/factors') as record:
+            predicted = 0
+            for uid, mids in requests:
+                predicted += len(recommendmovie.predict_ratings(store, movies, uid, mids, False, True, False, False,
+                                                                factors=True))
+            record['predictions'] = predicted
+
+    if rmse_percent > 0:
+        with phase(phases, 'rmse') as record:
+            results = recommendmovie.calculate_rmse_for_each_distance_measure(rmse_percent, movies, True, seed, workers)
+            record['measures'] = {measure: result._asdict() for measure, result in results.items()}
+    return phases
+
+
+def compare(before: Dict[str, dict], after: Dict[str, dict]):
+    """Print the time of each phase in both runs and the ratio between them on stderr"""
+    print("{:<32} {:>10} {:>10} {:>8}".format("Phase", "Before", "After", "Ratio"), file=sys.stderr)
+    for name, record in after.items():
+        if name in before:
+            old, new = before[name]['seconds'], record['seconds']
+            print("{:<32} {:10.3f} {:10.3f} {:8.2f}".format(name, old, new, new / old if old else float('inf')),
+                  file=sys.stderr)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        exit(0)
@@ -1,10 +1,33 @@
 from __future__ import print_function, division
 from argparse import ArgumentParser
-from collections import namedtuple
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from collections.abc import Mapping
+from contextlib import nullcontext
+from heapq import nlargest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
 from math import sqrt, log
-from random import random
-from typing import Dict, List, Optional, NamedTuple
+from multiprocessing import Pool
+from random import Random
+from typing import Dict, List, Optional, NamedTuple, Tuple
 import csv
+import json
+import mmap
+import os
+import queue
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is only needed for the vectorized backend
+    np = None
 
 
 def init_parser():
@@ -25,10 +48,103 @@ def init_parser():
                         help="Specify that IDs are IMDb IDs rather than MovieLens IDs.")
     parser.add_argument('-m', '--movielens', action='store_true',
                         help="Specify that IDs are MovieLens IDs.")
+    parser.add_argument('--compile', action='store_true',
+                        help="(Re)build the binary ratings store from ratings.csv and exit. The store is also built "
+                             "automatically the first time it is needed or whenever ratings.csv changes.")
+    parser.add_argument('--rate', metavar=('MOVIE', 'RATING'), nargs=2, action='append',
+                        help="Record the user's rating of a movie (MovieLens ID) in the delta log and exit. May be "
+                             "given more than once. The rating is used by every later prediction without "
+                             "recompiling the store.")
+    parser.add_argument('--unrate', metavar='MOVIE', action='append',
+                        help="Delete the user's rating of a movie (MovieLens ID) through the delta log and exit. May "
+                             "be given more than once.")
+    parser.add_argument('--compact', action='store_true',
+                        help="Fold the delta log into ratings.csv, recompile the store and exit. Neighbour indices "
+                             "have to be rebuilt afterwards.")
     parser.add_argument('-r', '--rmse', metavar="percent", nargs='?', type=int, const=10,
                         help="Run the cross-validation test routine to calculate RMSE for each distance measure. "
                              "If a percent is specified, only that percent of users in the dataset will be used "
                              "for the routine, selected randomly (default: 10).")
+    parser.add_argument('--build-neighbours', action='store_true',
+                        help="Precompute the k nearest neighbours of every user under each distance measure "
+                             "in parallel, save them next to ratings.csv and exit. Euclidean distances d are saved "
+                             "as the similarity 1 / (1 + d), so the nearest neighbours weigh the most.")
+    parser.add_argument('-n', '--neighbours', action='store_true',
+                        help="Predict from each user's precomputed nearest neighbours (see --build-neighbours) "
+                             "rather than from every user who rated the movie.")
+    parser.add_argument('--lsh', action='store_true',
+                        help="Predict from each user's k nearest neighbours among the candidates found by an "
+                             "approximate locality-sensitive hashing index (cosine or Pearson correlation), which is "
+                             "built next to ratings.csv the first time it is needed. With -r, also compare predicting "
+                             "from the k nearest neighbours found through it and found exactly.")
+    parser.add_argument('--lsh-tables', type=int, default=8,
+                        help="The number of hash tables of the LSH index. More tables find more of the true "
+                             "neighbours at the cost of more candidates to re-rank (default: 8).")
+    parser.add_argument('--lsh-bits', type=int,
+                        help="The number of bits per hash of the LSH index. More bits make smaller buckets and "
+                             "faster, less complete searches (default: about 64 users per bucket).")
+    parser.add_argument('--factors', action='store_true',
+                        help="Predict with a matrix factorisation model (latent factors and biases for every user and "
+                             "movie, trained by alternating least squares with numpy), which is trained next to "
+                             "ratings.csv the first time it is needed. With -r, also evaluate it on a held-out split "
+                             "of the ratings.")
+    parser.add_argument('--rank', type=int, default=32,
+                        help="The number of latent factors of the matrix factorisation model (default: 32).")
+    parser.add_argument('--iterations', type=int, default=10,
+                        help="The number of alternating least squares iterations to train the matrix factorisation "
+                             "model for (default: 10).")
+    parser.add_argument('--regularization', type=float, default=0.1,
+                        help="The regularisation of the matrix factorisation model, scaled by each user's and "
+                             "movie's number of ratings (default: 0.1).")
+    parser.add_argument('--item-based', action='store_true',
+                        help="Use item-based collaborative filtering with a precomputed item-item similarity matrix "
+                             "(adjusted cosine with --cosine, otherwise Pearson correlation), which is built next to "
+                             "ratings.csv the first time it is needed.")
+    parser.add_argument('-k', type=int, default=50,
+                        help="The number of neighbours to keep per user with --build-neighbours, --lsh or --top, or "
+                             "per movie with --item-based (default: 50).")
+    parser.add_argument('--min-common', type=int, default=3,
+                        help="The minimum number of movies two users must both have rated to be neighbours "
+                             "with --build-neighbours, --lsh or --top, or of users who must have rated two movies "
+                             "with --item-based (default: 3).")
+    parser.add_argument('-w', '--workers', type=int,
+                        help="The number of worker processes for building indices, training the matrix "
+                             "factorisation model and for the cross-validation routine (default: one per CPU).")
+    parser.add_argument('-s', '--seed', type=int,
+                        help="The seed for sampling users in the cross-validation routine, which makes the RMSE "
+                             "the same for any number of workers (default: random, and printed).")
+    parser.add_argument('--top', metavar='N', type=int,
+                        help="Recommend the N unseen movies with the highest predicted ratings for the user instead of "
+                             "predicting ratings for given movies. Only movies rated by the user's k nearest "
+                             "neighbours are considered.")
+    parser.add_argument('--min-support', type=int, default=MIN_SUPPORT,
+                        help="With --top, only recommend movies rated by at least this many neighbours (default: "
+                             "{}).".format(MIN_SUPPORT))
+    parser.add_argument('--only-genre', metavar='GENRE', action='append',
+                        help="With --top, only recommend movies with this genre. May be given more than once to allow "
+                             "any of several genres.")
+    parser.add_argument('--score-pairs', metavar='FILE',
+                        help="Predict a rating for every (user, movie) pair in a CSV file with userId and movieId "
+                             "columns, or a JSONL file (.jsonl) of objects with \"user_id\" and \"movie_id\", across "
+                             "the worker processes, and write them to --output in the same format and order. Pairs "
+                             "of the same user are predicted together, so input sorted by user is fastest.")
+    parser.add_argument('-o', '--output', default='-',
+                        help="The file to write the predictions of --score-pairs to (default: standard output).")
+    parser.add_argument('--serve', action='store_true',
+                        help="Load the dataset once and answer prediction requests over HTTP/JSON "
+                             "(POST /predict, GET /stats) until interrupted. The model options are fixed at start, "
+                             "and --factors, --item-based and --lsh build those models for the server to use.")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="The address to serve on with --serve (default: 127.0.0.1).")
+    parser.add_argument('--port', type=int, default=8000,
+                        help="The port to serve on with --serve (default: 8000).")
+    parser.add_argument('--batch-window', metavar='ms', type=float, default=5,
+                        help="How long the server waits to batch concurrent requests together (default: 5).")
+    parser.add_argument('--backend', choices=BACKENDS, default='python' if np is None else 'numpy',
+                        help="Compute similarities, genre weights and recommendations with the pure-Python "
+                             "functions or with the vectorized numpy engine, which scores all of the neighbours in "
+                             "one call (default: numpy if it is installed). The neighbour index, the LSH index, "
+                             "item-based filtering and the matrix factorisation model always use numpy.")
     distance = parser.add_mutually_exclusive_group()
     distance.add_argument('-p', '--pearson', action='store_true',
                           help="Use pearson correlation to calculate distances for collaborative filtering (default).")
@@ -45,142 +161,700 @@ def main():
     # Parse arguments
     parser = init_parser()
     args = parser.parse_args()
-    if args.rmse:
+    if args.backend == 'numpy' and np is None:
+        parser.error("the numpy backend requires numpy to be installed.")
+    if args.lsh_tables < 1 or args.lsh_bits is not None and not 0 < args.lsh_bits < 63:
+        parser.error("the LSH index needs at least one table and from 1 to 62 bits per hash.")
+    if np is None and (args.build_neighbours or args.neighbours or args.lsh or args.item_based):
+        parser.error("the neighbour index, the LSH index and item-based filtering require numpy to be installed.")
+    if args.factors:
+        if np is None:
+            parser.error("the matrix factorisation model requires numpy to be installed.")
+        if args.rank < 1 or args.iterations < 1 or args.regularization <= 0:
+            parser.error("the matrix factorisation model needs a rank and iterations of at least 1 and a positive "
+                         "regularization.")
+    if args.compile:
+        print("Wrote", compile_rating_store(args.full))
+    elif args.compact:
+        print("Wrote", compact_ratings(args.full))
+    elif args.rate or args.unrate:
+        if not args.user_id:
+            parser.error("user-id required to rate movies.")
+        changes = [(mid, rating) for mid, rating in args.rate or []] + [(mid, None) for mid in args.unrate or []]
+        movies = get_movies_from_ids([mid for mid, _ in changes], False, args.full)
+        unknown = [mid for mid, _ in changes if mid not in movies]
+        if unknown:
+            parser.error("unknown movies: {}".format(', '.join(unknown)))
+        try:
+            append_ratings(args.full, [(args.user_id, mid, rating) for mid, rating in changes])
+        except ValueError as error:
+            parser.error(str(error))
+        print("Recorded", len(changes), "ratings for user", args.user_id)
+    elif args.serve:
+        models = [name for name in ('factors', 'item_based', 'lsh') if getattr(args, name)]
+        try:
+            server = PredictionServer((args.host, args.port), args.full, args.batch_window / 1000, models,
+                                      args.workers, k=args.k, min_common=args.min_common,
+                                      lsh_tables=args.lsh_tables, lsh_bits=args.lsh_bits, rank=args.rank,
+                                      iterations=args.iterations, regularization=args.regularization)
+        except ValueError as error:
+            parser.error(str(error))
+        print("Serving predictions on http://{}:{}/".format(*server.server_address[:2]))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+    elif args.build_neighbours:
+        if args.k < 1:
+            parser.error("k needs to be at least 1.")
+        for filename in build_neighbour_indices(args.full, args.k, args.min_common, workers=args.workers):
+            print("Wrote", filename)
+    elif args.rmse:
         # run the cross validation routine
         if not 0 < args.rmse < 100:
             parser.error("cross-validation percent needs to be between 0 and 100.")
         # get all the movies and their genres from the database
         movies = get_movies_from_ids(None, True, args.full)
-        print(" Cosine RMSE:        Pearson RMSE:       Euclidean RMSE:       Genre RMSE:")
-        print(calculate_rmse_for_each_distance_measure(args.rmse, movies), "\a")
+        seed = args.seed if args.seed is not None else Random().randrange(2 ** 32)
+        began = time.perf_counter()
+        results = calculate_rmse_for_each_distance_measure(args.rmse, movies, args.full, seed,
+                                                           args.workers or os.cpu_count(), lsh=args.lsh, k=args.k,
+                                                           min_common=args.min_common, lsh_tables=args.lsh_tables,
+                                                           lsh_bits=args.lsh_bits, factors=args.factors,
+                                                           rank=args.rank, iterations=args.iterations,
+                                                           regularization=args.regularization,
+                                                           backend=args.backend)
+        print("Measure      RMSE         Predictions")
+        for measure, result in results.items():
+            print("{:<12} {:<12.6f} {}".format(measure.capitalize(), result.rmse, result.predictions))
+        fused = list(FUSED_METRICS) + ['genre']
+        names = [measure.capitalize() for measure in fused]
+        workers = args.workers or os.cpu_count()
+        # the measures share the pass's wall time, so each one's rate is its own predictions over that time
+        print("{} and {} were evaluated together in one pass: {:.2f} s wall time with {} worker{}, predictions/s: "
+              "{}".format(', '.join(names[:-1]), names[-1], results['genre'].seconds, workers,
+                          '' if workers == 1 else 's',
+                          ', '.join("{} {:.1f}".format(name, results[measure].predictions_per_second)
+                                    for name, measure in zip(names, fused))))
+        if args.lsh:
+            for measure in LSH_MEASURES:
+                exact, approximate = results[measure + ' knn'], results[measure + ' lsh']
+                print("{} LSH against exact k-NN: RMSE {:+.6f}, recall@{} {:.3f}, search {:.1f}x faster".format(
+                    measure.capitalize(), approximate.rmse - exact.rmse, args.k, approximate.recall,
+                    exact.seconds / approximate.seconds if approximate.seconds else float('inf')))
+        if args.factors:
+            print("Factors trained in {:.2f} s without {:.0%} of the ratings, evaluated on those of the same users in "
+                  "{:.2f} s".format(results['factors'].training_seconds, FACTOR_HOLDOUT, results['factors'].seconds))
+        print("Wall time: {:.2f} s (seed {})".format(time.perf_counter() - began, seed), "\a")
+    elif args.top is not None:
+        if not args.user_id:
+            parser.error("user-id required to recommend movies.")
+        if args.top < 1:
+            parser.error("--top needs to be at least 1.")
+        if args.k < 1:
+            parser.error("k needs to be at least 1.")
+        if args.item_based or ((args.neighbours or args.lsh) and args.genres):
+            parser.error("--top works with user-based filtering and can't weight the neighbour index by genre.")
+        if args.lsh and args.euclidean:
+            parser.error("the LSH index supports cosine similarity and Pearson correlation.")
+        if args.factors:
+            if args.genres or args.neighbours or args.lsh:
+                parser.error("--factors can't be combined with genres, the neighbour index or the LSH index.")
+            load_factor_model(args.full, args.rank, args.iterations, args.regularization, args.workers)
+        movies = get_movies_from_ids(None, True, args.full)
+        try:
+            recommendations = recommend_movies(load_rating_store(args.full), movies, args.user_id, args.top, args.full,
+                                               use_genres=args.genres, cosine=args.cosine, euclidean=args.euclidean,
+                                               backend=args.backend, neighbours=args.neighbours,
+                                               min_support=args.min_support, only_genres=args.only_genre,
+                                               lsh=args.lsh, k=args.k, min_common=args.min_common,
+                                               lsh_tables=args.lsh_tables, lsh_bits=args.lsh_bits,
+                                               factors=args.factors, rank=args.rank, iterations=args.iterations,
+                                               regularization=args.regularization)
+        except ValueError as error:
+            parser.error(str(error))
+        for mid, rating in recommendations:
+            print(movies[mid], "| Predicted rating:", round_stars(rating), "stars")
     else:
-        # Convert MovieLens IDs to TMDb/IMDb IDs if requested
-        movie_ids = args.ids if not args.imdb or args.tmdb else get_movie_ids_from_webdb_ids(args.ids, args.full, args.imdb, args.tmdb)
+        if args.score_pairs:
+            if args.user_id:
+                parser.error("--score-pairs reads the users and movies from the file.")
+        else:
+            # Convert MovieLens IDs to TMDb/IMDb IDs if requested
+            movie_ids = get_movie_ids_from_webdb_ids(args.ids, args.full, args.imdb, args.tmdb)
 
-        if not args.user_id:
-            parser.error("user-id required when not performing cross-validation routine.")
-        elif not args.ids:
-            parser.error("movies required when not performing cross-validation routine.")
+            if not args.user_id:
+                parser.error("user-id required when not performing cross-validation routine.")
+            elif not args.ids:
+                parser.error("movies required when not performing cross-validation routine.")
 
-        # Print the predicted rating for each requested movie
-        for movie, rating in get_predicted_ratings(args.user_id, movie_ids, args.genres, args.full,
-                                                   args.cosine, args.euclidean):
-            print(movie, "| Predicted rating:", round_stars(rating), "stars")
+        options = {'use_genres': args.genres, 'cosine': args.cosine, 'euclidean': args.euclidean,
+                   'backend': args.backend, 'neighbours': args.neighbours, 'item_based': args.item_based,
+                   'k': args.k, 'min_common': args.min_common, 'lsh': args.lsh, 'lsh_tables': args.lsh_tables,
+                   'lsh_bits': args.lsh_bits, 'factors': args.factors, 'rank': args.rank,
+                   'iterations': args.iterations, 'regularization': args.regularization}
+        try:
+            check_prediction_options(options)
+        except ValueError as error:
+            parser.error(str(error))
+        if args.factors:
+            load_factor_model(args.full, args.rank, args.iterations, args.regularization, args.workers)
+        if args.item_based:
+            load_item_similarities('adjusted_cosine' if args.cosine else 'pearson', args.full,
+                                   args.k, args.min_common, args.workers)
+        if args.lsh:
+            load_lsh_index('cosine' if args.cosine else 'pearson', args.full, args.lsh_tables, args.lsh_bits)
+        if args.neighbours:
+            try:
+                load_neighbour_index('cosine' if args.cosine else 'euclidean' if args.euclidean else 'pearson',
+                                     args.full)
+            except ValueError as error:
+                parser.error(str(error))
+        if args.score_pairs:
+            id_type = 'imdb' if args.imdb else 'tmdb' if args.tmdb else 'movielens'
+            try:
+                n = score_pairs(args.score_pairs, args.output, args.full, id_type, args.workers, **options)
+            except (OSError, ValueError) as error:
+                parser.error(str(error))
+            print("Scored", n, "pairs", file=sys.stderr)
+        else:
+            try:
+                predictions = list(get_predicted_ratings(args.user_id, movie_ids, full=args.full, **options))
+            except ValueError as error:
+                parser.error(str(error))
+            # Print the predicted rating for each requested movie
+            for movie, rating in predictions:
+                if rating is None:
+                    print(movie, "| Not enough similar users to predict a rating")
+                else:
+                    print(movie, "| Predicted rating:", round_stars(rating), "stars")
 
 
-def calculate_rmse_for_each_distance_measure(percent: float,
-                                             movies: Dict[str, NamedTuple]) -> (float, float, float, float):
-    """Leave-out-1 cross validation to calculate RMSE for each of the separate distance measures.
-    percent defines how much of the data set to use in the cross validation. e.g. percent=80 skips 20% of the uids."""
+class CoRated(NamedTuple):
+    """Sums over the movies two users both rated, from which the fused evaluator derives their similarity"""
+    count: int
+    # the sums of our ratings and of theirs
+    ours: float
+    theirs: float
+    # the sums of the products and of the squared differences of the pairs of ratings
+    products: float
+    sq_diffs: float
+
 
+def fused_pearson(co_rated: CoRated, our_stats: 'UserStats', their_stats: 'UserStats') -> float:
+    """pearson_correlation from co-rated sums"""
+    our_avg, their_avg = our_stats.mean, their_stats.mean
+    numer = (co_rated.products - their_avg * co_rated.ours - our_avg * co_rated.theirs
+             + co_rated.count * our_avg * their_avg)
+    denom = our_stats.centered_ss * their_stats.centered_ss
+    return 0 if denom == 0 else numer / sqrt(denom)
+
+
+def fused_cosine(co_rated: CoRated, our_stats: 'UserStats', their_stats: 'UserStats') -> float:
+    """cosine_similarity from co-rated sums"""
+    return co_rated.products / (our_stats.norm * their_stats.norm)
+
+
+def fused_euclidean(co_rated: CoRated, our_stats: 'UserStats', their_stats: 'UserStats') -> float:
+    """euclidean_distance from co-rated sums"""
+    return sqrt(co_rated.sq_diffs)
+
+
+# The similarity measures evaluated by the fused cross-validation pass. Any function of the co-rated sums and both
+# users' statistics can be registered here to be evaluated alongside them.
+FUSED_METRICS = {'cosine': fused_cosine, 'pearson': fused_pearson, 'euclidean': fused_euclidean}
+
+
+class RmseResult(NamedTuple):
+    """The outcome of the cross-validation routine for one measure"""
+    rmse: float
+    # the number of held-out ratings that could be predicted
+    predictions: int
+    # the wall time of the evaluation pass that predicted them, which is shared by all the measures it evaluates, or
+    # for the k-NN comparison the time spent finding the neighbours, summed over the workers
+    seconds: float
+    # for LSH search, the fraction of the exact k nearest neighbours it found
+    recall: float = None
+    # for the factor model, the time spent training it
+    training_seconds: float = None
+
+    @property
+    def predictions_per_second(self) -> float:
+        return self.predictions / self.seconds if self.seconds else 0
+
+
+def calculate_rmse_for_each_distance_measure(percent: float, movies: Dict[str, NamedTuple],
+                                             full: bool = False, seed: int = None, workers: int = 1,
+                                             shard_size: int = 16, lsh: bool = False, k: int = 50,
+                                             min_common: int = 3, lsh_tables: int = 8, lsh_bits: int = None,
+                                             factors: bool = False, rank: int = 32, iterations: int = 10,
+                                             regularization: float = 0.1,
+                                             backend: str = 'python') -> Dict[str, RmseResult]:
+    """Leave-out-1 cross validation to calculate RMSE for each of the separate distance measures.
+    percent defines how much of the data set to use in the cross validation. e.g. percent=80 skips 20% of the uids.
+    The genre weights are computed with the given backend."""
     ratio = percent / 100
-    # mapping of uids to their ratings
-    uid_to_ratings = {}
-    # mapping of mid to a list of uids that have ratings for the given mid
-    mid_to_uids = {}
-    with open('ml-latest-small/ratings.csv', encoding="utf8") as file:
-        reader = csv.reader(file)
-        next(reader)
-        for uid, mid, rating, _ in reader:
-            try:
-                uid_to_ratings[uid][mid] = float(rating)
-            except KeyError:
-                uid_to_ratings[uid] = {mid: float(rating)}
-            try:
-                mid_to_uids[mid].add(uid)
-            except KeyError:
-                mid_to_uids[mid] = {uid}
-
-    cosine_dif = 0
-    pearson_dif = 0
-    euclidean_dif = 0
-    genre_dif = 0
-    cosine_length = 0
-    pearson_length = 0
-    euclidean_length = 0
-    genre_length = 0
-    for uid, current_user_ratings in uid_to_ratings.items():
-        if len(current_user_ratings) <= 1 or random() >= ratio:
-            # Skip if the user has one or fewer ratings
-            # or if we're randomly skipping this user with probability percent
-            continue
-        cosine_length += len(current_user_ratings)
-        pearson_length += len(current_user_ratings)
-        euclidean_length += len(current_user_ratings)
-        genre_length += len(current_user_ratings)
-        for test_mid in current_user_ratings:
-            all_other_user_ratings = [uid_to_ratings[uid] for uid in mid_to_uids[test_mid]]
-            real_rating = current_user_ratings[test_mid]
-            test_ratings = {mid: rating for mid, rating in current_user_ratings.items() if mid != test_mid}
-            rating_sum = sum(rating for _, rating in test_ratings.items())
-            our_avg = rating_sum / len(test_ratings)
-            try:
-                dif = real_rating
-                dif -= get_rating(test_mid, movies, test_ratings, all_other_user_ratings, our_avg)
-                dif **= 2
-                pearson_dif += dif
-            except ZeroDivisionError:
-                pearson_length -= 1
-            try:
-                dif = real_rating
-                dif -= get_rating(test_mid, movies, test_ratings, all_other_user_ratings, our_avg, cosine=True)
-                dif **= 2
-                cosine_dif += dif
-            except ZeroDivisionError:
-                cosine_length -= 1
-            try:
-                dif = real_rating
-                dif -= get_rating(test_mid, movies, test_ratings, all_other_user_ratings, our_avg, euclidean=True)
-                dif **= 2
-                euclidean_dif += dif
-            except ZeroDivisionError:
-                euclidean_length -= 1
-            try:
-                dif = real_rating
-                dif -= get_rating(test_mid, movies, test_ratings, all_other_user_ratings, our_avg, use_genres=True)
-                dif **= 2
-                genre_dif += dif
-            except ZeroDivisionError:
-                genre_length -= 1
-    return (sqrt(cosine_dif / cosine_length), sqrt(pearson_dif / pearson_length),
-            sqrt(euclidean_dif / euclidean_length), sqrt(genre_dif / genre_length))
+    store = load_rating_store(full)
+    rng = Random(seed)
+    users = [u for u in range(store.n_users)
+             # Skip if the user has one or fewer ratings
+             # or if we're randomly skipping this user with probability percent
+             if store.user_stats(u).count > 1 and rng.random() < ratio]
+    fused = list(FUSED_METRICS) + ['genre']
+    measures = list(fused)
+    groups = [users[start:start + shard_size] for start in range(0, len(users), shard_size)]
+    tasks = [(full, group, backend) for group in groups]
+    knn_tasks = []
+    if lsh:
+        for measure in LSH_MEASURES:
+            # build the indices before the workers need them
+            lsh_bits = load_lsh_index(measure, full, lsh_tables, lsh_bits).n_bits
+        knn_tasks = [(full, group, k, min_common, lsh_tables, lsh_bits) for group in groups]
+        measures += [measure + search for measure in LSH_MEASURES for search in (' knn', ' lsh')]
+    # the fused pass is timed on its own, as the k-NN comparison reports its search time separately
+    if workers == 1:
+        _init_rmse_worker(movies)
+        began = time.perf_counter()
+        shards = [_rmse_for_users(task) for task in tasks]
+        seconds = time.perf_counter() - began
+        knn_shards = [_knn_rmse_for_users(task) for task in knn_tasks]
+    else:
+        with Pool(workers, initializer=_init_rmse_worker, initargs=(movies,)) as pool:
+            began = time.perf_counter()
+            shards = pool.map(_rmse_for_users, tasks, chunksize=1)
+            seconds = time.perf_counter() - began
+            knn_shards = pool.map(_knn_rmse_for_users, knn_tasks, chunksize=1)
+    for shard, knn_shard in zip(shards, knn_shards):
+        shard.update(knn_shard)
+    res = {}
+    for measure in measures:
+        dif = sum(shard[measure][0] for shard in shards)
+        length = sum(shard[measure][1] for shard in shards)
+        recall = None
+        if measure.endswith(' lsh'):
+            found = sum(shard[measure][3] for shard in shards)
+            exact = sum(shard[measure][4] for shard in shards)
+            recall = found / exact if exact else 1
+        res[measure] = RmseResult(sqrt(dif / length) if length else float('nan'), length,
+                                  seconds if measure in fused else sum(shard[measure][2] for shard in shards), recall)
+    if factors:
+        res['factors'] = _factor_rmse_for_users(full, users, (rng.randrange(2 ** 32), FACTOR_HOLDOUT), rank,
+                                                iterations, regularization, workers)
+    return res
+
+
+# The movies used by the cross-validation worker processes
+_rmse_movies = None
+
+
+def _init_rmse_worker(movies: Dict[str, NamedTuple]):
+    global _rmse_movies
+    _rmse_movies = movies
+
+
+def _rmse_for_users(task: Tuple[bool, List[int], str]) -> Dict[str, List[float]]:
+    """Worker for calculate_rmse_for_each_distance_measure: leave out each rating of each of the given users in turn
+    and return the sum of squared errors, the number of predictions and the time taken for each measure.
+
+    This is a fused version of calling get_rating for each measure. The sums over the movies our user and each
+    co-rater both rated are gathered in one walk over the co-raters, and leaving a rating out just subtracts its
+    terms from them and from our statistics, so every measure is evaluated in one pass over the held-out movie's
+    raters without copying our ratings. Our user is not one of their own neighbours."""
+    full, users, backend = task
+    store = load_rating_store(full)
+    genre_matrix = load_genre_matrix(store, _rmse_movies, backend)
+    measures = list(FUSED_METRICS) + ['genre']
+    res = {measure: [0, 0, 0] for measure in measures}
+    began = time.perf_counter()
+    for u in users:
+        our_movies, our_ratings = store.user_row(u)
+        our_stats = store.user_stats(u)
+        our_genres = genre_matrix.row(u)
+        # count, our sum, their sum, sum of products and sum of squared differences for every co-rater
+        co_rated = {}
+        for m, our_rating in zip(our_movies, our_ratings):
+            raters, ratings = store.movie_raters(m)
+            for v, their_rating in zip(raters, ratings):
+                if v == u:
+                    continue
+                try:
+                    sums = co_rated[v]
+                except KeyError:
+                    sums = co_rated[v] = [0, 0, 0, 0, 0]
+                sums[0] += 1
+                sums[1] += our_rating
+                sums[2] += their_rating
+                sums[3] += our_rating * their_rating
+                sums[4] += (our_rating - their_rating) ** 2
+
+        for test_m, real_rating in zip(our_movies, our_ratings):
+            test_stats = our_stats.without(real_rating)
+            our_avg = test_stats.mean
+            test_genres = genre_matrix.without(our_genres, test_m)
+            raters, ratings = store.movie_raters(test_m)
+            neighbours = [v for v in raters if v != u]
+            genre_weights = iter(genre_matrix.weights(test_genres, neighbours, False, False, backend=backend))
+            numers = dict.fromkeys(measures, 0)
+            denoms = dict.fromkeys(measures, 0)
+            for v, their_rating in zip(raters, ratings):
+                if v == u:
+                    continue
+                their_stats = store.user_stats(v)
+                diff = their_rating - their_stats.mean
+                count, ours, theirs, products, sq_diffs = co_rated[v]
+                pair = CoRated(count - 1, ours - real_rating, theirs - their_rating,
+                               products - real_rating * their_rating, sq_diffs - (real_rating - their_rating) ** 2)
+                for measure, metric in FUSED_METRICS.items():
+                    weight = metric(pair, test_stats, their_stats)
+                    numers[measure] += diff * weight
+                    denoms[measure] += abs(weight)
+                weight = next(genre_weights)
+                numers['genre'] += diff * weight
+                denoms['genre'] += abs(weight)
+            for measure in measures:
+                if denoms[measure] != 0:
+                    res[measure][0] += (real_rating - our_avg - numers[measure] / denoms[measure]) ** 2
+                    res[measure][1] += 1
+    for measure in measures:
+        res[measure][2] = time.perf_counter() - began
+    return res
+
+
+def _knn_rmse_for_users(task: Tuple[bool, List[int], int, int, int, int]) -> Dict[str, List[float]]:
+    """Worker for calculate_rmse_for_each_distance_measure with "lsh": leave out each rating of each of the given
+    users in turn and predict it from the user's k nearest neighbours without it, found exactly and through the LSH
+    index. Returns the sum of squared errors, the number of predictions and the time spent finding the neighbours for
+    each, and for LSH also the number of the exact neighbours it found and the number of exact neighbours."""
+    full, users, k, min_common, tables, bits = task
+    store = load_rating_store(full)
+    res = {}
+    for measure in LSH_MEASURES:
+        index = load_lsh_index(measure, full, tables, bits)
+        exact_res = res[measure + ' knn'] = [0, 0, 0]
+        lsh_res = res[measure + ' lsh'] = [0, 0, 0, 0, 0]
+        for u in users:
+            our_stats = store.user_stats(u)
+            for m, real_rating in zip(*store.user_row(u)):
+                began = time.perf_counter()
+                exact = nearest_neighbours(store, u, k, min_common, [measure], m)[measure]
+                exact_res[2] += time.perf_counter() - began
+                began = time.perf_counter()
+                approximate = index.user_neighbours(store, u, k, min_common, m)
+                lsh_res[2] += time.perf_counter() - began
+                lsh_res[3] += len(set(exact[0]).intersection(approximate[0]))
+                lsh_res[4] += len(exact[0])
+                their_ratings = dict(zip(*store.movie_raters(m)))
+                for sums, (neighbours, weights) in ((exact_res, exact), (lsh_res, approximate)):
+                    numer = 0
+                    denom = 0
+                    for v, weight in zip(neighbours, weights):
+                        if v in their_ratings:
+                            numer += (their_ratings[v] - store.user_stats(v).mean) * weight
+                            denom += abs(weight)
+                    if denom != 0:
+                        sums[0] += (real_rating - our_stats.without(real_rating).mean - numer / denom) ** 2
+                        sums[1] += 1
+    return res
+
+
+def _factor_rmse_for_users(full: bool, users: List[int], holdout: Tuple[int, float], rank: int, iterations: int,
+                           regularization: float, workers: int) -> RmseResult:
+    """Train the matrix factorisation model without the held-out split and predict the held-out ratings of the given
+    users with it, all at once"""
+    began = time.perf_counter()
+    user_factors, movie_factors, user_biases, movie_biases, mean = train_factors(full, rank, iterations,
+                                                                                  regularization, workers,
+                                                                                  holdout=holdout)
+    training_seconds = time.perf_counter() - began
+    store = load_rating_store(full)
+    users = np.asarray(users, dtype=np.int64)
+    row, cols, vals, _ = gather_user_rows(store, users)
+    test = held_out(users[row], cols, *holdout)
+    users, movies, ratings = users[row[test]], cols[test], vals[test]
+    began = time.perf_counter()
+    # as FactorModel.predict, for many users at once
+    predictions = np.clip(np.einsum('ij,ij->i', user_factors[users], movie_factors[movies])
+                          + user_biases[users] + movie_biases[movies] + mean, 0.5, 5)
+    seconds = time.perf_counter() - began
+    return RmseResult(sqrt(float(((predictions - ratings) ** 2).mean())) if len(ratings) else float('nan'),
+                      len(ratings), seconds, training_seconds=training_seconds)
 
 
 def get_predicted_ratings(user_id: str, movie_ids: List[str],
-                          use_genres: bool, full: bool, cosine: bool, euclidean: bool) -> (NamedTuple, float):
+                          use_genres: bool, full: bool, cosine: bool, euclidean: bool,
+                          backend: str = 'python', neighbours: bool = False, item_based: bool = False,
+                          k: int = 50, min_common: int = 3, lsh: bool = False, lsh_tables: int = 8,
+                          lsh_bits: int = None, factors: bool = False, rank: int = 32, iterations: int = 10,
+                          regularization: float = 0.1) -> (NamedTuple, float):
     """For a given User ID, predict ratings for each movie in the list of MovieLens IDs using collaborative filtering.
-    "full" specifies that that full database should be used"""
+    "full" specifies that that full database should be used, "neighbours" that only the user's precomputed
+    nearest neighbours are weighted, "lsh" that only the k nearest of the candidates from the LSH index with
+    lsh_tables tables and lsh_bits bits per hash are, and "item_based" that the item-item similarity matrix with
+    k neighbours per movie is used instead. "factors" predicts from the matrix factorisation model with rank factors
+    trained for the given iterations and regularization instead. The rating is None if no neighbour could be
+    weighted, or if the factor model doesn't know the movie. Raises ValueError for unknown users or movies."""
     # Get mappings of movie_ids to Titles / Genres
     movies = get_movies_from_ids(movie_ids, use_genres, full)
+    unknown = [mid for mid in movie_ids if mid not in movies]
+    if unknown:
+        raise ValueError("unknown movies: {}".format(', '.join(unknown)))
+    predictions = predict_ratings(load_rating_store(full), movies, user_id, movie_ids, use_genres, full,
+                                  cosine, euclidean, backend=backend, neighbours=neighbours, item_based=item_based,
+                                  k=k, min_common=min_common, lsh=lsh, lsh_tables=lsh_tables, lsh_bits=lsh_bits,
+                                  factors=factors, rank=rank, iterations=iterations, regularization=regularization)
     for mid in movie_ids:
-        our_user_ratings, all_other_user_ratings = get_relevant_user_ratings(user_id, mid, full)
-        rating_sum = sum(rating for _, rating in our_user_ratings.items())
-        our_avg = rating_sum / len(our_user_ratings)
-        yield movies[mid], get_rating(mid, movies, our_user_ratings, all_other_user_ratings,
-                                      our_avg, use_genres, cosine, euclidean)
+        yield movies[mid], predictions.get(mid)
+
+
+def predict_ratings(store: 'RatingStore', movies: Dict[str, NamedTuple], user_id: str, movie_ids: List[str],
+                    use_genres: bool, full: bool, cosine: bool, euclidean: bool,
+                    backend: str = 'python', neighbours: bool = False, item_based: bool = False,
+                    k: int = 50, min_common: int = 3, lsh: bool = False, lsh_tables: int = 8,
+                    lsh_bits: int = None, factors: bool = False, rank: int = 32, iterations: int = 10,
+                    regularization: float = 0.1) -> Dict[str, float]:
+    """The work behind get_predicted_ratings on already loaded data: return a mapping from each Movie ID to its
+    predicted rating, leaving out movies for which no neighbour could be weighted"""
+    measure = 'cosine' if cosine else 'euclidean' if euclidean else 'pearson'
+    if factors:
+        return get_ratings_from_factors(store, load_factor_model(full, rank, iterations, regularization), user_id,
+                                        movie_ids)
+    elif item_based:
+        matrix = load_item_similarities('adjusted_cosine' if cosine else 'pearson', full, k, min_common)
+        return get_ratings_item_based(store, matrix, user_id, movie_ids)
+    elif lsh:
+        if measure not in LSH_MEASURES:
+            raise ValueError("the LSH index supports {}, not {}".format(' and '.join(LSH_MEASURES), measure))
+        our_index = store.user_index(user_id)
+        if our_index is None:
+            raise ValueError("user {} has no ratings in the dataset".format(user_id))
+        index = load_lsh_index(measure, full, lsh_tables, lsh_bits)
+        return get_ratings_from_neighbours(store, our_index, index.user_neighbours(store, our_index, k, min_common),
+                                           movie_ids)
+    elif neighbours:
+        return get_ratings_from_index(store, load_neighbour_index(measure, full), user_id, movie_ids)
+    elif backend == 'numpy' and not use_genres:
+        return get_ratings_vectorized(store, user_id, movie_ids, measure)
+    # Gather the neighbours of every requested movie at once so that each neighbour is only weighted once
+    our_index, others = get_relevant_users(store, user_id, movie_ids)
+    our_stats = store.user_stats(our_index)
+    weights = None
+    if use_genres:
+        genre_matrix = load_genre_matrix(store, movies, backend)
+        weights = genre_matrix.weights(genre_matrix.row(our_index), others, cosine, euclidean, backend=backend)
+    return get_ratings(movie_ids, movies, store.user_vector(our_index), [store.user_vector(u) for u in others],
+                       our_stats.mean, use_genres, cosine, euclidean, our_stats, [store.user_stats(u) for u in others],
+                       weights)
+
+
+# How many of the user's neighbours need to have rated a movie for it to be recommended by default: a movie rated by
+# a single neighbour gets that neighbour's offset at full weight, which fills the top of the list with outliers
+MIN_SUPPORT = 5
+
+
+def recommend_movies(store: 'RatingStore', movies: Dict[str, NamedTuple], user_id: str, n: int, full: bool,
+                     use_genres: bool = False, cosine: bool = False, euclidean: bool = False,
+                     backend: str = 'python', neighbours: bool = False, min_support: int = MIN_SUPPORT,
+                     only_genres: List[str] = None, lsh: bool = False, k: int = 50, min_common: int = 3,
+                     lsh_tables: int = 8, lsh_bits: int = None, factors: bool = False, rank: int = 32,
+                     iterations: int = 10, regularization: float = 0.1) -> List[Tuple[str, float]]:
+    """Return the n movies the user hasn't rated with the highest predicted ratings, best first, as (Movie ID, rating)
+    pairs. The candidates are the movies rated by at least min_support of the user's neighbours, optionally limited
+    to movies with any of only_genres. The neighbours are the precomputed nearest neighbours if "neighbours", the k
+    nearest found through the LSH index if "lsh", and otherwise the k nearest of the users who rated at least
+    min_common of the same movies, as nearest_neighbours finds them (or the k with the closest genres if
+    "use_genres"). Each neighbour is weighted once, and the weighted sums for every movie are accumulated in flat
+    arrays indexed by movie before a bounded heap picks the best n. Movies are ranked by their unclipped predictions
+    and the ratings returned are clipped to the 0.5 to 5 star scale.
+
+    With "factors", every movie the matrix factorisation model knows is scored with one matrix-vector product and
+    the candidates are the movies with at least min_support ratings."""
+    our_index = store.user_index(user_id)
+    if our_index is None:
+        raise ValueError("user {} has no ratings in the dataset".format(user_id))
+    allowed = None
+    if only_genres:
+        names, masks = genre_masks(store, movies)
+        unknown = set(only_genres).difference(names)
+        if unknown:
+            raise ValueError("unknown genre: {}".format(', '.join(sorted(unknown))))
+        allowed = sum(1 << names.index(genre) for genre in set(only_genres))
+    seen = set(store.user_row(our_index)[0])
+    if factors:
+        model = load_factor_model(full, rank, iterations, regularization)
+        scores = model.predict(our_index, clip=False)
+        keep = np.ones(model.n_movies, dtype=bool)
+        keep[[m for m in seen if m < model.n_movies]] = False
+        if min_support > 1:
+            keep &= np.fromiter((len(store.movie_raters(m)[0]) for m in range(model.n_movies)), dtype=np.int64,
+                                count=model.n_movies) >= min_support
+        if allowed is not None:
+            keep &= (np.frombuffer(masks, dtype=np.int32)[:model.n_movies] & allowed) != 0
+        candidates = np.flatnonzero(keep)
+        if len(candidates) > n:
+            candidates = candidates[np.argpartition(-scores[candidates], n - 1)[:n]]
+        best = candidates[np.argsort(-scores[candidates], kind='stable')]
+        ratings = np.clip(scores[best], 0.5, 5)
+        return [(store.movie_keys[m], rating) for m, rating in zip(best.tolist(), ratings.tolist())]
+    our_stats = store.user_stats(our_index)
+    measure = 'cosine' if cosine else 'euclidean' if euclidean else 'pearson'
+    if neighbours:
+        users, weights = (view.tolist() for view in load_neighbour_index(measure, full).user_neighbours(our_index))
+    elif lsh:
+        if measure not in LSH_MEASURES:
+            raise ValueError("the LSH index supports {}, not {}".format(' and '.join(LSH_MEASURES), measure))
+        users, weights = load_lsh_index(measure, full, lsh_tables, lsh_bits).user_neighbours(store, our_index, k,
+                                                                                             min_common)
+    elif use_genres:
+        _, users = get_relevant_users(store, user_id, list(store.user_vector(our_index)))
+        genre_matrix = load_genre_matrix(store, movies, backend)
+        weights = genre_matrix.weights(genre_matrix.row(our_index), users, cosine, euclidean, backend=backend)
+        # euclidean genre weights are distances, so the closest genres are the smallest
+        nearest = sorted(range(len(users)), key=weights.__getitem__, reverse=not euclidean)[:k]
+        users, weights = [users[i] for i in nearest], [weights[i] for i in nearest]
+    else:
+        users, weights = nearest_neighbours(store, our_index, k, min_common, [measure], backend=backend)[measure]
+
+    # the numerator and denominator of the weighted sum, and the number of neighbours who rated it, for every movie
+    if backend == 'numpy' and users:
+        users_array = np.asarray(users, dtype=np.int64)
+        row, cols, vals, lengths = gather_user_rows(store, users_array)
+        weights_array = np.asarray(weights, dtype=np.float64)
+        means = gather_user_totals(store, users_array)[0] / lengths
+        numers = np.bincount(cols, weights=(vals - means[row]) * weights_array[row], minlength=store.n_movies).tolist()
+        denoms = np.bincount(cols, weights=np.abs(weights_array)[row], minlength=store.n_movies).tolist()
+        support = np.bincount(cols, minlength=store.n_movies).tolist()
+    else:
+        numers = array('d', bytes(8 * store.n_movies))
+        denoms = array('d', bytes(8 * store.n_movies))
+        support = array('i', bytes(4 * store.n_movies))
+        for v, weight in zip(users, weights):
+            other_avg = store.user_stats(v).mean
+            for m, rating in zip(*store.user_row(v)):
+                numers[m] += (rating - other_avg) * weight
+                denoms[m] += abs(weight)
+                support[m] += 1
+
+    candidates = (m for m in range(store.n_movies)
+                  if support[m] >= min_support and denoms[m] != 0 and m not in seen
+                  and (allowed is None or masks[m] & allowed))
+    best = nlargest(n, candidates, key=lambda m: numers[m] / denoms[m])
+    return [(store.movie_keys[m], min(max(our_stats.mean + numers[m] / denoms[m], 0.5), 5)) for m in best]
+
+
+def score_pairs(source: str, destination: str, full: bool, id_type: str = 'movielens', workers: int = None,
+                chunk_size: int = 10000, **options) -> int:
+    """Predict the rating of every (user, movie) pair in a CSV or JSONL file across a pool of worker processes and
+    write them to destination ("-" for standard output) in the same format and order. Returns the number of pairs."""
+    check_prediction_options(options)
+    jsonl = source.endswith('.jsonl')
+    workers = workers or os.cpu_count()
+    began = time.perf_counter()
+    done = 0
+    pending = deque()
+
+    def write_oldest():
+        nonlocal done
+        chunk, result = pending.popleft()
+        for (user_id, movie_id), rating in zip(chunk, result.get()):
+            if jsonl:
+                output.write(json.dumps({'user_id': user_id, 'movie_id': movie_id, 'rating': rating}) + '\n')
+            else:
+                output.write('{},{},{}\n'.format(user_id, movie_id, '' if rating is None else rating))
+        done += len(chunk)
+        elapsed = time.perf_counter() - began
+        print("\r{} pairs, {:.0f} pairs/s".format(done, done / elapsed), end='', file=sys.stderr)
+
+    with open(source, encoding="utf8", newline='') as file, \
+            (open(destination, 'w', encoding="utf8", newline='') if destination != '-' else nullcontext(sys.stdout)) \
+            as output, Pool(workers) as pool:
+        if not jsonl:
+            output.write('userId,movieId,rating\n')
+        pairs = _read_pairs(file, jsonl)
+        for chunk in iter(lambda: list(islice(pairs, chunk_size)), []):
+            pending.append((chunk, pool.apply_async(_score_pairs_for_chunk, ((full, chunk, id_type, options),))))
+            if len(pending) >= 2 * workers:
+                write_oldest()
+        while pending:
+            write_oldest()
+    print(file=sys.stderr)
+    return done
+
+
+def _read_pairs(file, jsonl: bool):
+    """Yield the (user ID, movie ID) pairs of a file for score_pairs, as they are in the file"""
+    if jsonl:
+        for number, line in enumerate(file, 1):
+            if line.strip():
+                pair = json.loads(line)
+                if 'user_id' not in pair or 'movie_id' not in pair:
+                    raise ValueError("{} line {} needs user_id and movie_id".format(file.name, number))
+                yield pair['user_id'], pair['movie_id']
+        return
+    reader = csv.reader(file)
+    header = next(reader)
+    try:
+        user_column, movie_column = header.index('userId'), header.index('movieId')
+    except ValueError:
+        raise ValueError("{} needs userId and movieId columns".format(file.name))
+    for row in reader:
+        if row:
+            if len(row) <= max(user_column, movie_column):
+                raise ValueError("{} line {} has no userId or movieId".format(file.name, reader.line_num))
+            yield row[user_column], row[movie_column]
+
+
+def _score_pairs_for_chunk(task: Tuple[bool, List[tuple], str, dict]) -> List[Optional[float]]:
+    """Worker for score_pairs: predict each pair of a chunk with one call to predict_ratings per user over the
+    distinct movies of the user's pairs. A user predict_ratings rejects gets no ratings."""
+    full, pairs, id_type, options = task
+    store = load_rating_store(full)
+    movies = get_movies_from_ids(None, True, full)
+    keys = [str(movie_id) for _, movie_id in pairs]
+    if id_type != 'movielens':
+        keys = movies.translate(keys, id_type)
+    groups = {}
+    for (user_id, _), mid in zip(pairs, keys):
+        if mid is not None:
+            groups.setdefault(str(user_id), {})[mid] = None
+    for user_id, group in groups.items():
+        try:
+            groups[user_id] = predict_ratings(store, movies, user_id, list(group), full=full,
+                                              **dict(PREDICTION_OPTIONS, **options))
+        except ValueError:
+            groups[user_id] = {}
+    return [groups[str(user_id)].get(mid) if mid is not None else None for (user_id, _), mid in zip(pairs, keys)]
 
 
 def pearson_correlation(our_vector: Dict[str, float], other_vector: Dict[str, float],
-                        our_avg: float, other_avg: float) -> float:
-    """Compute the Pearson correlation between two vectors"""
+                        our_avg: float, other_avg: float,
+                        our_centered_ss: float = None, other_centered_ss: float = None) -> float:
+    """Compute the Pearson correlation between two vectors. The centered sums of squares of the vectors
+    (see UserStats) are computed from the vectors unless they are given."""
     numer = 0
     for mid, our_rating in our_vector.items():
         if mid in other_vector:
             numer += (our_rating - our_avg) * (other_vector[mid] - other_avg)
-    denom = sum((rating - our_avg) ** 2 for _, rating in our_vector.items())
-    denom *= sum((rating - other_avg) ** 2 for _, rating in other_vector.items())
+    if our_centered_ss is None:
+        our_centered_ss = sum((rating - our_avg) ** 2 for _, rating in our_vector.items())
+    if other_centered_ss is None:
+        other_centered_ss = sum((rating - other_avg) ** 2 for _, rating in other_vector.items())
+    denom = our_centered_ss * other_centered_ss
     return 0 if denom == 0 else numer / sqrt(denom)
 
 
-def cosine_similarity(our_vector: Dict[str, float], other_vector: List[Dict[str, float]]) -> float:
-    """Compute the cosine similarity between two vectors"""
+def cosine_similarity(our_vector: Dict[str, float], other_vector: List[Dict[str, float]],
+                      our_norm: float = None, other_norm: float = None) -> float:
+    """Compute the cosine similarity between two vectors. The L2 norms of the vectors are computed from the vectors
+    unless they are given."""
     numer = 0
     for key, our_score in our_vector.items():
         if key in other_vector:
             numer += our_score * other_vector[key]
-    denom = sqrt(sum(rating ** 2 for _, rating in our_vector.items()))
-    denom *= sqrt(sum(rating ** 2 for _, rating in other_vector.items()))
-    return numer / denom
+    if our_norm is None:
+        our_norm = sqrt(sum(rating ** 2 for _, rating in our_vector.items()))
+    if other_norm is None:
+        other_norm = sqrt(sum(rating ** 2 for _, rating in other_vector.items()))
+    return numer / (our_norm * other_norm)
 
 
 def euclidean_distance(our_vector: Dict[str, float], other_vector: List[Dict[str, float]]) -> float:
@@ -218,21 +892,211 @@ def canberra_distance(our_vector: Dict[str, float], other_vector: List[Dict[str,
                for key, our_score in our_vector.items() if key in other_vector)
 
 
+# Backends for computing similarities: the pure-Python functions above, one user pair at a time,
+# or vectorized_similarities() below, all of the neighbours at once
+BACKENDS = ('python', 'numpy')
+
+# Measures supported by vectorized_similarities(), named after the pure-Python function each one reproduces
+VECTORIZED_MEASURES = ('pearson', 'cosine', 'euclidean', 'square_euclidean', 'manhattan', 'bray_curtis', 'canberra')
+
+
+def vectorized_similarities(store: 'RatingStore', our_user_ratings: Dict[str, float], our_avg: float,
+                            users, measure: str = 'pearson', our_stats: 'UserStats' = None) -> ('np.ndarray', 'np.ndarray'):
+    """Compute the similarity (or distance) between our user's ratings and each of the given users in the store in
+    one vectorized pass, returning the similarities and the users' average ratings as arrays aligned with users.
+    Results match the pure-Python function of the same name given the same user statistics; pairs for which that
+    function would divide by zero come out as nan (or 0 for pearson, which already handles it)."""
+    if our_stats is None:
+        our_stats = user_statistics(our_user_ratings)
+    users = np.asarray(users, dtype=np.int64)
+    row, cols, vals, lengths = gather_user_rows(store, users)
+
+    # Our ratings as a dense vector over the movies, with a mask of the movies we rated
+    ours = np.zeros(store.n_movies)
+    rated = np.zeros(store.n_movies, dtype=bool)
+    for mid, rating in our_user_ratings.items():
+        m = store.movie_index(mid)
+        if m is not None:
+            ours[m] = rating
+            rated[m] = True
+    co_rated = rated[cols]
+    our_vals = ours[cols]
+
+    def row_sums(weights):
+        # bincount adds each row's terms in order, as the pure-Python functions do
+        return np.bincount(row, weights=weights, minlength=len(users))
+
+    # The users' statistics come straight from the table in the store
+    totals, totals_sq = gather_user_totals(store, users)
+    means = totals / lengths
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if measure == 'pearson':
+            numer = row_sums(np.where(co_rated, (our_vals - our_avg) * (vals - means[row]), 0))
+            denom = our_stats.centered_ss * (totals_sq - totals * totals / lengths)
+            res = np.where(denom == 0, 0, numer / np.sqrt(denom))
+        elif measure == 'cosine':
+            numer = row_sums(np.where(co_rated, our_vals * vals, 0))
+            res = numer / (our_stats.norm * np.sqrt(totals_sq))
+        elif measure in ('euclidean', 'square_euclidean'):
+            res = row_sums(np.where(co_rated, (our_vals - vals) ** 2, 0))
+            if measure == 'euclidean':
+                res = np.sqrt(res)
+        elif measure == 'manhattan':
+            res = row_sums(np.where(co_rated, np.abs(our_vals - vals), 0))
+        elif measure == 'bray_curtis':
+            res = row_sums(np.where(co_rated, np.abs(our_vals - vals), 0))
+            res /= row_sums(np.where(co_rated, np.abs(our_vals + vals), 0))
+        elif measure == 'canberra':
+            res = row_sums(np.where(co_rated, np.abs(our_vals - vals) / (np.abs(our_vals) + np.abs(vals)), 0))
+        else:
+            raise ValueError("unknown measure: {}".format(measure))
+    return res, means
+
+
+def gather_user_rows(store: 'RatingStore', users: 'np.ndarray') -> ('np.ndarray', 'np.ndarray', 'np.ndarray',
+                                                                     'np.ndarray'):
+    """Flatten the rows of the given users into one sparse matrix in coordinate form, keeping each row in order.
+    Returns the row (position in users), movie index and rating of every entry, and the length of each row.
+    The rows of users with ratings in the delta log are spliced in from the store's delta_rows."""
+    return _gather_slices(users, store.user_offsets, store.user_movies, store.user_ratings, store.n_base_users,
+                          store.delta_rows)
+
+
+def gather_movie_columns(store: 'RatingStore', movies: 'np.ndarray') -> ('np.ndarray', 'np.ndarray', 'np.ndarray',
+                                                                         'np.ndarray'):
+    """gather_user_rows for the columns of the given movies: returns the row (position in movies), user index and
+    rating of every entry, and the length of each column"""
+    return _gather_slices(movies, store.movie_offsets, store.movie_users, store.movie_ratings, store.n_base_movies,
+                          store.delta_columns)
+
+
+def _gather_slices(indices: 'np.ndarray', offsets: memoryview, keys: memoryview, values: memoryview, n_base: int,
+                   delta: dict) -> ('np.ndarray', 'np.ndarray', 'np.ndarray', 'np.ndarray'):
+    """The work behind gather_user_rows and gather_movie_columns on one side of the store"""
+    offsets = np.frombuffer(offsets, dtype=np.int64)
+    base = indices < n_base
+    updated = _in_delta(indices, delta)
+    base &= ~updated
+    starts = offsets[np.where(base, indices, 0)]
+    lengths = np.where(base, offsets[np.where(base, indices + 1, 0)] - starts, 0)
+    positions = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    cols = np.frombuffer(keys, dtype=np.int32)[positions]
+    vals = np.frombuffer(values, dtype=np.float32)[positions].astype(np.float64)
+    if updated.any():
+        at = np.flatnonzero(updated)
+        rows = [delta[i] for i in indices[at].tolist()]
+        delta_lengths = np.array([len(row_keys) for row_keys, _ in rows], dtype=np.int64)
+        # each row goes where it would have started among the others, in order
+        before = np.repeat((np.cumsum(lengths) - lengths)[at], delta_lengths)
+        cols = np.insert(cols, before, np.concatenate([np.frombuffer(row_keys, dtype=np.int32)
+                                                       for row_keys, _ in rows]))
+        vals = np.insert(vals, before, np.concatenate([np.frombuffer(row_values, dtype=np.float32)
+                                                       for _, row_values in rows]).astype(np.float64))
+        lengths[at] = delta_lengths
+    row = np.repeat(np.arange(len(indices)), lengths)
+    return row, cols, vals, lengths
+
+
+def gather_user_totals(store: 'RatingStore', users: 'np.ndarray') -> ('np.ndarray', 'np.ndarray'):
+    """Return the sum and the sum of squares of the ratings of each of the given users from the statistics table,
+    or from the store's delta_stats for users with ratings in the delta log"""
+    base = np.where(users < store.n_base_users, users, 0)
+    totals = np.frombuffer(store.user_totals, dtype=np.float64)[base]
+    totals_sq = np.frombuffer(store.user_totals_sq, dtype=np.float64)[base]
+    at = np.flatnonzero(_in_delta(users, store.delta_stats))
+    for i, u in zip(at.tolist(), users[at].tolist()):
+        stats = store.delta_stats[u]
+        totals[i], totals_sq[i] = stats.total, stats.total_sq
+    return totals, totals_sq
+
+
+def gather_user_counts(store: 'RatingStore', users: 'np.ndarray') -> 'np.ndarray':
+    """Return the number of ratings of each of the given users, as gather_user_totals does for their sums"""
+    offsets = np.frombuffer(store.user_offsets, dtype=np.int64)
+    base = users < store.n_base_users
+    counts = np.where(base, offsets[np.where(base, users + 1, 0)] - offsets[np.where(base, users, 0)], 0)
+    at = np.flatnonzero(_in_delta(users, store.delta_stats))
+    for i, u in zip(at.tolist(), users[at].tolist()):
+        counts[i] = store.delta_stats[u].count
+    return counts
+
+
+def _in_delta(users: 'np.ndarray', delta: dict) -> 'np.ndarray':
+    """Return a mask of the users that have an entry in one of the store's delta mappings"""
+    if not delta:
+        return np.zeros(len(users), dtype=bool)
+    return np.isin(users, np.fromiter(delta, dtype=np.int64, count=len(delta)))
+
+
+def get_ratings_vectorized(store: 'RatingStore', user_id: str, movie_ids: List[str],
+                           measure: str = 'pearson') -> Dict[str, float]:
+    """get_ratings for the numpy backend: score every user who rated any of the movie_ids against our user with one
+    call to vectorized_similarities, then take the weighted sum over each movie's raters straight from the store"""
+    our_index = store.user_index(user_id)
+    if our_index is None:
+        raise ValueError("user {} has no ratings in the dataset".format(user_id))
+    our_stats = store.user_stats(our_index)
+    columns = {mid: store.movie_raters(m) for mid, m in ((mid, store.movie_index(mid)) for mid in movie_ids)
+               if m is not None}
+    if not columns:
+        return {}
+    users = np.unique(np.concatenate([np.frombuffer(raters, dtype=np.int32) for raters, _ in columns.values()]))
+    users = users[users != our_index]
+    our_avg = our_stats.mean
+    weights, means = vectorized_similarities(store, store.user_vector(our_index), our_avg, users, measure, our_stats)
+    predictions = {}
+    for mid, (raters, ratings) in columns.items():
+        raters = np.frombuffer(raters, dtype=np.int32)
+        others = raters != our_index
+        positions = np.searchsorted(users, raters[others])
+        weight = weights[positions]
+        denom = np.abs(weight).sum()
+        if denom != 0:
+            numer = ((np.frombuffer(ratings, dtype=np.float32)[others] - means[positions]) * weight).sum()
+            predictions[mid] = our_avg + float(numer / denom)
+    return predictions
+
+
 def get_rating(mid: str,
                movies: List[str], our_user_ratings: Dict[str, float], all_other_user_ratings: List[Dict[str, float]],
                our_avg: float,
-               use_genres: bool = False, cosine: bool = False, euclidean: bool = False) -> float:
+               use_genres: bool = False, cosine: bool = False, euclidean: bool = False,
+               our_stats: 'UserStats' = None, other_stats: List['UserStats'] = None) -> float:
     """Given a Movie ID and a list of our user's ratings, return the predicted rating for each movie
     using collaborative filtering with a distance function based on user arguments"""
-    numer = 0
-    denom = 0
-    if use_genres:
+    try:
+        return get_ratings([mid], movies, our_user_ratings, all_other_user_ratings,
+                           our_avg, use_genres, cosine, euclidean, our_stats, other_stats)[mid]
+    except KeyError:
+        # none of the other users could be weighted
+        raise ZeroDivisionError("no weighted neighbours for movie {}".format(mid))
+
+
+def get_ratings(movie_ids: List[str],
+                movies: List[str], our_user_ratings: Dict[str, float], all_other_user_ratings: List[Dict[str, float]],
+                our_avg: float,
+                use_genres: bool = False, cosine: bool = False, euclidean: bool = False,
+                our_stats: 'UserStats' = None, other_stats: List['UserStats'] = None,
+                weights: List[float] = None) -> Dict[str, float]:
+    """Batched version of get_rating: return a mapping from each Movie ID to its predicted rating. The weight of each
+    other user is computed once and shared by all of the movies they rated, and movies for which no other user could
+    be weighted are left out. our_stats and other_stats (aligned with all_other_user_ratings) are the users' entries
+    in the statistics table; they are computed from the vectors when not given. weights (also aligned with
+    all_other_user_ratings) can supply precomputed weights, e.g. from GenreMatrix.weights."""
+    if our_stats is None:
+        our_stats = user_statistics(our_user_ratings)
+    if other_stats is None:
+        other_stats = [user_statistics(other_user_ratings) for other_user_ratings in all_other_user_ratings]
+    targets = set(movie_ids)
+    numers = dict.fromkeys(targets, 0)
+    denoms = dict.fromkeys(targets, 0)
+    if use_genres and weights is None:
         # using genre-based weighting was considered, but after further testing showed poor results
         corpus = {}
         for other_user_ratings in all_other_user_ratings:
             seen = set()
-            for mid, _ in other_user_ratings.items():
-                for genre in movies[mid].genres:
+            for other_mid, _ in other_user_ratings.items():
+                for genre in movies[other_mid].genres:
                     if genre not in seen:
                         seen.add(genre)
                         try:
@@ -242,27 +1106,30 @@ def get_rating(mid: str,
         n = len(all_other_user_ratings)
         # get frequencies for all of the genres in our list of movies
         our_genre_frequencies = get_genre_frequencies(our_user_ratings, movies)
-    for other_user_ratings in all_other_user_ratings:
+    for i, (other_user_ratings, stats) in enumerate(zip(all_other_user_ratings, other_stats)):
         # for all the other users that we're comparing against
         # (ones who have rated any movie for which we want the prediction)
-        if mid not in other_user_ratings:
+        rated = [mid for mid in targets if mid in other_user_ratings]
+        if not rated:
             continue
-        # compute their average score
-        other_avg = sum(rating for _, rating in other_user_ratings.items()) / len(other_user_ratings)
-        diff = (other_user_ratings[mid] - other_avg)
-        if use_genres:
+        other_avg = stats.mean
+        if weights is not None:
+            weight = weights[i]
+        elif use_genres:
             weight = get_genre_weight(our_user_ratings, other_user_ratings, our_genre_frequencies,
-                                      movies, corpus, n, our_avg, other_avg, cosine, euclidean)
+                                      movies, corpus, n, cosine, euclidean)
         elif cosine:
-            weight = cosine_similarity(our_user_ratings, other_user_ratings)
+            weight = cosine_similarity(our_user_ratings, other_user_ratings, our_stats.norm, stats.norm)
         elif euclidean:
             weight = euclidean_distance(our_user_ratings, other_user_ratings)
         else:
-            weight = pearson_correlation(our_user_ratings, other_user_ratings, our_avg, other_avg)
-        numer += diff * weight
-        denom += abs(weight)
-    # return the weighted sum of ratings for the given movie id
-    return our_avg + (numer / denom)
+            weight = pearson_correlation(our_user_ratings, other_user_ratings, our_avg, other_avg,
+                                         our_stats.centered_ss, stats.centered_ss)
+        for mid in rated:
+            numers[mid] += (other_user_ratings[mid] - other_avg) * weight
+            denoms[mid] += abs(weight)
+    # return the weighted sum of ratings for each movie id
+    return {mid: our_avg + (numers[mid] / denoms[mid]) for mid in targets if denoms[mid] != 0}
 
 
 def get_genre_weight(our_user_ratings: Dict[str, float], other_user_ratings: Dict[str, float],
@@ -270,24 +1137,25 @@ def get_genre_weight(our_user_ratings: Dict[str, float], other_user_ratings: Dic
                      corpus: Dict[str, int], n: int,
                      cosine: bool, euclidean: bool,
                      augmented: bool = False, boolean: bool = False,
-                     logarithmic: bool = True, smooth: bool = True) -> float:
+                     logarithmic: bool = True, smooth: bool = True,
+                     genre_frequencies: Dict[str, int] = None) -> float:
     """Return the distance between tf-idf vectors of the genres in our list of movies and the genres in the other
-    user's list of movies."""
-    genre_frequencies = get_genre_frequencies(other_user_ratings, movies)
+    user's list of movies. genre_frequencies are the other user's, computed from other_user_ratings if not given."""
+    if genre_frequencies is None:
+        genre_frequencies = get_genre_frequencies(other_user_ratings, movies)
     # using genre-based weighting was considered, but after further testing showed poor results
     # genre_frequencies contains the frequencies of genres in the document
     # for each query term (genre in our_user_ratings), compute the tf-idf for the term
     other_vector = {}
     our_vector = {}
     # Create a mapping from genres to their tf-idf scores so we can compare two users
-    # based on the difference between tf-idf scores of different genres within their list of rated movies
-    for mid, _ in our_user_ratings.items():
-        for genre in movies[mid].genres:
-            if genre not in our_vector:
-                other_vector[genre] = tf_idf(genre_frequencies, genre, corpus, n,
-                                             augmented, boolean, logarithmic, smooth)
-                our_vector[genre] = tf_idf(our_genre_frequencies, genre, corpus, n,
-                                           augmented, boolean, logarithmic, smooth)
+    # based on the difference between tf-idf scores of different genres within their list of rated movies.
+    # our_genre_frequencies holds exactly the genres of our movies, in the order they first appear.
+    for genre in our_genre_frequencies:
+        other_vector[genre] = tf_idf(genre_frequencies, genre, corpus, n,
+                                     augmented, boolean, logarithmic, smooth)
+        our_vector[genre] = tf_idf(our_genre_frequencies, genre, corpus, n,
+                                   augmented, boolean, logarithmic, smooth)
     if cosine:
         return cosine_similarity(our_vector, other_vector)
     elif euclidean:
@@ -346,73 +1214,2061 @@ def inverse_document_frequency(genre: str, corpus: Dict[str, int], n: int, smoot
         return log(n / total)
 
 
-def get_movie_ids_from_webdb_ids(ids: List[str], full: bool, imdb: bool, tmdb: bool) -> List[str]:
-    """Given a list of IMDb IDs, return a list of Movie IDs corresponding to the same movie in the database"""
-    filename = 'ml-latest/links.csv' if full else 'ml-latest-small/links.csv'
-    with open(filename, encoding="utf8") as file:
-        reader = csv.reader(file)
-        next(reader)
-        if tmdb:
-            return [mid for mid, _, tmdb_id in reader if tmdb_id in ids]
-        elif imdb:
-            for i in range(len(ids)):
-                ids[i] = ids[i].zfill(7)
-            return [mid for mid, imdb_id, _ in reader if imdb_id in ids]
+# Loaded genre matrices, keyed by the path of the ratings store they were built from
+_genre_matrices = {}
+
+
+class GenreMatrix:
+    """The genres of every movie in a RatingStore as bitmasks (bit i is genres[i]) and the number of movies of each
+    genre every user rated as a dense users x genres matrix, from which GenreMatrix.weights computes the same
+    tf-idf genre weights as get_genre_weight for many users at once. The matrix is counted from the base store, with
+    the given backend, and update() recounts the rows of the users with ratings in the delta log."""
+
+    def __init__(self, store: 'RatingStore', movies: Dict[str, NamedTuple], backend: str = 'python'):
+        self.store = store
+        self.movies = movies
+        self.genres, self.masks = genre_masks(store, movies)
+        n_genres = len(self.genres)
+        n_users = store.n_base_users
+        if backend == 'numpy':
+            masks = np.frombuffer(self.masks, dtype=np.int32)
+            user_of = np.repeat(np.arange(n_users), np.diff(np.frombuffer(store.user_offsets, dtype=np.int64)))
+            rated = masks[np.frombuffer(store.user_movies, dtype=np.int32)]
+            counts = np.zeros((n_users, n_genres), dtype=np.int32)
+            for g in range(n_genres):
+                counts[:, g] = np.bincount(user_of, weights=(rated >> g) & 1, minlength=n_users)
+            self.counts = array('i', counts.tobytes())
         else:
-            return ids
+            self.counts = counts = array('i', bytes(4 * n_users * n_genres))
+            # the genres of each distinct mask are only worked out once
+            mask_genres = {mask: [g for g in range(n_genres) if mask >> g & 1] for mask in set(self.masks)}
+            movie_genres = [mask_genres[mask] for mask in self.masks]
+            offsets, user_movies = store.user_offsets, store.user_movies
+            for u in range(n_users):
+                base = u * n_genres
+                for m in user_movies[offsets[u]:offsets[u + 1]]:
+                    for g in movie_genres[m]:
+                        counts[base + g] += 1
+        self._applied = 0
+        self.update()
+
+    def update(self):
+        """Recount the rows of the users who rated, re-rated or deleted a rating of a movie since the last update,
+        adding rows for new users and masks for new movies"""
+        store = self.store
+        changes = store.changes[self._applied:]
+        self._applied += len(changes)
+        if not changes:
+            return
+        n_genres = len(self.genres)
+        for key in store.movie_keys[len(self.masks):]:
+            self.masks.append(sum(1 << self.genres.index(genre) for genre in set(self.movies[key].genres))
+                              if key in self.movies else 0)
+        self.counts.extend(array('i', bytes(4 * n_genres * (store.n_users - len(self.counts) // n_genres))))
+        for u in {u for u, _ in changes}:
+            row = [0] * n_genres
+            for m in store.user_row(u)[0]:
+                mask = self.masks[m]
+                for g in range(n_genres):
+                    if mask >> g & 1:
+                        row[g] += 1
+            self.counts[u * n_genres:(u + 1) * n_genres] = array('i', row)
+
+    def row(self, user_index: int) -> List[int]:
+        """Return the user's genre counts"""
+        n_genres = len(self.genres)
+        return self.counts[user_index * n_genres:(user_index + 1) * n_genres].tolist()
+
+    def without(self, counts: List[int], movie_index: int) -> List[int]:
+        """Return genre counts with one of the rated movies left out"""
+        mask = self.masks[movie_index]
+        return [count - (mask >> g & 1) for g, count in enumerate(counts)]
+
+    def weights(self, our_counts: List[int], users: List[int], cosine: bool, euclidean: bool,
+                augmented: bool = False, boolean: bool = False,
+                logarithmic: bool = True, smooth: bool = True, backend: str = 'python') -> List[float]:
+        """Return get_genre_weight between our genre counts and each of the given users, taking the users as the
+        corpus and computing with the given backend. Pairs whose tf-idf vectors have no spread get a weight of 0."""
+        n_genres = len(self.genres)
+        n = len(users)
+        # only the genres of our movies are compared
+        ours = [g for g in range(n_genres) if our_counts[g]]
+        if not n or not ours:
+            return [0] * n
+        our_tf = term_frequencies(our_counts, augmented, boolean, logarithmic)
+        if backend == 'numpy':
+            full_counts = np.frombuffer(self.counts, dtype=np.int32).reshape(-1, n_genres)[np.asarray(users)]
+            counts = full_counts[:, ours]
+            document_frequency = (counts > 0).sum(axis=0)
+            with np.errstate(divide='ignore'):
+                idf = np.where(document_frequency > 0, np.log(((1 + n) if smooth else n) / document_frequency), 0)
+            if augmented:
+                tf = 0.5 + 0.5 * counts / full_counts.max(axis=1, keepdims=True)
+            elif boolean:
+                tf = (counts > 0).astype(np.float64)
+            elif logarithmic:
+                tf = np.log1p(counts)
+            else:
+                tf = counts / full_counts.sum(axis=1, keepdims=True)
+            theirs = tf * idf
+            our_vector = np.array([our_tf[g] for g in ours]) * idf
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if cosine:
+                    numer = theirs @ our_vector
+                    denom = np.sqrt((theirs ** 2).sum(axis=1)) * sqrt((our_vector ** 2).sum())
+                    res = np.where(denom != 0, numer / denom, 0)
+                elif euclidean:
+                    res = np.sqrt(((theirs - our_vector) ** 2).sum(axis=1))
+                else:
+                    theirs = theirs - theirs.mean(axis=1, keepdims=True)
+                    our_vector = our_vector - our_vector.mean()
+                    denom = (theirs ** 2).sum(axis=1) * (our_vector ** 2).sum()
+                    res = np.where(denom != 0, (theirs @ our_vector) / np.sqrt(denom), 0)
+            return res.tolist()
+        document_frequency = [0] * n_genres
+        rows = [self.row(v) for v in users]
+        for row in rows:
+            for g in ours:
+                if row[g]:
+                    document_frequency[g] += 1
+        idf = [log(((1 + n) if smooth else n) / document_frequency[g]) if document_frequency[g] else 0
+               for g in range(n_genres)]
+        our_vector = [our_tf[g] * idf[g] for g in ours]
+        res = []
+        for row in rows:
+            tf = term_frequencies(row, augmented, boolean, logarithmic)
+            their_vector = [tf[g] * idf[g] for g in ours]
+            if cosine:
+                denom = sqrt(sum(x * x for x in our_vector)) * sqrt(sum(x * x for x in their_vector))
+                res.append(sum(x * y for x, y in zip(our_vector, their_vector)) / denom if denom else 0)
+            elif euclidean:
+                res.append(sqrt(sum((x - y) ** 2 for x, y in zip(our_vector, their_vector))))
+            else:
+                our_avg = sum(our_vector) / len(our_vector)
+                their_avg = sum(their_vector) / len(their_vector)
+                numer = sum((x - our_avg) * (y - their_avg) for x, y in zip(our_vector, their_vector))
+                denom = sum((x - our_avg) ** 2 for x in our_vector) * sum((y - their_avg) ** 2 for y in their_vector)
+                res.append(numer / sqrt(denom) if denom else 0)
+        return res
+
+
+def genre_masks(store: 'RatingStore', movies: Dict[str, NamedTuple]) -> (List[str], array):
+    """Return the sorted list of genres and, for every movie in the store, its genres as a bitmask in which bit i
+    stands for the i-th genre"""
+    if isinstance(movies, Catalogue):
+        # the catalogue's bitmasks are over the same sorted genres
+        codes = movies.genre_codes
+        return list(movies.genres), array('i', (codes[i] if i >= 0 else 0
+                                                for i in movies.movie_indices(store.movie_keys)))
+    genres = sorted({genre for movie in movies.values() for genre in movie.genres})
+    bits = {genre: 1 << i for i, genre in enumerate(genres)}
+    return genres, array('i', (sum(bits[genre] for genre in set(movies[key].genres)) if key in movies else 0
+                               for key in store.movie_keys))
+
+
+def term_frequencies(counts: List[int], augmented: bool, boolean: bool, logarithmic: bool) -> List[float]:
+    """term_frequency for every genre of a row of genre counts"""
+    if augmented:
+        most = max(counts)
+        return [0.5 + (0.5 * (count / most)) for count in counts]
+    elif boolean:
+        return [1 if count else 0 for count in counts]
+    elif logarithmic:
+        return [log(1 + count) for count in counts]
+    else:
+        total = sum(counts)
+        return [count / total for count in counts]
+
+
+def load_genre_matrix(store: 'RatingStore', movies: Dict[str, NamedTuple], backend: str = 'python') -> GenreMatrix:
+    """Return the genre matrix of a ratings store, counting it with the given backend the first time it is needed"""
+    filename = store.filename
+    matrix = _genre_matrices.get(filename)
+    if matrix is None or matrix.store is not store:
+        matrix = _genre_matrices[filename] = GenreMatrix(store, movies, backend)
+    matrix.update()
+    return matrix
+
+
+def get_movie_ids_from_webdb_ids(ids: List[str], full: bool, imdb: bool, tmdb: bool) -> List[str]:
+    """Given a list of IMDb (or TMDb) IDs, return a list of Movie IDs corresponding to the same movies in the database,
+    leaving out IDs that aren't in links.csv"""
+    if not (imdb or tmdb):
+        return list(ids)
+    return [mid for mid in load_catalogue(full).translate(ids, 'tmdb' if tmdb else 'imdb') if mid is not None]
+
+
+class Movie(NamedTuple):
+    """A movie of movies.csv"""
+    title: str
+    genres: List[str]
 
 
 def get_movies_from_ids(movie_ids: List[str], get_all: bool, full: bool) -> Dict[str, NamedTuple]:
-    """Return a mapping from Movie IDs to a name, genres pair"""
-    filename = 'ml-latest/movies.csv' if full else 'ml-latest-small/movies.csv'
-    with open(filename, encoding="utf8") as file:
-        reader = csv.reader(file)
-        next(reader)
-        Movie = namedtuple('Movie', ['title', 'genres'])
-        if get_all:
-            # If we're computing the genre rating, we need the genres for all the movies we'll encounter, not just
-            # the ones in the movie_ids we're looking for
-
-            # TODO We know all the movies that we'll run into once we get_relevant_user_ratings()
-            # so make a separate method for when the genre-based method is being used
-            # that is run AFTER get_relevant_user_ratings()
-            return {mid: Movie(title, genres.split('|')) for mid, title, genres in reader}
-        else:
-            return {mid: Movie(title, genres.split('|')) for mid, title, genres in reader if mid in movie_ids}
+    """Return a mapping from Movie IDs to a name, genres pair: the whole catalogue if get_all, otherwise just the
+    movie_ids that are in it"""
+    catalogue = load_catalogue(full)
+    if get_all:
+        # If we're computing the genre rating, we need the genres for all the movies we'll encounter, not just
+        # the ones in the movie_ids we're looking for
+        return catalogue
+    return {mid: catalogue[mid] for mid in movie_ids if mid in catalogue}
 
 
 def get_relevant_user_ratings(user_id: str, movie_ids: List[str], full: bool) -> (Dict[str, float], List[Dict[str, float]]):
     """Given a User ID and a list of movies, return the User ID's ratings
     as well as all movies rated by any user who rated any of the movie_ids"""
-    filename = 'ml-latest/ratings.csv' if full else 'ml-latest-small/ratings.csv'
-    with open(filename, encoding="utf8") as file:
+    store = load_rating_store(full)
+    our_index, others = get_relevant_users(store, user_id, movie_ids)
+    return store.user_vector(our_index), [store.user_vector(u) for u in others]
+
+
+def get_relevant_users(store: 'RatingStore', user_id: str, movie_ids: List[str]) -> (int, List[int]):
+    """Given a User ID and a list of movies, return the user's index in the store and the sorted indices
+    of every other user who rated any of the movie_ids"""
+    our_index = store.user_index(user_id)
+    if our_index is None:
+        raise ValueError("user {} has no ratings in the dataset".format(user_id))
+    others = set()
+    for mid in movie_ids:
+        movie_index = store.movie_index(mid)
+        if movie_index is not None:
+            others.update(store.movie_raters(movie_index)[0])
+    others.discard(our_index)
+    return our_index, sorted(others)
+
+
+def dataset_file(name: str, full: bool) -> str:
+    """Return the path of a file in the full or small MovieLens dataset directory"""
+    return os.path.join('ml-latest' if full else 'ml-latest-small', name)
+
+
+# Header of the movie catalogue: magic, version, size and mtime of the movies.csv and links.csv it was compiled from
+# (-1 for a missing links.csv), then the number of movies, of IMDb links, of TMDb links, of bytes of titles and of
+# bytes of genre names. It is followed by the sorted MovieLens IDs, the genres of each movie as a bitmask over the
+# sorted genre names, the offsets of each movie's title, the UTF-8 titles, the genre names separated by "|", then
+# the IMDb IDs and the TMDb IDs of the links, each sorted and followed by the index of the movie of each.
+CATALOGUE_MAGIC = b'MLMC'
+CATALOGUE_VERSION = 1
+CATALOGUE_HEADER = struct.Struct('=4sIqqqqqqqqq')
+
+# The kinds of IDs movies can be looked up by
+ID_TYPES = ('movielens', 'imdb', 'tmdb')
+
+# Loaded catalogues, keyed by the path of the binary file
+_catalogues = {}
+
+
+class Catalogue(Mapping):
+    """Memory-mapped index of movies.csv and links.csv that reads as a mapping from Movie IDs to Movie tuples.
+
+    Movies are numbered densely in order of their MovieLens IDs. A movie's tuple is only built when it is looked
+    up, from its genre bitmask (bit i is genres[i]) and its slice of the titles, so nothing is parsed up front. The
+    IMDb and TMDb IDs of the links are kept sorted with the index of their movie: one ID is found by binary search
+    and many at once by one vectorized search with numpy."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._mmap, header, section = _map_binary(filename, CATALOGUE_HEADER, CATALOGUE_MAGIC, CATALOGUE_VERSION)
+        (self.movies_size, self.movies_mtime, self.links_size, self.links_mtime, self.n_movies, n_imdb, n_tmdb,
+         n_title_bytes, n_genre_bytes) = header
+        self.movie_ids = section('i', self.n_movies)
+        self.genre_codes = section('i', self.n_movies)
+        self.title_offsets = section('q', self.n_movies + 1)
+        self.titles = section('B', n_title_bytes)
+        self.genres = str(section('B', n_genre_bytes), 'utf8').split('|') if n_genre_bytes else []
+        self.links = {'imdb': (section('q', n_imdb), section('i', n_imdb)),
+                      'tmdb': (section('q', n_tmdb), section('i', n_tmdb))}
+
+    def __reduce__(self):
+        # worker processes map the file again rather than receiving a copy of it
+        return Catalogue, (self.filename,)
+
+    def is_current(self, movies_source: str, links_source: str) -> bool:
+        """Whether the catalogue was compiled from the given movies.csv and links.csv as they are now"""
+        return (self.movies_size, self.movies_mtime, self.links_size, self.links_mtime) == \
+            _source_stamp(movies_source) + _source_stamp(links_source)
+
+    def __getitem__(self, movie_id: str) -> Movie:
+        movie_index = self.movie_index(movie_id)
+        if movie_index is None:
+            raise KeyError(movie_id)
+        return self.movie(movie_index)
+
+    def __contains__(self, movie_id) -> bool:
+        return self.movie_index(movie_id) is not None
+
+    def __iter__(self):
+        return (str(mid) for mid in self.movie_ids)
+
+    def __len__(self) -> int:
+        return self.n_movies
+
+    def movie_index(self, movie_id: str) -> Optional[int]:
+        """Return the dense index of a MovieLens movie ID, or None if it isn't in movies.csv"""
+        return _find(self.movie_ids, _parse_id(movie_id))
+
+    def movie(self, movie_index: int) -> Movie:
+        """Return the title and genres of the movie with the given dense index"""
+        start, end = self.title_offsets[movie_index], self.title_offsets[movie_index + 1]
+        code = self.genre_codes[movie_index]
+        return Movie(str(self.titles[start:end], 'utf8'),
+                     [genre for i, genre in enumerate(self.genres) if code >> i & 1])
+
+    def movie_indices(self, ids: List[str], id_type: str = 'movielens') -> List[int]:
+        """Return the dense index of the movie of each of the given MovieLens, IMDb or TMDb IDs, or -1 for IDs that
+        aren't in the catalogue"""
+        if id_type == 'movielens':
+            keys, movies = self.movie_ids, None
+        else:
+            keys, movies = self.links[id_type]
+        values = [_parse_id(value, id_type) for value in ids]
+        res = []
+        for value in values:
+            i = _find(keys, value)
+            res.append(-1 if i is None else i if movies is None else movies[i])
+        return res
+
+    def translate(self, ids: List[str], id_type: str = 'movielens') -> List[Optional[str]]:
+        """Translate MovieLens, IMDb or TMDb IDs to the Movie IDs used everywhere else, with None for IDs that aren't
+        in the catalogue. Leading zeros and a "tt" prefix of IMDb IDs don't matter."""
+        movie_ids = self.movie_ids
+        return [str(movie_ids[i]) if i >= 0 else None for i in self.movie_indices(ids, id_type)]
+
+
+def _parse_id(value: str, id_type: str = 'movielens') -> int:
+    """Parse a MovieLens, IMDb or TMDb ID, or return -1, which no movie has. Only IMDb IDs may start with "tt"."""
+    value = str(value).strip()
+    if id_type == 'imdb' and value[:2].lower() == 'tt':
+        value = value[2:]
+    return int(value) if value.isdecimal() else -1
+
+
+def _source_stamp(source: str) -> (int, int):
+    """Return the size and mtime of a source file, or -1 for both if it is missing"""
+    try:
+        stat = os.stat(source)
+    except FileNotFoundError:
+        return -1, -1
+    return stat.st_size, stat.st_mtime_ns
+
+
+def load_catalogue(full: bool) -> Catalogue:
+    """Return the memory-mapped movie catalogue for the dataset, compiling it first if it is missing or if
+    movies.csv or links.csv have changed since it was compiled"""
+    movies_source = dataset_file('movies.csv', full)
+    links_source = dataset_file('links.csv', full)
+    filename = dataset_file('catalogue.bin', full)
+    catalogue = _catalogues.get(filename)
+    if catalogue is None or not catalogue.is_current(movies_source, links_source):
+        try:
+            catalogue = Catalogue(filename)
+        except (OSError, ValueError, struct.error):
+            catalogue = None
+        if catalogue is None or not catalogue.is_current(movies_source, links_source):
+            catalogue = Catalogue(compile_catalogue(full))
+        _catalogues[filename] = catalogue
+    return catalogue
+
+
+def compile_catalogue(full: bool) -> str:
+    """Parse movies.csv and links.csv once and write the catalogue next to them. Returns its path."""
+    movies_source = dataset_file('movies.csv', full)
+    links_source = dataset_file('links.csv', full)
+    # take the stamps first so that a file changed while it is read is compiled again next time
+    stamp = _source_stamp(movies_source) + _source_stamp(links_source)
+    with open(movies_source, encoding="utf8") as file:
+        reader = csv.reader(file)
+        next(reader)
+        rows = sorted((int(mid), title, genres.split('|')) for mid, title, genres in reader)
+    genres = sorted({genre for _, _, movie_genres in rows for genre in movie_genres})
+    if len(genres) > 31:
+        raise ValueError("the catalogue packs up to 31 genres into a bitmask, {} has {}".format(movies_source,
+                                                                                          len(genres)))
+    bits = {genre: 1 << i for i, genre in enumerate(genres)}
+    movie_ids = array('i', (mid for mid, _, _ in rows))
+    genre_codes = array('i', (sum(bits[genre] for genre in set(movie_genres)) for _, _, movie_genres in rows))
+    titles = bytearray()
+    title_offsets = array('q', [0])
+    for _, title, _ in rows:
+        titles += title.encode('utf8')
+        title_offsets.append(len(titles))
+    links = {'imdb': [], 'tmdb': []}
+    if stamp[2] != -1:
+        with open(links_source, encoding="utf8") as file:
+            reader = csv.reader(file)
+            next(reader)
+            for mid, imdb_id, tmdb_id in reader:
+                movie_index = _find(movie_ids, int(mid))
+                if movie_index is None:
+                    continue
+                for id_type, value in (('imdb', imdb_id), ('tmdb', tmdb_id)):
+                    if value:
+                        links[id_type].append((int(value), movie_index))
+    genre_names = '|'.join(genres).encode('utf8')
+    sections = [movie_ids, genre_codes, title_offsets, array('B', titles), array('B', genre_names)]
+    for id_type in ('imdb', 'tmdb'):
+        pairs = sorted(links[id_type])
+        sections += [array('q', (value for value, _ in pairs)), array('i', (m for _, m in pairs))]
+    filename = dataset_file('catalogue.bin', full)
+    _write_binary(filename, CATALOGUE_HEADER.pack(CATALOGUE_MAGIC, CATALOGUE_VERSION, *stamp, len(movie_ids),
+                                                  len(links['imdb']), len(links['tmdb']), len(titles),
+                                                  len(genre_names)),
+                  sections)
+    _catalogues.pop(filename, None)
+    return filename
+
+
+# Header of the binary ratings store: magic, version, size and mtime of the ratings.csv it was compiled from,
+# then the number of users, movies and ratings. The arrays that follow are in native byte order since the store
+# is a local cache of ratings.csv rather than an interchange format.
+STORE_MAGIC = b'MLRS'
+STORE_VERSION = 2
+STORE_HEADER = struct.Struct('=4sIqqqqq')
+
+# The delta log: new, changed and deleted ratings appended to a CSV file next to ratings.csv until compact_ratings
+# folds them into it. An empty rating deletes the user's rating of the movie.
+DELTA_LOG = 'ratings-delta.csv'
+DELTA_FIELDS = ['userId', 'movieId', 'rating', 'timestamp']
+
+# Loaded stores, keyed by the path of the binary file
+_rating_stores = {}
+
+
+class UserStats(NamedTuple):
+    """An entry of the per-user statistics table: the number of ratings, their sum and their sum of squares.
+    Ratings are multiples of 0.5, so the sums are exact in floating point and removing a rating is exact too."""
+    count: int
+    total: float
+    total_sq: float
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count
+
+    @property
+    def norm(self) -> float:
+        """The L2 norm of the user's rating vector"""
+        return sqrt(self.total_sq)
+
+    @property
+    def centered_ss(self) -> float:
+        """The sum of squares of the user's ratings about their mean"""
+        return self.total_sq - self.total * self.total / self.count if self.count else 0
+
+    def without(self, rating: float) -> 'UserStats':
+        """Return the statistics of the same ratings with one rating left out"""
+        return UserStats(self.count - 1, self.total - rating, self.total_sq - rating * rating)
+
+    def with_rating(self, rating: float) -> 'UserStats':
+        """Return the statistics of the same ratings with one more rating"""
+        return UserStats(self.count + 1, self.total + rating, self.total_sq + rating * rating)
+
+
+def user_statistics(user_ratings: Dict[str, float]) -> UserStats:
+    """Compute the statistics of a rating vector that isn't in the table"""
+    return UserStats(len(user_ratings), sum(rating for _, rating in user_ratings.items()),
+                     sum(rating * rating for _, rating in user_ratings.items()))
+
+
+class RatingStore:
+    """Memory-mapped view of a compiled ratings.csv stored both by user and by movie, with the delta log merged over
+    it in memory. Use user_row, movie_raters and user_stats rather than the arrays to see the merged ratings."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._mmap, header, section = _map_binary(filename, STORE_HEADER, STORE_MAGIC, STORE_VERSION)
+        self.source_size, self.source_mtime, n_users, n_movies, n_ratings = header
+        self.n_users = self.n_base_users = n_users
+        self.n_movies = self.n_base_movies = n_movies
+        self.n_ratings = n_ratings
+        self.user_ids = section('i', n_users)
+        self.movie_ids = section('i', n_movies)
+        self.user_offsets = section('q', n_users + 1)
+        self.user_movies = section('i', n_ratings)
+        self.user_ratings = section('f', n_ratings)
+        self.movie_offsets = section('q', n_movies + 1)
+        self.movie_users = section('i', n_ratings)
+        self.movie_ratings = section('f', n_ratings)
+        self.user_totals = section('d', n_users)
+        self.user_totals_sq = section('d', n_users)
+        # The rest of the code works with MovieLens IDs as strings
+        self.movie_keys = [str(mid) for mid in self.movie_ids]
+        self._movie_means = None
+        # The ratings merged from the delta log, and how much of which log file has been read
+        self.delta_rows = {}
+        self.delta_columns = {}
+        self.delta_stats = {}
+        self.changes = []
+        self._new_users = {}
+        self._new_movies = {}
+        self._delta_inode = None
+        self._delta_offset = 0
+
+    def is_current(self, source: str) -> bool:
+        """Whether the store was compiled from the given ratings.csv as it is now"""
+        stat = os.stat(source)
+        return stat.st_size == self.source_size and stat.st_mtime_ns == self.source_mtime
+
+    def user_index(self, user_id: str) -> Optional[int]:
+        """Return the dense index of a MovieLens user ID, or None if the user has no ratings"""
+        user_index = self._user_position(int(user_id))
+        return None if user_index is None or not self.user_stats(user_index).count else user_index
+
+    def movie_index(self, movie_id: str) -> Optional[int]:
+        """Return the dense index of a MovieLens movie ID, or None if nobody rated the movie"""
+        movie_index = self._movie_position(int(movie_id))
+        return None if movie_index is None or not len(self.movie_raters(movie_index)[0]) else movie_index
+
+    def user_row(self, user_index: int) -> (memoryview, memoryview):
+        """Return the indices of the movies the given user rated and their ratings"""
+        row = self.delta_rows.get(user_index)
+        if row is not None:
+            return row
+        start, end = self.user_offsets[user_index], self.user_offsets[user_index + 1]
+        return self.user_movies[start:end], self.user_ratings[start:end]
+
+    def user_vector(self, user_index: int) -> Dict[str, float]:
+        """Return a mapping from Movie IDs to ratings for the given user"""
+        keys = self.movie_keys
+        return {keys[m]: rating for m, rating in zip(*self.user_row(user_index))}
+
+    def user_stats(self, user_index: int) -> UserStats:
+        """Return the user's entry in the statistics table"""
+        stats = self.delta_stats.get(user_index)
+        if stats is not None:
+            return stats
+        return UserStats(self.user_offsets[user_index + 1] - self.user_offsets[user_index],
+                         self.user_totals[user_index], self.user_totals_sq[user_index])
+
+    def movie_means(self) -> List[float]:
+        """Return the average rating of every movie, computed the first time it is needed"""
+        if self._movie_means is None:
+            self._movie_means = [self._movie_mean(m) for m in range(self.n_movies)]
+        return self._movie_means
+
+    def _movie_mean(self, movie_index: int) -> float:
+        ratings = self.movie_raters(movie_index)[1]
+        return sum(ratings) / len(ratings) if len(ratings) else 0
+
+    def movie_raters(self, movie_index: int) -> (memoryview, memoryview):
+        """Return the indices of the users who rated the given movie and their ratings"""
+        column = self.delta_columns.get(movie_index)
+        if column is not None:
+            return column
+        start, end = self.movie_offsets[movie_index], self.movie_offsets[movie_index + 1]
+        return self.movie_users[start:end], self.movie_ratings[start:end]
+
+    def apply_deltas(self, log: str):
+        """Merge the ratings appended to the delta log since it was last read. A line that is still being written is
+        left for the next call, and a log that has been replaced (by compact_ratings) is read from the start."""
+        try:
+            stat = os.stat(log)
+        except FileNotFoundError:
+            return
+        if stat.st_ino != self._delta_inode:
+            self._delta_inode = stat.st_ino
+            self._delta_offset = 0
+        if stat.st_size <= self._delta_offset:
+            return
+        with open(log, 'rb') as file:
+            file.seek(self._delta_offset)
+            data = file.read(stat.st_size - self._delta_offset)
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b'\n'):
+                break
+            self._delta_offset += len(line)
+            change = _parse_delta_line(line, log)
+            if change is not None:
+                self.apply_rating(*change[:3])
+
+    def apply_rating(self, user_id: int, movie_id: int, rating: Optional[float]):
+        """Merge one rating over the store, replacing any earlier rating of the movie by the user. A rating of None
+        deletes it. The user's row, the movie's column and the user's statistics are copied with the change applied,
+        so a reader holding the previous ones still sees a consistent snapshot."""
+        u = self._user_position(user_id, create=rating is not None)
+        m = self._movie_position(movie_id, create=rating is not None)
+        if u is None or m is None:
+            return
+        movies, ratings = self.user_row(u)
+        i = bisect_left(movies, m)
+        old = ratings[i] if i < len(movies) and movies[i] == m else None
+        if old is None and rating is None:
+            return
+        self.delta_rows[u] = _splice(movies, ratings, i, m, old is not None, rating)
+        raters, ratings = self.movie_raters(m)
+        self.delta_columns[m] = _splice(raters, ratings, bisect_left(raters, u), u, old is not None, rating)
+        stats = self.user_stats(u)
+        if old is not None:
+            stats = stats.without(old)
+        if rating is not None:
+            stats = stats.with_rating(rating)
+        self.delta_stats[u] = stats
+        if self._movie_means is not None:
+            self._movie_means[m] = self._movie_mean(m)
+        self.changes.append((u, m))
+
+    def _user_position(self, user_id: int, create: bool = False) -> Optional[int]:
+        """Return the index of a MovieLens user ID even if all of their ratings were deleted, optionally giving an
+        unknown user the next free index"""
+        user_index = self._new_users.get(user_id)
+        if user_index is None:
+            user_index = _find(self.user_ids, user_id)
+        if user_index is None and create:
+            user_index = self._new_users[user_id] = self.n_users
+            self.n_users += 1
+            self.delta_rows[user_index] = (array('i'), array('f'))
+            self.delta_stats[user_index] = UserStats(0, 0.0, 0.0)
+        return user_index
+
+    def _movie_position(self, movie_id: int, create: bool = False) -> Optional[int]:
+        """_user_position for movies"""
+        movie_index = self._new_movies.get(movie_id)
+        if movie_index is None:
+            movie_index = _find(self.movie_ids, movie_id)
+        if movie_index is None and create:
+            movie_index = self._new_movies[movie_id] = self.n_movies
+            self.n_movies += 1
+            self.movie_keys.append(str(movie_id))
+            self.delta_columns[movie_index] = (array('i'), array('f'))
+            if self._movie_means is not None:
+                self._movie_means.append(0)
+        return movie_index
+
+
+def _splice(keys: memoryview, values: memoryview, i: int, key: int, present: bool,
+            value: Optional[float]) -> (array, array):
+    """Return copies of a sorted row of indices and its ratings with the rating at position i set to value, inserted
+    if it isn't present or removed if value is None"""
+    keys = array('i', bytes(keys))
+    values = array('f', bytes(values))
+    if not present:
+        keys.insert(i, key)
+        values.insert(i, value)
+    elif value is None:
+        del keys[i]
+        del values[i]
+    else:
+        values[i] = value
+    return keys, values
+
+
+def load_rating_store(full: bool) -> RatingStore:
+    """Return the memory-mapped ratings store for the dataset, compiling it first if it is missing or if ratings.csv
+    has changed since it was compiled, with everything appended to the delta log so far merged over it"""
+    source = dataset_file('ratings.csv', full)
+    filename = dataset_file('ratings.bin', full)
+    store = _rating_stores.get(filename)
+    if store is None or not store.is_current(source):
+        try:
+            store = RatingStore(filename)
+        except (OSError, ValueError, struct.error):
+            store = None
+        if store is None or not store.is_current(source):
+            store = RatingStore(compile_rating_store(full))
+        _rating_stores[filename] = store
+    store.apply_deltas(dataset_file(DELTA_LOG, full))
+    return store
+
+
+def _parse_delta_line(line: bytes, log: str) -> Optional[Tuple[int, int, Optional[float], int]]:
+    """Parse a line of the delta log into a (user ID, movie ID, rating, timestamp) tuple. The header and malformed
+    lines give None, the latter with a warning on standard error."""
+    try:
+        row = next(csv.reader([line.decode('utf8')]))
+        if row == DELTA_FIELDS:
+            return None
+        uid, mid, rating, timestamp = row
+        rating = float(rating) if rating else None
+        if rating is not None and not 0.5 <= rating <= 5:
+            raise ValueError(rating)
+        return int(uid), int(mid), rating, int(timestamp)
+    except (ValueError, StopIteration):
+        print("Skipping malformed line of {}: {!r}".format(log, line), file=sys.stderr)
+        return None
+
+
+def append_ratings(full: bool, ratings: List[Tuple[int, int, Optional[float]]]):
+    """Append (user ID, movie ID, rating) triples to the delta log, where a rating of None deletes the user's rating
+    of the movie. They are merged over the ratings store the next time it is loaded, in this or any other process.
+    Raises ValueError, before anything is written, if any ID or rating is invalid."""
+    timestamp = int(time.time())
+    lines = []
+    for uid, mid, rating in ratings:
+        ids = []
+        for value in (uid, mid):
+            try:
+                ids.append(int(value))
+            except (ValueError, TypeError):
+                ids.append(0)
+            if ids[-1] < 1:
+                raise ValueError("user and movie IDs are positive integers, not {}".format(value))
+        if rating is not None:
+            try:
+                value = float(rating)
+            except (ValueError, TypeError):
+                value = None
+            if value is None or not (0.5 <= value <= 5 and (value * 2).is_integer()):
+                raise ValueError("ratings are multiples of 0.5 from 0.5 to 5, not {}".format(rating))
+            rating = value
+        lines.append((ids[0], ids[1], '' if rating is None else rating, timestamp))
+    with open(dataset_file(DELTA_LOG, full), 'a', encoding="utf8") as file:
+        if file.tell() == 0:
+            lines.insert(0, DELTA_FIELDS)
+        file.write(''.join('{},{},{},{}\n'.format(*line) for line in lines))
+
+
+def compact_ratings(full: bool) -> str:
+    """Fold the delta log into ratings.csv, keeping it sorted by user and by movie within each user, and recompile
+    the store. Returns the path of ratings.csv.
+
+    The log is first renamed out of the way so that ratings appended while compacting start a new log, which is
+    merged over the new store. The precomputed neighbour indices and item-item similarity matrices are built from
+    the old ratings.csv, so they have to be rebuilt afterwards."""
+    source = dataset_file('ratings.csv', full)
+    log = dataset_file(DELTA_LOG, full)
+    compacting = log + '.compacting'
+    if os.path.exists(log):
+        if os.path.exists(compacting):
+            # an earlier compaction was interrupted, so fold both logs in
+            with open(compacting, 'ab') as file, open(log, 'rb') as rest:
+                file.write(rest.read())
+            os.remove(log)
+        else:
+            os.replace(log, compacting)
+    if not os.path.exists(compacting):
+        return source
+    deltas = {}
+    with open(compacting, 'rb') as file:
+        for line in file:
+            change = _parse_delta_line(line, compacting)
+            if change is not None:
+                uid, mid, rating, timestamp = change
+                deltas.setdefault(uid, {})[str(mid)] = ('' if rating is None else rating, timestamp)
+    pending = sorted(deltas, reverse=True)
+    temporary = source + '.tmp'
+    with open(source, encoding="utf8") as file, open(temporary, 'w', encoding="utf8", newline='') as out:
+        reader = csv.reader(file)
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(next(reader))
+
+        def write_user(uid, rows):
+            # users who only have ratings in the log come before this one
+            while pending and pending[-1] < uid:
+                new_uid = pending.pop()
+                write_user(new_uid, {})
+            if pending and pending[-1] == uid:
+                pending.pop()
+            rows.update(deltas.get(uid, {}))
+            for mid in sorted(rows, key=int):
+                rating, timestamp = rows[mid]
+                if rating:
+                    writer.writerow((uid, mid, rating, timestamp))
+
+        current, rows = None, {}
+        for uid, mid, rating, timestamp in reader:
+            uid = int(uid)
+            if uid != current:
+                if current is not None:
+                    write_user(current, rows)
+                current, rows = uid, {}
+            rows[mid] = (rating, timestamp)
+        if current is not None:
+            write_user(current, rows)
+        while pending:
+            write_user(pending[-1], {})
+    os.replace(temporary, source)
+    os.remove(compacting)
+    compile_rating_store(full)
+    return source
+
+
+def compile_rating_store(full: bool) -> str:
+    """Parse ratings.csv once and write it out as a binary ratings store next to it. Returns the store's path."""
+    source = dataset_file('ratings.csv', full)
+    filename = dataset_file('ratings.bin', full)
+    stat = os.stat(source)
+    user_ids = array('i')
+    user_offsets = array('q', [0])
+    raw_movies = array('i')
+    ratings = array('f')
+    with open(source, encoding="utf8") as file:
         reader = csv.reader(file)
-        # skip header
         next(reader)
-        # List of movie ratings for relevant users (ones who have rated any given movie id)
-        all_other_user_ratings = []
-        # Running list of the current user id ratings
-        user_ratings = {}
-        current_uid = 0
-        insert = False
         for uid, mid, rating, _ in reader:
-            if current_uid != uid:
-                if user_id == current_uid:
-                    our_user_ratings = user_ratings
-                elif insert:
-                    all_other_user_ratings.append(user_ratings)
-                current_uid = uid
-                user_ratings = {}
-                insert = False
-            if mid in movie_ids:
-                insert = True
-            user_ratings[mid] = float(rating)
-        # Required for last user in CSV
-        if user_id == current_uid:
-            our_user_ratings = user_ratings
-        elif insert:
-            all_other_user_ratings.append(user_ratings)
-    return our_user_ratings, all_other_user_ratings
+            uid = int(uid)
+            if not user_ids or user_ids[-1] != uid:
+                if user_ids and uid < user_ids[-1]:
+                    raise ValueError("{} is not sorted by userId".format(source))
+                if user_ids:
+                    user_offsets.append(len(raw_movies))
+                user_ids.append(uid)
+            raw_movies.append(int(mid))
+            ratings.append(float(rating))
+    if user_ids:
+        user_offsets.append(len(raw_movies))
+    n_ratings = len(raw_movies)
+
+    # Renumber the movies densely, and sort each user's row by movie index
+    movie_ids = array('i', sorted(set(raw_movies)))
+    index = {mid: i for i, mid in enumerate(movie_ids)}
+    user_movies = array('i', bytes(4 * n_ratings))
+    user_ratings = array('f', bytes(4 * n_ratings))
+    for u in range(len(user_ids)):
+        start, end = user_offsets[u], user_offsets[u + 1]
+        row = sorted(zip((index[mid] for mid in raw_movies[start:end]), ratings[start:end]))
+        user_movies[start:end] = array('i', (m for m, _ in row))
+        user_ratings[start:end] = array('f', (rating for _, rating in row))
+    del raw_movies, ratings, index
+
+    # The user statistics table
+    user_totals = array('d', bytes(8 * len(user_ids)))
+    user_totals_sq = array('d', bytes(8 * len(user_ids)))
+    for u in range(len(user_ids)):
+        for i in range(user_offsets[u], user_offsets[u + 1]):
+            user_totals[u] += user_ratings[i]
+            user_totals_sq[u] += user_ratings[i] * user_ratings[i]
+
+    # Transpose into the by-movie layout with a counting sort. Users are visited in order so every column is sorted.
+    movie_offsets = array('q', bytes(8 * (len(movie_ids) + 1)))
+    for m in user_movies:
+        movie_offsets[m + 1] += 1
+    for m in range(len(movie_ids)):
+        movie_offsets[m + 1] += movie_offsets[m]
+    cursor = array('q', movie_offsets)
+    movie_users = array('i', bytes(4 * n_ratings))
+    movie_ratings = array('f', bytes(4 * n_ratings))
+    for u in range(len(user_ids)):
+        for i in range(user_offsets[u], user_offsets[u + 1]):
+            m = user_movies[i]
+            movie_users[cursor[m]] = u
+            movie_ratings[cursor[m]] = user_ratings[i]
+            cursor[m] += 1
+
+    _write_binary(filename, STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, stat.st_size, stat.st_mtime_ns,
+                                              len(user_ids), len(movie_ids), n_ratings),
+                  (user_ids, movie_ids, user_offsets, user_movies, user_ratings,
+                   movie_offsets, movie_users, movie_ratings, user_totals, user_totals_sq))
+    return filename
+
+
+# Measures a neighbour index can be built for. A euclidean distance d is kept as the similarity 1 / (1 + d), so the
+# nearest neighbours weigh the most and one at distance 0 weighs 1 rather than nothing.
+NEIGHBOUR_MEASURES = ('pearson', 'cosine', 'euclidean')
+
+# Header of a neighbour index: magic, version, size and mtime of the ratings.csv its store was compiled from,
+# then the number of users, k and the minimum number of co-rated movies it was built with. It is followed by
+# n_users * k neighbour indices (-1 where a user has fewer than k neighbours) and their similarities, nearest first.
+INDEX_MAGIC = b'MLNI'
+INDEX_VERSION = 2
+INDEX_HEADER = struct.Struct('=4sIqqqqq')
+
+# Loaded neighbour indices, keyed by the path of the index file
+_neighbour_indices = {}
+
+
+class NeighbourIndex:
+    """Memory-mapped top-k neighbour lists for every user of a RatingStore under one measure.
+
+    The file is never written to. update() recomputes the lists of the users with new ratings in the delta log and
+    keeps them in memory; the other users' lists are left as they were built until the index is rebuilt."""
+
+    def __init__(self, filename: str, measure: str):
+        self._mmap, header, section = _map_binary(filename, INDEX_HEADER, INDEX_MAGIC, INDEX_VERSION)
+        self.source_size, self.source_mtime, self.n_users, self.k, self.min_common = header
+        self.measure = measure
+        self.neighbours = section('i', self.n_users * self.k)
+        self.weights = section('f', self.n_users * self.k)
+        self.updated = {}
+        self._applied = 0
+
+    def is_current(self, store: RatingStore) -> bool:
+        """Whether the index was built from the given store's ratings.csv"""
+        return (self.source_size, self.source_mtime) == (store.source_size, store.source_mtime)
+
+    def update(self, store: RatingStore):
+        """Recompute the neighbours of the users who rated, re-rated or deleted a rating since the last update"""
+        changes = store.changes[self._applied:]
+        self._applied += len(changes)
+        for u in {u for u, _ in changes}:
+            neighbours, weights = [], []
+            if store.user_stats(u).count:
+                res = nearest_neighbours(store, u, self.k, self.min_common, [self.measure])
+                neighbours, weights = res[self.measure]
+            self.updated[u] = (array('i', neighbours), array('f', weights))
+
+    def user_neighbours(self, user_index: int) -> (memoryview, memoryview):
+        """Return the indices of the user's nearest neighbours and their similarities, nearest first"""
+        if user_index in self.updated:
+            return self.updated[user_index]
+        if user_index >= self.n_users:
+            return array('i'), array('f')
+        start = user_index * self.k
+        end = start + self.k
+        neighbours = self.neighbours[start:end]
+        try:
+            end = start + neighbours.tolist().index(-1)
+        except ValueError:
+            pass
+        return self.neighbours[start:end], self.weights[start:end]
+
+
+def neighbour_index_file(measure: str, full: bool) -> str:
+    """Return the path of the neighbour index for a measure"""
+    return dataset_file('neighbours-{}.bin'.format(measure), full)
+
+
+def load_neighbour_index(measure: str, full: bool) -> NeighbourIndex:
+    """Return the neighbour index for a measure. Raises ValueError if it hasn't been built for the current ratings."""
+    if np is None:
+        raise ValueError("the neighbour index requires numpy to be installed")
+    filename = neighbour_index_file(measure, full)
+    store = load_rating_store(full)
+    index = _neighbour_indices.get(filename)
+    if index is None or not index.is_current(store):
+        try:
+            index = NeighbourIndex(filename, measure)
+        except (OSError, ValueError, struct.error):
+            index = None
+        if index is None or not index.is_current(store):
+            raise ValueError("no current {} neighbour index for the dataset, build it with --build-neighbours"
+                             .format(measure))
+        _neighbour_indices[filename] = index
+    index.update(store)
+    return index
+
+
+def nearest_neighbours(store: RatingStore, user_index: int, k: int, min_common: int, measures: List[str],
+                       held_out: int = None, backend: str = 'numpy') -> Dict[str, Tuple[List[int], List[float]]]:
+    """Find the k nearest neighbours of a user under each measure among the users who rated at least
+    min_common of the same movies, returning their indices and similarities, nearest first. Euclidean distances are
+    turned into similarities as in NEIGHBOUR_MEASURES. The user's rating of the movie index held_out is left out.
+
+    Only the co-rated movies contribute to the sums, so they are gathered from the columns of the user's movies
+    rather than from the rows of every co-rater, with the given backend."""
+    our_movies, our_ratings = store.user_row(user_index)
+    our_stats = store.user_stats(user_index)
+    if held_out is not None:
+        pairs = [(m, rating) for m, rating in zip(our_movies, our_ratings) if m != held_out]
+        if len(pairs) < len(our_movies):
+            our_stats = our_stats.without(our_ratings[bisect_left(our_movies, held_out)])
+        our_movies, our_ratings = [m for m, _ in pairs], [rating for _, rating in pairs]
+    our_mean = our_stats.mean if our_stats.count else 0
+    if backend == 'numpy':
+        return _nearest_neighbours_vectorized(store, user_index, k, min_common, measures, our_movies, our_ratings,
+                                              our_stats)
+    # the number of co-rated movies and the sums over them for every user, in flat arrays indexed by user
+    n_users = store.n_users
+    common = array('i', bytes(4 * n_users))
+    dots, centered_dots, centered_sums, square_distances = (array('d', bytes(8 * n_users)) for _ in range(4))
+    for m, our_rating in zip(our_movies, our_ratings):
+        our_centered = our_rating - our_mean
+        for v, their_rating in zip(*store.movie_raters(m)):
+            common[v] += 1
+            dots[v] += our_rating * their_rating
+            centered_dots[v] += our_centered * their_rating
+            centered_sums[v] += our_centered
+            square_distances[v] += (our_rating - their_rating) ** 2
+    common[user_index] = 0
+    candidates = [v for v in range(n_users) if common[v] >= max(min_common, 1)]
+    stats = [store.user_stats(v) for v in candidates]
+    res = {}
+    for measure in measures:
+        if measure == 'pearson':
+            # the sum of our centered ratings times their centered ratings, with their mean factored out
+            weights = [(centered_dots[v] - their_stats.mean * centered_sums[v]) / sqrt(denom) if denom else 0
+                       for v, their_stats, denom in zip(candidates, stats,
+                                                        (our_stats.centered_ss * s.centered_ss for s in stats))]
+        elif measure == 'cosine':
+            weights = [dots[v] / (our_stats.norm * their_stats.norm) for v, their_stats in zip(candidates, stats)]
+        else:
+            weights = [1 / (1 + sqrt(square_distances[v])) for v in candidates]
+        order = sorted(range(len(candidates)), key=weights.__getitem__, reverse=True)[:k]
+        res[measure] = ([candidates[i] for i in order], [weights[i] for i in order])
+    return res
+
+
+def _nearest_neighbours_vectorized(store: RatingStore, user_index: int, k: int, min_common: int, measures: List[str],
+                                   our_movies: List[int], our_ratings: List[float],
+                                   our_stats: UserStats) -> Dict[str, Tuple[List[int], List[float]]]:
+    """The numpy backend of nearest_neighbours, which gives the same similarities as vectorized_similarities"""
+    ours = np.asarray(our_ratings, dtype=np.float64)
+    row, users, vals, _ = gather_movie_columns(store, np.asarray(our_movies, dtype=np.int64))
+    common = np.bincount(users, minlength=store.n_users)
+    common[user_index] = 0
+    candidate = common >= max(min_common, 1)
+    candidates = np.flatnonzero(candidate)
+    # each entry of a candidate's co-rated movies, by the candidate's position in candidates
+    kept = candidate[users]
+    position = np.cumsum(candidate) - 1
+    at, our_vals, vals = position[users[kept]], ours[row[kept]], vals[kept]
+    totals, totals_sq = gather_user_totals(store, candidates)
+    lengths = gather_user_counts(store, candidates)
+    res = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for measure in measures:
+            if measure == 'pearson':
+                means = totals / lengths
+                numer = np.bincount(at, weights=(our_vals - our_stats.mean) * (vals - means[at]),
+                                    minlength=len(candidates))
+                denom = our_stats.centered_ss * (totals_sq - totals * totals / lengths)
+                weights = np.where(denom == 0, 0, numer / np.sqrt(denom))
+            elif measure == 'cosine':
+                numer = np.bincount(at, weights=our_vals * vals, minlength=len(candidates))
+                weights = numer / (our_stats.norm * np.sqrt(totals_sq))
+            else:
+                weights = 1 / (1 + np.sqrt(np.bincount(at, weights=(our_vals - vals) ** 2,
+                                                       minlength=len(candidates))))
+            order = np.argsort(-weights, kind='stable')[:k]
+            res[measure] = (candidates[order].tolist(), weights[order].tolist())
+    return res
+
+
+def _nearest_neighbours_for_users(task: Tuple[bool, int, int, int, int, List[str]]) -> (int, int, Dict[str, Tuple[array, array]]):
+    """Worker for build_neighbour_indices: find the neighbours of a contiguous range of users"""
+    full, start, end, k, min_common, measures = task
+    store = load_rating_store(full)
+    res = {measure: (array('i', [-1]) * (k * (end - start)), array('f', bytes(4 * k * (end - start))))
+           for measure in measures}
+    for u in range(start, end):
+        for measure, (neighbours, weights) in nearest_neighbours(store, u, k, min_common, measures).items():
+            offset = (u - start) * k
+            res[measure][0][offset:offset + len(neighbours)] = array('i', neighbours)
+            res[measure][1][offset:offset + len(weights)] = array('f', weights)
+    return start, end, res
+
+
+def build_neighbour_indices(full: bool, k: int, min_common: int, measures: List[str] = None,
+                            workers: int = None, chunk_size: int = 64) -> List[str]:
+    """Precompute the top-k neighbours of every user under each measure across a pool of worker processes,
+    reporting progress and throughput on stderr, and write one index per measure. Returns their paths."""
+    if np is None:
+        raise ValueError("the neighbour index requires numpy to be installed")
+    measures = measures or list(NEIGHBOUR_MEASURES)
+    store = load_rating_store(full)
+    n = store.n_users
+    neighbours = {measure: array('i', [-1]) * (n * k) for measure in measures}
+    weights = {measure: array('f', bytes(4 * n * k)) for measure in measures}
+    for start, res in _run_chunked(_nearest_neighbours_for_users, full, n, 'users', workers, chunk_size,
+                                   k, min_common, measures):
+        for measure, (chunk_neighbours, chunk_weights) in res.items():
+            neighbours[measure][start * k:start * k + len(chunk_neighbours)] = chunk_neighbours
+            weights[measure][start * k:start * k + len(chunk_weights)] = chunk_weights
+    filenames = []
+    for measure in measures:
+        filename = neighbour_index_file(measure, full)
+        _write_binary(filename, INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, store.source_size, store.source_mtime,
+                                                  n, k, min_common),
+                      (neighbours[measure], weights[measure]))
+        _neighbour_indices.pop(filename, None)
+        filenames.append(filename)
+    return filenames
+
+
+def _run_chunked(worker: callable, full: bool, n: int, unit: str, workers: int, chunk_size: int, *args, pool=None):
+    """Split range(n) into chunks and run worker((full, start, end) + args) over them in a pool of worker processes,
+    reporting progress and throughput on stderr. Yields the start of each chunk and its result as chunks finish.
+    The workers map the same store file, so the ratings are shared rather than copied into each process. A caller
+    running several passes can keep its own pool and pass it in, so the processes and their mapped store are reused."""
+    tasks = [(full, start, min(start + chunk_size, n)) + args for start in range(0, n, chunk_size)]
+    began = time.perf_counter()
+    done = 0
+    with nullcontext(pool) if pool is not None else Pool(workers) as pool:
+        for start, end, res in pool.imap_unordered(worker, tasks):
+            done += end - start
+            elapsed = time.perf_counter() - began
+            print("\r{}/{} {}, {:.0f} {}/s".format(done, n, unit, done / elapsed, unit), end='', file=sys.stderr)
+            yield start, res
+    print(file=sys.stderr)
+
+
+def get_ratings_from_index(store: RatingStore, index: NeighbourIndex, user_id: str,
+                           movie_ids: List[str]) -> Dict[str, float]:
+    """get_ratings using only the user's precomputed nearest neighbours: for each movie, look up the rating each
+    neighbour gave it (if any) and take the weighted sum"""
+    our_index = store.user_index(user_id)
+    if our_index is None:
+        raise ValueError("user {} has no ratings in the dataset".format(user_id))
+    return get_ratings_from_neighbours(store, our_index, index.user_neighbours(our_index), movie_ids)
+
+
+def get_ratings_from_neighbours(store: RatingStore, our_index: int, neighbours: (List[int], List[float]),
+                                movie_ids: List[str]) -> Dict[str, float]:
+    """The work behind get_ratings_from_index given the user's neighbours and their similarities"""
+    our_avg = store.user_stats(our_index).mean
+    neighbours = [(v, weight, store.user_stats(v).mean) for v, weight in zip(*neighbours)]
+    predictions = {}
+    for mid in movie_ids:
+        m = store.movie_index(mid)
+        if m is None:
+            continue
+        numer = 0
+        denom = 0
+        for v, weight, other_avg in neighbours:
+            movies, ratings = store.user_row(v)
+            i = bisect_left(movies, m)
+            if i < len(movies) and movies[i] == m:
+                numer += (ratings[i] - other_avg) * weight
+                denom += abs(weight)
+        if denom != 0:
+            predictions[mid] = our_avg + (numer / denom)
+    return predictions
+
+
+# Measures the approximate (LSH) neighbour index can be built for. Pearson correlation is the cosine similarity of
+# mean-centered vectors, so both are hashed with signed random projections, of the raw ratings for cosine and of the
+# ratings centered on each user's mean for pearson.
+LSH_MEASURES = ('cosine', 'pearson')
+
+# The number of hash tables of an LSH index, and the number of users per bucket its number of bits per hash is
+# chosen for when it isn't given
+LSH_TABLES = 8
+LSH_BUCKET_SIZE = 64
+
+# Header of an LSH index: magic, version, size and mtime of the ratings.csv its store was compiled from, then the
+# number of users and movies, the number of tables and the number of bits per hash. It is followed by the random
+# hyperplanes (n_movies rows of n_tables * n_bits components), the signature of every user in every table (n_users
+# rows of n_tables), and for each table the signatures in sorted order and the users they belong to, so a bucket is
+# a contiguous run found by binary search.
+LSH_MAGIC = b'MLLH'
+LSH_VERSION = 1
+LSH_HEADER = struct.Struct('=4sIqqqqqq')
+
+# Loaded LSH indices, keyed by the path of the index file
+_lsh_indices = {}
+
+
+class LshIndex:
+    """Memory-mapped locality-sensitive hash tables of every user of a RatingStore under cosine or pearson, one bit per
+    random hyperplane. user_neighbours re-ranks the candidates from the user's buckets exactly, and update() rehashes
+    the users with ratings in the delta log in memory."""
+
+    def __init__(self, filename: str, measure: str):
+        self._mmap, header, section = _map_binary(filename, LSH_HEADER, LSH_MAGIC, LSH_VERSION)
+        self.source_size, self.source_mtime, self.n_users, self.n_movies, self.n_tables, self.n_bits = header
+        self.measure = measure
+        self.planes = section('f', self.n_movies * self.n_tables * self.n_bits)
+        self.signatures = section('q', self.n_users * self.n_tables)
+        self.bucket_signatures = section('q', self.n_tables * self.n_users)
+        self.bucket_users = section('i', self.n_tables * self.n_users)
+        self.updated = {}
+        self._applied = 0
+
+    def is_current(self, store: RatingStore, tables: int, bits: int) -> bool:
+        """Whether the index was built from the given store's ratings.csv with the given parameters"""
+        return (self.source_size, self.source_mtime, self.n_tables, self.n_bits) == \
+            (store.source_size, store.source_mtime, tables, bits)
+
+    def update(self, store: RatingStore):
+        """Rehash the users who rated, re-rated or deleted a rating since the last update"""
+        changes = store.changes[self._applied:]
+        self._applied += len(changes)
+        for u in {u for u, _ in changes}:
+            # a user without ratings hashes to zero in every table, as build_lsh_index hashes them
+            signatures = [0] * self.n_tables
+            if store.user_stats(u).count:
+                signatures = lsh_signatures(store, u, self.planes, self.n_movies, self.n_tables, self.n_bits,
+                                            self.measure == 'pearson')
+            self.updated[u] = signatures
+
+    def user_signatures(self, user_index: int) -> List[int]:
+        """Return the user's signature in every table"""
+        if user_index in self.updated:
+            return self.updated[user_index]
+        return self.signatures[user_index * self.n_tables:(user_index + 1) * self.n_tables].tolist()
+
+    def candidates(self, user_index: int, signatures: List[int] = None) -> List[int]:
+        """Return the sorted indices of the other users who share a bucket with the user in any table, under the
+        given signatures rather than the user's own if any"""
+        n = self.n_users
+        buckets = []
+        res = set()
+        if signatures is None:
+            signatures = self.user_signatures(user_index)
+        for t, signature in enumerate(signatures):
+            start = bisect_left(self.bucket_signatures, signature, t * n, (t + 1) * n)
+            buckets.append(self.bucket_users[start:bisect_right(self.bucket_signatures, signature, start, (t + 1) * n)])
+            res.update(v for v, signatures in self.updated.items() if signatures[t] == signature)
+        # rehashed users are only found under their new signatures
+        found = np.unique(np.concatenate([np.frombuffer(bucket, dtype=np.int32) for bucket in buckets]))
+        res.update(found[~_in_delta(found, self.updated)].tolist())
+        res.discard(user_index)
+        return sorted(res)
+
+    def user_neighbours(self, store: RatingStore, user_index: int, k: int, min_common: int,
+                        held_out: int = None) -> (List[int], List[float]):
+        """Return the k nearest of the user's candidates who rated at least min_common of the same movies and their
+        similarities, nearest first, re-ranked exactly with vectorized_similarities. The user's rating of the movie
+        index held_out is left out of both the hash and the ranking."""
+        our_user_ratings = store.user_vector(user_index)
+        our_stats = store.user_stats(user_index)
+        signatures = None
+        if held_out is not None:
+            our_stats = our_stats.without(our_user_ratings.pop(store.movie_keys[held_out]))
+            signatures = lsh_signatures(store, user_index, self.planes, self.n_movies, self.n_tables, self.n_bits,
+                                        self.measure == 'pearson', held_out)
+        candidates = np.asarray(self.candidates(user_index, signatures), dtype=np.int64)
+        row, cols, _, _ = gather_user_rows(store, candidates)
+        rated = np.zeros(store.n_movies, dtype=bool)
+        rated[np.frombuffer(store.user_row(user_index)[0], dtype=np.int32)] = True
+        if held_out is not None:
+            rated[held_out] = False
+        common = np.bincount(row, weights=rated[cols], minlength=len(candidates))
+        candidates = candidates[common >= max(min_common, 1)]
+        weights, _ = vectorized_similarities(store, our_user_ratings, our_stats.mean, candidates, self.measure,
+                                             our_stats)
+        order = np.argsort(-weights, kind='stable')[:k]
+        return candidates[order].tolist(), weights[order].tolist()
+
+
+def lsh_signatures(store: RatingStore, user_index: int, planes: memoryview, n_movies: int, n_tables: int,
+                   n_bits: int, centered: bool, held_out: int = None) -> List[int]:
+    """Hash one user's ratings (centered on their mean if "centered") against the hyperplanes of an LSH index,
+    returning their signature in every table. Movies that are newer than the hyperplanes, and the movie index
+    held_out, are left out."""
+    width = n_tables * n_bits
+    movies, ratings = store.user_row(user_index)
+    stats = store.user_stats(user_index)
+    if held_out is not None:
+        stats = stats.without(ratings[list(movies).index(held_out)])
+    mean = stats.mean if centered else 0
+    movies = np.asarray(movies, dtype=np.int64)
+    kept = (movies < n_movies) & (movies != (-1 if held_out is None else held_out))
+    values = np.asarray(ratings, dtype=np.float64)[kept] - mean
+    projections = (values @ np.frombuffer(planes, dtype=np.float32).reshape(n_movies, width)[movies[kept]]).tolist()
+    return [sum(1 << b for b in range(n_bits) if projections[t * n_bits + b] > 0) for t in range(n_tables)]
+
+
+def lsh_index_file(measure: str, full: bool) -> str:
+    """Return the path of the LSH index for a measure"""
+    return dataset_file('lsh-{}.bin'.format(measure), full)
+
+
+def load_lsh_index(measure: str, full: bool, tables: int = LSH_TABLES, bits: int = None) -> LshIndex:
+    """Return the LSH index for a measure, building it first if it is missing, was built from different ratings or
+    with different parameters. By default each hash has enough bits for about LSH_BUCKET_SIZE users per bucket."""
+    if np is None:
+        raise ValueError("the LSH index requires numpy to be installed")
+    filename = lsh_index_file(measure, full)
+    store = load_rating_store(full)
+    if bits is None:
+        bits = min(max(int(log(max(store.n_users, 1) / LSH_BUCKET_SIZE, 2)), 1), 62)
+    index = _lsh_indices.get(filename)
+    if index is None or not index.is_current(store, tables, bits):
+        try:
+            index = LshIndex(filename, measure)
+        except (OSError, ValueError, struct.error):
+            index = None
+        if index is None or not index.is_current(store, tables, bits):
+            index = LshIndex(build_lsh_index(measure, full, tables, bits), measure)
+        _lsh_indices[filename] = index
+    index.update(store)
+    return index
+
+
+def build_lsh_index(measure: str, full: bool, tables: int, bits: int, seed: int = 0, chunk_size: int = 256) -> str:
+    """Draw tables * bits random Gaussian hyperplanes over the movies, hash every user against them and write the
+    index next to ratings.csv. Returns its path."""
+    if np is None:
+        raise ValueError("the LSH index requires numpy to be installed")
+    store = load_rating_store(full)
+    n_users, n_movies = store.n_users, store.n_movies
+    width = tables * bits
+    centered = measure == 'pearson'
+    planes = np.random.default_rng(seed).standard_normal((n_movies, width), dtype=np.float32)
+    signatures = np.zeros((n_users, tables), dtype=np.int64)
+    powers = np.int64(1) << np.arange(bits, dtype=np.int64)
+    for start in range(0, n_users, chunk_size):
+        users = np.arange(start, min(start + chunk_size, n_users), dtype=np.int64)
+        row, cols, vals, lengths = gather_user_rows(store, users)
+        if centered:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                vals = vals - (gather_user_totals(store, users)[0] / lengths)[row]
+        # the projections of each user's row are the sums of its movies' hyperplane components
+        contributions = planes[cols] * vals[:, None]
+        projections = np.zeros((len(users), width))
+        rated = lengths > 0
+        projections[rated] = np.add.reduceat(contributions, (np.cumsum(lengths) - lengths)[rated], axis=0)
+        signatures[start:start + len(users)] = ((projections > 0).reshape(-1, tables, bits) * powers).sum(axis=2)
+    planes = array('f', planes.tobytes())
+    order = np.argsort(signatures, axis=0, kind='stable').T
+    bucket_signatures = array('q', np.take_along_axis(signatures.T, order, axis=1).tobytes())
+    bucket_users = array('i', order.astype(np.int32).tobytes())
+    signatures = array('q', signatures.tobytes())
+    filename = lsh_index_file(measure, full)
+    _write_binary(filename, LSH_HEADER.pack(LSH_MAGIC, LSH_VERSION, store.source_size, store.source_mtime,
+                                            n_users, n_movies, tables, bits),
+                  (planes, signatures, bucket_signatures, bucket_users))
+    _lsh_indices.pop(filename, None)
+    return filename
+
+
+# Measures the item-item similarity matrix can be built with
+ITEM_MEASURES = ('adjusted_cosine', 'pearson')
+
+# Header of an item-item similarity matrix: magic, version, size and mtime of the ratings.csv its store was compiled
+# from, then the number of movies, the number of neighbours kept per movie and the minimum number of users who must
+# have rated both movies. It is followed by a CSR matrix: n_movies + 1 offsets, then the neighbouring movie indices
+# and similarities of each movie, most similar first.
+ITEMS_MAGIC = b'MLIS'
+ITEMS_VERSION = 1
+ITEMS_HEADER = struct.Struct('=4sIqqqqq')
+
+# Loaded item-item similarity matrices, keyed by the path of the matrix file
+_item_similarities = {}
+
+
+class ItemSimilarities:
+    """Memory-mapped sparse item-item similarity matrix keeping the top neighbours of every movie.
+
+    As with NeighbourIndex, update() recomputes the rows of the movies with new ratings in the delta log in memory."""
+
+    def __init__(self, filename: str, measure: str):
+        self._mmap, header, section = _map_binary(filename, ITEMS_HEADER, ITEMS_MAGIC, ITEMS_VERSION)
+        self.source_size, self.source_mtime, self.n_movies, self.k, self.min_common = header
+        self.measure = measure
+        self.offsets = section('q', self.n_movies + 1)
+        n_entries = self.offsets[self.n_movies]
+        self.neighbours = section('i', n_entries)
+        self.weights = section('f', n_entries)
+        self.updated = {}
+        self._applied = 0
+
+    def is_current(self, store: RatingStore, k: int, min_common: int) -> bool:
+        """Whether the matrix was built from the given store's ratings.csv with the given parameters"""
+        return (self.source_size, self.source_mtime, self.k, self.min_common) == \
+            (store.source_size, store.source_mtime, k, min_common)
+
+    def update(self, store: RatingStore):
+        """Recompute the most similar movies to the movies rated, re-rated or unrated since the last update"""
+        changes = store.changes[self._applied:]
+        self._applied += len(changes)
+        item_means = store.movie_means() if self.measure == 'pearson' and changes else None
+        for m in {m for _, m in changes}:
+            neighbours, weights = similar_items(store, m, self.k, self.min_common, self.measure, item_means)
+            self.updated[m] = (array('i', neighbours), array('f', weights))
+
+    def movie_neighbours(self, movie_index: int) -> (memoryview, memoryview):
+        """Return the indices of the movies most similar to the given movie and their similarities"""
+        if movie_index in self.updated:
+            return self.updated[movie_index]
+        if movie_index >= self.n_movies:
+            return array('i'), array('f')
+        start, end = self.offsets[movie_index], self.offsets[movie_index + 1]
+        return self.neighbours[start:end], self.weights[start:end]
+
+
+def load_item_similarities(measure: str, full: bool, k: int, min_common: int,
+                           workers: int = None) -> ItemSimilarities:
+    """Return the item-item similarity matrix for a measure, building it first if it is missing, was built from
+    different ratings or with different parameters"""
+    if np is None:
+        raise ValueError("the item-item similarity matrix requires numpy to be installed")
+    filename = dataset_file('items-{}.bin'.format(measure), full)
+    store = load_rating_store(full)
+    matrix = _item_similarities.get(filename)
+    if matrix is None or not matrix.is_current(store, k, min_common):
+        try:
+            matrix = ItemSimilarities(filename, measure)
+        except (OSError, ValueError, struct.error):
+            matrix = None
+        if matrix is None or not matrix.is_current(store, k, min_common):
+            matrix = ItemSimilarities(build_item_similarities(measure, full, k, min_common, workers), measure)
+        _item_similarities[filename] = matrix
+    matrix.update(store)
+    return matrix
+
+
+def similar_items(store: RatingStore, movie_index: int, k: int, min_common: int, measure: str,
+                  item_means: List[float] = None) -> (List[int], List[float]):
+    """Find the k movies most similar to a movie among those at least min_common of its raters also rated, keeping
+    only positive similarities. Ratings are centered on each user's mean for adjusted cosine and on each movie's mean
+    (item_means) for pearson, and all of the sums run over the users who rated both movies."""
+    users, ratings = store.movie_raters(movie_index)
+    adjusted = measure == 'adjusted_cosine'
+    users = np.frombuffer(users, dtype=np.int32).astype(np.int64)
+    row, cols, vals, lengths = gather_user_rows(store, users)
+    ours = np.frombuffer(ratings, dtype=np.float32).astype(np.float64)
+    if adjusted:
+        means = gather_user_totals(store, users)[0] / lengths
+        ours -= means
+        theirs = vals - means[row]
+    else:
+        ours -= item_means[movie_index]
+        theirs = vals - np.asarray(item_means)[cols]
+    ours = ours[row]
+    common = np.bincount(cols, minlength=store.n_movies)
+    dot = np.bincount(cols, weights=ours * theirs, minlength=store.n_movies)
+    denom = np.bincount(cols, weights=ours * ours, minlength=store.n_movies)
+    denom *= np.bincount(cols, weights=theirs * theirs, minlength=store.n_movies)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = np.where(denom > 0, dot / np.sqrt(denom), 0)
+    weights[(common < max(min_common, 1))] = 0
+    weights[movie_index] = 0
+    candidates = np.flatnonzero(weights > 0)
+    order = np.argsort(-weights[candidates], kind='stable')[:k]
+    return candidates[order].tolist(), weights[candidates[order]].tolist()
+
+def _similar_items_for_movies(task: Tuple[bool, int, int, int, int, str]) -> (int, int, List[Tuple[List[int], List[float]]]):
+    """Worker for build_item_similarities: find the most similar movies to a contiguous range of movies"""
+    full, start, end, k, min_common, measure = task
+    store = load_rating_store(full)
+    item_means = store.movie_means() if measure == 'pearson' else None
+    return start, end, [similar_items(store, m, k, min_common, measure, item_means) for m in range(start, end)]
+
+
+def build_item_similarities(measure: str, full: bool, k: int, min_common: int,
+                            workers: int = None, chunk_size: int = 64) -> str:
+    """Precompute the sparsified item-item similarity matrix for a measure across a pool of worker processes and
+    write it next to ratings.csv. Returns its path."""
+    if np is None:
+        raise ValueError("the item-item similarity matrix requires numpy to be installed")
+    store = load_rating_store(full)
+    rows = [None] * store.n_movies
+    for start, res in _run_chunked(_similar_items_for_movies, full, store.n_movies, 'movies', workers, chunk_size,
+                                   k, min_common, measure):
+        rows[start:start + len(res)] = res
+    offsets = array('q', [0])
+    neighbours = array('i')
+    weights = array('f')
+    for row_neighbours, row_weights in rows:
+        neighbours.extend(row_neighbours)
+        weights.extend(row_weights)
+        offsets.append(len(neighbours))
+    filename = dataset_file('items-{}.bin'.format(measure), full)
+    _write_binary(filename, ITEMS_HEADER.pack(ITEMS_MAGIC, ITEMS_VERSION, store.source_size, store.source_mtime,
+                                              store.n_movies, k, min_common),
+                  (offsets, neighbours, weights))
+    _item_similarities.pop(filename, None)
+    return filename
+
+
+def get_ratings_item_based(store: RatingStore, matrix: ItemSimilarities, user_id: str,
+                           movie_ids: List[str]) -> Dict[str, float]:
+    """Item-based collaborative filtering: predict each movie as the weighted sum of our user's own ratings of the
+    movies most similar to it. Only our user's row and each movie's row of the matrix are read."""
+    our_index = store.user_index(user_id)
+    if our_index is None:
+        raise ValueError("user {} has no ratings in the dataset".format(user_id))
+    our_ratings = dict(zip(*store.user_row(our_index)))
+    predictions = {}
+    for mid in movie_ids:
+        m = store.movie_index(mid)
+        if m is None:
+            continue
+        numer = 0
+        denom = 0
+        for other, weight in zip(*matrix.movie_neighbours(m)):
+            if other in our_ratings:
+                numer += our_ratings[other] * weight
+                denom += abs(weight)
+        if denom != 0:
+            predictions[mid] = numer / denom
+    return predictions
+
+
+# Defaults of the matrix factorisation model: the number of latent factors, the number of alternating least squares
+# iterations and the regularisation, which is scaled by each user's and movie's number of ratings (ALS-WR)
+FACTOR_RANK = 32
+FACTOR_ITERATIONS = 10
+FACTOR_REGULARIZATION = 0.1
+
+# The fraction of the ratings held out of training by the cross-validation routine
+FACTOR_HOLDOUT = 0.1
+
+# Header of a matrix factorisation model: magic, version, size and mtime of the ratings.csv its store was compiled
+# from, then the number of users, movies and factors, the number of iterations it was trained for, the regularisation
+# and the global mean rating. It is followed by the user factors (n_users rows of n_factors), the movie factors
+# (n_movies rows of n_factors), the user biases and the movie biases, all float32.
+FACTORS_MAGIC = b'MLMF'
+FACTORS_VERSION = 1
+FACTORS_HEADER = struct.Struct('=4sIqqqqqqdd')
+
+# Loaded factor models, keyed by the path of the model file
+_factor_models = {}
+
+
+class FactorModel:
+    """Memory-mapped latent factor model of a RatingStore, which predicts the global mean plus the user's and the
+    movie's bias plus the dot product of their factors. Requires numpy. update() solves the factors of the users with
+    ratings in the delta log again in memory; movies newer than the model can't be predicted until it is retrained."""
+
+    def __init__(self, filename: str):
+        self._mmap, header, section = _map_binary(filename, FACTORS_HEADER, FACTORS_MAGIC, FACTORS_VERSION)
+        (self.source_size, self.source_mtime, self.n_users, self.n_movies, self.rank, self.iterations,
+         self.regularization, self.mean) = header
+        self.user_factors = np.frombuffer(section('f', self.n_users * self.rank),
+                                          dtype=np.float32).reshape(self.n_users, self.rank)
+        self.movie_factors = np.frombuffer(section('f', self.n_movies * self.rank),
+                                           dtype=np.float32).reshape(self.n_movies, self.rank)
+        self.user_biases = np.frombuffer(section('f', self.n_users), dtype=np.float32)
+        self.movie_biases = np.frombuffer(section('f', self.n_movies), dtype=np.float32)
+        self.updated = {}
+        self._applied = 0
+
+    def is_current(self, store: RatingStore, rank: int, iterations: int, regularization: float) -> bool:
+        """Whether the model was trained on the given store's ratings.csv with the given parameters"""
+        return (self.source_size, self.source_mtime, self.rank, self.iterations, self.regularization) == \
+            (store.source_size, store.source_mtime, rank, iterations, regularization)
+
+    def update(self, store: RatingStore):
+        """Solve the factors of the users who rated, re-rated or deleted a rating since the last update again"""
+        changes = store.changes[self._applied:]
+        self._applied += len(changes)
+        if not changes:
+            return
+        users = np.array(sorted({u for u, _ in changes}), dtype=np.int64)
+        row, cols, vals, _ = gather_user_rows(store, users)
+        known = cols < self.n_movies
+        factors, biases = solve_factors(row[known], cols[known], vals[known], len(users), self.movie_factors,
+                                        self.movie_biases, self.mean, self.regularization)
+        for u, user_factors, bias in zip(users.tolist(), factors, biases.tolist()):
+            self.updated[u] = (user_factors, bias)
+
+    def user_vector(self, user_index: int) -> Optional[Tuple['np.ndarray', float]]:
+        """Return the user's factors and bias, or None for a user the model doesn't know"""
+        if user_index in self.updated:
+            return self.updated[user_index]
+        if user_index >= self.n_users:
+            return None
+        return self.user_factors[user_index], float(self.user_biases[user_index])
+
+    def predict(self, user_index: int, movies: 'np.ndarray' = None, clip: bool = True) -> 'np.ndarray':
+        """Predict the user's ratings of the given movie indices, which must be less than n_movies, or of every movie
+        in the model. Without "clip" the scores aren't limited to the range of the ratings, which keeps movies
+        predicted above it in order."""
+        factors, bias = self.user_vector(user_index)
+        if movies is None:
+            scores = self.movie_factors @ factors + self.movie_biases
+        else:
+            scores = self.movie_factors[movies] @ factors + self.movie_biases[movies]
+        scores += self.mean + bias
+        return np.clip(scores, 0.5, 5) if clip else scores
+
+
+def held_out(users: 'np.ndarray', movies: 'np.ndarray', seed: int, fraction: float) -> 'np.ndarray':
+    """Return a mask of the (user, movie) pairs in a held-out split of about the given fraction of the ratings. The
+    split is a hash of each pair and the seed, so every process computes the same split for any slice of the
+    ratings."""
+    with np.errstate(over='ignore'):
+        h = (users.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+             ^ movies.astype(np.uint64) * np.uint64(0xC2B2AE3D27D4EB4F)) + np.uint64(seed & 0xFFFFFFFFFFFFFFFF)
+        h ^= h >> np.uint64(31)
+        h *= np.uint64(0xBF58476D1CE4E5B9)
+        h ^= h >> np.uint64(29)
+    return (h >> np.uint64(11)).astype(np.float64) < fraction * 2 ** 53
+
+
+def solve_factors(row: 'np.ndarray', cols: 'np.ndarray', vals: 'np.ndarray', n_rows: int, fixed: 'np.ndarray',
+                  fixed_biases: 'np.ndarray', mean: float, regularization: float) -> ('np.ndarray', 'np.ndarray'):
+    """One half of an alternating least squares step: given a sparse matrix in the coordinate form returned by
+    gather_user_rows (or gather_movie_columns) and the factors and biases of its columns, solve the regularised least
+    squares problem for the factors and bias of each row. The column factors are extended with a constant 1 for the
+    row's bias. Rows with the same number of ratings are stacked so that their normal equations are built with one
+    batched matrix product, and all of them are solved in one batch. Rows without ratings get zeros."""
+    rank = fixed.shape[1]
+    design = np.ones((len(fixed), rank + 1))
+    design[:, :rank] = fixed
+    targets = vals - mean - fixed_biases[cols]
+    counts = np.bincount(row, minlength=n_rows)
+    starts = np.cumsum(counts) - counts
+    gram = np.zeros((n_rows, rank + 1, rank + 1))
+    rhs = np.zeros((n_rows, rank + 1, 1))
+    order = np.argsort(counts, kind='stable')
+    lengths, firsts = np.unique(counts[order], return_index=True)
+    for length, group in zip(lengths.tolist(), np.split(order, firsts[1:])):
+        if length:
+            positions = starts[group][:, None] + np.arange(length)
+            columns = design[cols[positions]]
+            transposed = columns.transpose(0, 2, 1)
+            gram[group] = transposed @ columns
+            rhs[group] = transposed @ targets[positions][:, :, None]
+    rated = np.flatnonzero(counts)
+    gram[rated] += regularization * counts[rated][:, None, None] * np.eye(rank + 1)
+    solution = np.zeros((n_rows, rank + 1))
+    solution[rated] = np.linalg.solve(gram[rated], rhs[rated])[:, :, 0]
+    return solution[:, :rank].astype(np.float32), solution[:, rank].astype(np.float32)
+
+
+# The fixed side of the current half step of train_factors in a worker process, as (file, step, factors, biases)
+_training_fixed = None
+
+
+def _solve_factors_for_range(task: Tuple[bool, int, int, bool, str, int, int, float, float,
+                                         Optional[Tuple[int, float]]]) -> (int, int, Tuple['np.ndarray', 'np.ndarray']):
+    """Worker for train_factors: solve the factors of a contiguous range of users (or of movies if not "by_user")
+    against the fixed factors of the other side, leaving out the held-out split if given as (seed, fraction). The
+    fixed factors and biases are read from fixed_file once per step and kept for the step's other chunks."""
+    global _training_fixed
+    full, start, end, by_user, fixed_file, step, rank, mean, regularization, holdout = task
+    if _training_fixed is None or _training_fixed[:2] != (fixed_file, step):
+        data = np.fromfile(fixed_file, dtype=np.float32)
+        n_fixed = len(data) // (rank + 1)
+        _training_fixed = (fixed_file, step, data[:n_fixed * rank].reshape(n_fixed, rank), data[n_fixed * rank:])
+    fixed, fixed_biases = _training_fixed[2:]
+    store = load_rating_store(full)
+    indices = np.arange(start, end, dtype=np.int64)
+    if by_user:
+        row, cols, vals, _ = gather_user_rows(store, indices)
+        users, movies = indices[row], cols
+    else:
+        row, cols, vals, _ = gather_movie_columns(store, indices)
+        users, movies = cols, indices[row]
+    if holdout is not None:
+        keep = ~held_out(users, movies, *holdout)
+        row, cols, vals = row[keep], cols[keep], vals[keep]
+    return start, end, solve_factors(row, cols, vals, end - start, fixed, fixed_biases, mean, regularization)
+
+
+def train_factors(full: bool, rank: int, iterations: int, regularization: float, workers: int = None,
+                  seed: int = 0, holdout: Tuple[int, float] = None,
+                  chunk_size: int = 4096) -> ('np.ndarray', 'np.ndarray', 'np.ndarray', 'np.ndarray', float):
+    """Train a latent factor model on the store by alternating least squares across a pool of worker processes, leaving
+    out the ratings of the (seed, fraction) holdout split if given. Returns the user factors, movie factors, user
+    biases and movie biases as float32 arrays, and the global mean."""
+    store = load_rating_store(full)
+    n_users, n_movies = store.n_users, store.n_movies
+    total = count = 0
+    for start in range(0, n_users, chunk_size):
+        users = np.arange(start, min(start + chunk_size, n_users), dtype=np.int64)
+        row, cols, vals, _ = gather_user_rows(store, users)
+        if holdout is not None:
+            vals = vals[~held_out(users[row], cols, *holdout)]
+        total += vals.sum()
+        count += len(vals)
+    mean = float(total / count) if count else 0
+    movie_factors = (np.random.default_rng(seed).standard_normal((n_movies, rank)) * 0.1).astype(np.float32)
+    movie_biases = np.zeros(n_movies, dtype=np.float32)
+    user_factors = np.zeros((n_users, rank), dtype=np.float32)
+    user_biases = np.zeros(n_users, dtype=np.float32)
+    with tempfile.TemporaryDirectory() as scratch, Pool(workers) as pool:
+        fixed_file = os.path.join(scratch, 'fixed.bin')
+        for iteration in range(iterations):
+            print("Iteration {}/{}".format(iteration + 1, iterations), file=sys.stderr)
+            for step, (by_user, n, unit, factors, biases, fixed, fixed_biases) in enumerate((
+                    (True, n_users, 'users', user_factors, user_biases, movie_factors, movie_biases),
+                    (False, n_movies, 'movies', movie_factors, movie_biases, user_factors, user_biases)),
+                    2 * iteration):
+                with open(fixed_file, 'wb') as f:
+                    fixed.tofile(f)
+                    fixed_biases.tofile(f)
+                for start, (chunk_factors, chunk_biases) in _run_chunked(
+                        _solve_factors_for_range, full, n, unit, workers, chunk_size, by_user, fixed_file, step, rank,
+                        mean, regularization, holdout, pool=pool):
+                    factors[start:start + len(chunk_factors)] = chunk_factors
+                    biases[start:start + len(chunk_biases)] = chunk_biases
+    return user_factors, movie_factors, user_biases, movie_biases, mean
+
+
+def factor_model_file(full: bool) -> str:
+    """Return the path of the matrix factorisation model"""
+    return dataset_file('factors.bin', full)
+
+
+def load_factor_model(full: bool, rank: int = FACTOR_RANK, iterations: int = FACTOR_ITERATIONS,
+                      regularization: float = FACTOR_REGULARIZATION, workers: int = None) -> FactorModel:
+    """Return the matrix factorisation model, training it first if it is missing, was trained on different ratings
+    or with different parameters"""
+    if np is None:
+        raise ValueError("the matrix factorisation model requires numpy to be installed")
+    filename = factor_model_file(full)
+    store = load_rating_store(full)
+    model = _factor_models.get(filename)
+    if model is None or not model.is_current(store, rank, iterations, regularization):
+        try:
+            model = FactorModel(filename)
+        except (OSError, ValueError, struct.error):
+            model = None
+        if model is None or not model.is_current(store, rank, iterations, regularization):
+            model = FactorModel(build_factor_model(full, rank, iterations, regularization, workers))
+        _factor_models[filename] = model
+    model.update(store)
+    return model
+
+
+def build_factor_model(full: bool, rank: int, iterations: int, regularization: float, workers: int = None) -> str:
+    """Train the matrix factorisation model on every rating and write it next to ratings.csv. Returns its path."""
+    store = load_rating_store(full)
+    user_factors, movie_factors, user_biases, movie_biases, mean = train_factors(full, rank, iterations,
+                                                                                  regularization, workers)
+    filename = factor_model_file(full)
+    _write_binary(filename, FACTORS_HEADER.pack(FACTORS_MAGIC, FACTORS_VERSION, store.source_size,
+                                                store.source_mtime, store.n_users, store.n_movies, rank, iterations,
+                                                regularization, mean),
+                  [array('f', factors.tobytes()) for factors in (user_factors, movie_factors, user_biases,
+                                                                 movie_biases)])
+    _factor_models.pop(filename, None)
+    return filename
+
+
+def get_ratings_from_factors(store: RatingStore, model: FactorModel, user_id: str,
+                             movie_ids: List[str]) -> Dict[str, float]:
+    """Predict each movie from the factor model with one dot product of the user's and the movie's factors, leaving
+    out movies the model doesn't know"""
+    our_index = store.user_index(user_id)
+    if our_index is None:
+        raise ValueError("user {} has no ratings in the dataset".format(user_id))
+    known = {mid: m for mid, m in ((mid, store.movie_index(mid)) for mid in movie_ids)
+             if m is not None and m < model.n_movies}
+    if not known:
+        return {}
+    ratings = model.predict(our_index, np.fromiter(known.values(), dtype=np.int64, count=len(known)))
+    return dict(zip(known, ratings.tolist()))
+
+
+def _map_binary(filename: str, header: struct.Struct, magic: bytes, version: int) -> (mmap.mmap, tuple, callable):
+    """Memory-map a file written by _write_binary. Returns the mmap, the header fields after the magic and version,
+    and a function that maps each following section in turn given its typecode and length."""
+    with open(filename, 'rb') as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    fields = header.unpack_from(mapped)
+    if fields[0] != magic or fields[1] != version:
+        raise ValueError("{} is not a version {} {} file".format(filename, version, magic.decode()))
+    view = memoryview(mapped)
+    offset = header.size
+
+    def section(typecode: str, length: int) -> memoryview:
+        nonlocal offset
+        offset = _align(offset)
+        size = length * struct.calcsize(typecode)
+        res = view[offset:offset + size].cast(typecode)
+        offset += size
+        return res
+
+    return mapped, fields[2:], section
+
+
+# The process's umask, read once at import since reading it means setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _write_binary(filename: str, header: bytes, sections: List[array]):
+    """Write a header followed by 8-byte aligned arrays. The file is written under a unique temporary name first so
+    that a reader never maps a half-written file and writers in other processes don't interleave."""
+    descriptor, temporary = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(filename) + '.',
+                                             dir=os.path.dirname(filename) or os.curdir)
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(header)
+            for section in sections:
+                file.write(bytes(_align(file.tell()) - file.tell()))
+                section.tofile(file)
+        # mkstemp makes the file private, but the dataset's files are shared like any other
+        os.chmod(temporary, 0o666 & ~_UMASK)
+        os.replace(temporary, filename)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def _align(offset: int) -> int:
+    """Round a byte offset up to the next multiple of 8"""
+    return (offset + 7) & ~7
+
+
+def _find(ids: memoryview, value: int) -> Optional[int]:
+    """Binary search a sorted ID array, returning the position of the value or None"""
+    i = bisect_left(ids, value)
+    return i if i < len(ids) and ids[i] == value else None
+
+
+class LatencyHistogram:
+    """Thread-safe histogram of request latencies with fixed millisecond buckets"""
+
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self.counts[bisect_left(self.BUCKETS, seconds * 1000)] += 1
+            self.total += seconds * 1000
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            count = sum(self.counts)
+            return {'count': count, 'mean_ms': self.total / count if count else 0,
+                    'buckets': [{'le_ms': bound, 'count': n}
+                                for bound, n in zip(self.BUCKETS + ('inf',), self.counts)]}
+
+
+# Options of a prediction request, as keyword arguments of predict_ratings, and their defaults
+PREDICTION_OPTIONS = {'use_genres': False, 'cosine': False, 'euclidean': False, 'backend': 'python',
+                      'neighbours': False, 'item_based': False, 'k': 50, 'min_common': 3,
+                      'lsh': False, 'lsh_tables': 8, 'lsh_bits': None, 'factors': False, 'rank': 32,
+                      'iterations': 10, 'regularization': 0.1}
+
+# Options that select which index or model is built rather than how it is used: a PredictionServer fixes them when
+# it starts, since changing one means rebuilding in the middle of serving
+MODEL_OPTIONS = ('k', 'min_common', 'lsh_tables', 'lsh_bits', 'rank', 'iterations', 'regularization')
+
+
+def check_prediction_options(options: dict):
+    """Raise ValueError unless the options, keyword arguments of predict_ratings, are valid together"""
+    for name, value in options.items():
+        if name not in PREDICTION_OPTIONS:
+            raise ValueError("unknown option: {}".format(name))
+        default = PREDICTION_OPTIONS[name]
+        if isinstance(default, bool) and not isinstance(value, bool):
+            raise ValueError("{} needs to be true or false".format(name))
+    option = dict(PREDICTION_OPTIONS, **options).get
+    for name in ('k', 'min_common', 'lsh_tables', 'rank', 'iterations'):
+        if isinstance(option(name), bool) or not isinstance(option(name), int) or option(name) < 1:
+            raise ValueError("{} needs to be a whole number of at least 1".format(name))
+    bits = option('lsh_bits')
+    if bits is not None and (isinstance(bits, bool) or not isinstance(bits, int) or not 0 < bits < 63):
+        raise ValueError("lsh_bits needs to be a whole number from 1 to 62")
+    regularization = option('regularization')
+    if isinstance(regularization, bool) or not isinstance(regularization, (int, float)) or not regularization > 0:
+        raise ValueError("regularization needs to be a positive number")
+    if option('backend') not in BACKENDS:
+        raise ValueError("backend needs to be one of {}".format(', '.join(BACKENDS)))
+    if option('backend') == 'numpy' and np is None:
+        raise ValueError("the numpy backend requires numpy to be installed")
+    if option('cosine') and option('euclidean'):
+        raise ValueError("cosine similarity and euclidean distance can't be used together")
+    if np is None and (option('neighbours') or option('item_based') or option('lsh')):
+        raise ValueError("the neighbour index, the LSH index and item-based filtering require numpy to be installed")
+    if option('factors'):
+        if np is None:
+            raise ValueError("the matrix factorisation model requires numpy to be installed")
+        if option('use_genres') or option('neighbours') or option('item_based') or option('lsh'):
+            raise ValueError("the matrix factorisation model can't be combined with genres, the neighbour index, "
+                             "item-based filtering or the LSH index")
+    if option('item_based') and (option('use_genres') or option('neighbours') or option('euclidean')):
+        raise ValueError("item-based filtering uses its own similarity matrix; it can't be combined with genres, the "
+                         "neighbour index or euclidean distance")
+    if option('lsh') and (option('use_genres') or option('neighbours') or option('item_based')
+                          or option('euclidean')):
+        raise ValueError("the LSH index supports cosine similarity and Pearson correlation, and can't be combined "
+                         "with genres, the neighbour index or item-based filtering")
+    if option('neighbours') and option('use_genres'):
+        raise ValueError("the neighbour index can't be used with genre weighting")
+
+
+# How long a request waits for its batch, in seconds, before the server gives up on it
+PREDICTION_TIMEOUT = 60
+
+
+class _PendingPrediction:
+    """A prediction request waiting for its batch to be computed"""
+
+    def __init__(self, user_id: str, movie_ids: List[str], options: tuple):
+        self.user_id = user_id
+        self.movie_ids = movie_ids
+        self.options = options
+        self.predictions = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class PredictionServer(ThreadingHTTPServer):
+    """HTTP/JSON server that keeps the ratings, movies and links loaded and answers prediction requests.
+
+    Handler threads queue their requests for a single batching thread, which waits up to batch_window seconds for
+    more requests to arrive and then groups them by user and options: each group is predicted with one call to
+    predict_ratings over the union of the requested movies, so the neighbours' similarities are computed once and
+    shared by every request in the group. Before each batch the store merges in whatever has been appended to the
+    delta log, by POST /ratings or by any other process, so a new rating is seen by the next batch.
+
+    The MODEL_OPTIONS are fixed for the life of the server, and the models it serves ("factors", "item_based" and
+    "lsh") are built or loaded before it starts listening, so no request waits behind a rebuild."""
+
+    daemon_threads = True
+
+    def __init__(self, address: (str, int), full: bool, batch_window: float = 0.005, models: List[str] = (),
+                 workers: int = None, **options):
+        fixed = [name for name in options if name not in MODEL_OPTIONS]
+        if fixed:
+            raise ValueError("not options of the server's models: {}".format(', '.join(fixed)))
+        unknown = [model for model in models if model not in ('factors', 'item_based', 'lsh')]
+        if unknown:
+            raise ValueError("unknown models: {}".format(', '.join(unknown)))
+        check_prediction_options(options)
+        self.full = full
+        self.batch_window = batch_window
+        self.options = {name: options.get(name, PREDICTION_OPTIONS[name]) for name in MODEL_OPTIONS}
+        self.models = frozenset(models)
+        self.store = load_rating_store(full)
+        self.movies = get_movies_from_ids(None, True, full)
+        option = self.options.get
+        if 'factors' in self.models:
+            load_factor_model(full, option('rank'), option('iterations'), option('regularization'), workers)
+        if 'item_based' in self.models:
+            for measure in ITEM_MEASURES:
+                load_item_similarities(measure, full, option('k'), option('min_common'), workers)
+        if 'lsh' in self.models:
+            for measure in LSH_MEASURES:
+                load_lsh_index(measure, full, option('lsh_tables'), option('lsh_bits'))
+        super().__init__(address, PredictionRequestHandler)
+        self.latency = LatencyHistogram()
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.requests = 0
+        self.batches = 0
+        self._pending = queue.Queue()
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+
+    def predict(self, user_id: str, movie_ids: List[str], **options) -> Dict[str, float]:
+        """Queue a prediction and wait for its batch. Raises ValueError for options the server can't predict with,
+        and otherwise whatever predicting the batch raised."""
+        for name in MODEL_OPTIONS:
+            if name in options and options[name] != self.options[name]:
+                raise ValueError("the server predicts with {} {}".format(name, self.options[name]))
+        for model in ('factors', 'item_based', 'lsh'):
+            if options.get(model) and model not in self.models:
+                raise ValueError("the server was started without the {} model".format(model))
+        options = dict(options, **self.options)
+        check_prediction_options(options)
+        pending = _PendingPrediction(user_id, movie_ids,
+                                     tuple(options.get(name, default) for name, default in PREDICTION_OPTIONS.items()))
+        self._pending.put(pending)
+        if not pending.done.wait(PREDICTION_TIMEOUT):
+            raise TimeoutError("no prediction within {} s".format(PREDICTION_TIMEOUT))
+        if pending.error is not None:
+            raise pending.error
+        return {mid: pending.predictions[mid] for mid in movie_ids if mid in pending.predictions}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'in_flight': self.in_flight, 'requests': self.requests, 'batches': self.batches,
+                    'latency': self.latency.as_dict()}
+
+    def _batch_loop(self):
+        while True:
+            batch = [self._pending.get()]
+            deadline = time.perf_counter() + self.batch_window
+            while True:
+                remaining = deadline - time.perf_counter()
+                try:
+                    batch.append(self._pending.get(timeout=remaining) if remaining > 0 else self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            with self._lock:
+                self.batches += 1
+            try:
+                self._predict_batch(batch)
+            except Exception as error:
+                # fail whatever is left of the batch rather than the thread, which every later request waits on
+                for pending in batch:
+                    if not pending.done.is_set():
+                        pending.error = RuntimeError(str(error))
+                        pending.done.set()
+
+    def _predict_batch(self, batch: List[_PendingPrediction]):
+        # pick up ratings appended to the delta log since the last batch
+        self.store = load_rating_store(self.full)
+        groups = {}
+        for pending in batch:
+            groups.setdefault((pending.user_id, pending.options), []).append(pending)
+        for (user_id, options), group in groups.items():
+            movie_ids = list(dict.fromkeys(mid for pending in group for mid in pending.movie_ids))
+            predictions = error = None
+            try:
+                predictions = predict_ratings(self.store, self.movies, user_id, movie_ids, full=self.full,
+                                              **dict(zip(PREDICTION_OPTIONS, options)))
+            except Exception as e:
+                error = e
+            for pending in group:
+                pending.predictions, pending.error = predictions, error
+                pending.done.set()
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    """Handles POST /predict, POST /ratings and GET /stats for a PredictionServer.
+
+    A prediction request is a JSON object with "user_id" and "movie_ids", optionally "id_type" ("movielens",
+    "imdb" or "tmdb") and any of the options of get_predicted_ratings ("genres", "cosine", "euclidean",
+    "backend", "neighbours", "item_based", "k", "min_common", "lsh", "lsh_tables", "lsh_bits", "factors", "rank",
+    "iterations", "regularization"); the options of the models are fixed when the server starts, so a request may
+    only repeat them. A ratings request
+    is a JSON object with "user_id" and "ratings", a mapping from MovieLens IDs to ratings, or to null to delete the
+    user's rating of the movie."""
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.server.stats())
+        else:
+            self._reply(404, {'error': "not found"})
+
+    def do_POST(self):
+        routes = {'/predict': self._predict, '/ratings': self._rate}
+        if self.path not in routes:
+            self._reply(404, {'error': "not found"})
+            return
+        server = self.server
+        began = time.perf_counter()
+        with server._lock:
+            server.in_flight += 1
+            server.requests += 1
+        try:
+            status, body = routes[self.path]()
+        except Exception as error:
+            status, body = 500, {'error': "internal error: {}".format(error)}
+        finally:
+            with server._lock:
+                server.in_flight -= 1
+        server.latency.observe(time.perf_counter() - began)
+        self._reply(status, body)
+
+    def _predict(self) -> (int, dict):
+        server = self.server
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(request['user_id'], (int, str)) or not isinstance(request['movie_ids'], list):
+                raise ValueError("user_id needs to be an ID and movie_ids a list of IDs")
+            user_id = str(request['user_id'])
+            ids = [str(movie_id) for movie_id in request['movie_ids']]
+            id_type = request.get('id_type', 'movielens')
+            if id_type not in ID_TYPES:
+                raise ValueError("unknown id_type: {}".format(id_type))
+            options = {name: request[name] for name in PREDICTION_OPTIONS if name in request}
+            if 'genres' in request:
+                options['use_genres'] = request['genres']
+        except (ValueError, KeyError, TypeError) as error:
+            return 400, {'error': "bad request: {}".format(error)}
+        movie_ids = server.movies.translate(ids, id_type)
+        try:
+            predictions = server.predict(user_id, [mid for mid in movie_ids if mid is not None], **options)
+        except ValueError as error:
+            return 400, {'error': str(error)}
+        results = []
+        for requested, mid in zip(ids, movie_ids):
+            rating = predictions.get(mid)
+            results.append({'id': requested, 'movie_id': mid,
+                            'title': server.movies[mid].title if mid is not None else None,
+                            'rating': rating, 'stars': round_stars(rating) if rating is not None else None})
+        return 200, {'user_id': user_id, 'predictions': results}
+
+    def _rate(self) -> (int, dict):
+        server = self.server
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            user_id = int(request['user_id'])
+            ratings = [(user_id, int(mid), rating) for mid, rating in request['ratings'].items()]
+            unknown = [str(mid) for _, mid, _ in ratings if str(mid) not in server.movies]
+            if unknown:
+                raise ValueError("unknown movies: {}".format(', '.join(unknown)))
+            append_ratings(server.full, ratings)
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            return 400, {'error': "bad request: {}".format(error)}
+        return 200, {'user_id': user_id, 'recorded': len(ratings)}
+
+    def _reply(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # keep the console quiet, /stats has the numbers
+        pass
 
 
 def round_stars(score: float) -> float:
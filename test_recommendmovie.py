@@ -0,0 +1,588 @@
+"""Regression tests for recommendmovie.py, run with "python -m pytest" from the repository root.
+
+Each test works in a fresh directory with a small synthetic dataset in the MovieLens layout from benchmark.py, so
+nothing is downloaded and the real datasets are never touched."""
+from math import sqrt
+import csv
+import json
+import multiprocessing
+import os
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import benchmark
+import recommendmovie
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+needs_numpy = pytest.mark.skipif(np is None, reason="numpy is not installed")
+
+# Module-level caches of loaded files, keyed by path relative to the working directory
+CACHES = ('_genre_matrices', '_catalogues', '_rating_stores', '_neighbour_indices', '_lsh_indices',
+          '_item_similarities', '_factor_models')
+
+
+def clear_caches():
+    for name in CACHES:
+        getattr(recommendmovie, name).clear()
+    recommendmovie._training_fixed = None
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    """About 6,000 synthetic ratings of 400 movies by 120 users in ml-latest under a fresh working directory.
+    Returns the ratings store."""
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('ml-latest')
+    benchmark.generate_dataset(6000, 120, 400, seed=7)
+    clear_caches()
+    yield recommendmovie.load_rating_store(True)
+    clear_caches()
+
+
+@pytest.fixture
+def movies(dataset):
+    return recommendmovie.get_movies_from_ids(None, True, True)
+
+
+@pytest.fixture
+def tiny_dataset(tmp_path, monkeypatch):
+    """Three users who rated movies 10, 20, 30 and 40, each with a mean of 3, and user 4, who rated all of them
+    but movie 10. Returns the ratings store."""
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('ml-latest')
+    ratings = {1: {10: 4, 20: 4, 30: 1, 40: 3}, 2: {10: 4, 20: 3, 30: 1, 40: 4}, 3: {10: 2, 20: 2, 30: 5, 40: 3},
+               4: {20: 5, 30: 1, 40: 3}}
+    with open(recommendmovie.dataset_file('ratings.csv', True), 'w') as file:
+        file.write('userId,movieId,rating,timestamp\n')
+        file.writelines('{},{},{},0\n'.format(u, mid, rating) for u, row in ratings.items()
+                        for mid, rating in row.items())
+    with open(recommendmovie.dataset_file('movies.csv', True), 'w') as file:
+        file.write('movieId,title,genres\n')
+        file.writelines('{0},Movie {0} (2000),Drama\n'.format(mid) for mid in (10, 20, 30, 40))
+    with open(recommendmovie.dataset_file('links.csv', True), 'w') as file:
+        file.write('movieId,imdbId,tmdbId\n')
+    clear_caches()
+    yield recommendmovie.load_rating_store(True)
+    clear_caches()
+
+
+def python_similarity(measure, our_ratings, our_stats, their_ratings, their_stats):
+    """The pure-Python function vectorized_similarities reproduces for a measure"""
+    if measure == 'pearson':
+        return recommendmovie.pearson_correlation(our_ratings, their_ratings, our_stats.mean, their_stats.mean,
+                                                  our_stats.centered_ss, their_stats.centered_ss)
+    if measure == 'cosine':
+        return recommendmovie.cosine_similarity(our_ratings, their_ratings, our_stats.norm, their_stats.norm)
+    return getattr(recommendmovie, measure + '_distance')(our_ratings, their_ratings)
+
+
+@needs_numpy
+@pytest.mark.parametrize('measure', recommendmovie.VECTORIZED_MEASURES)
+def test_vectorized_similarities_match_python(dataset, measure):
+    store = dataset
+    users = list(range(store.n_users))
+    for u in range(0, store.n_users, 10):
+        our_ratings, our_stats = store.user_vector(u), store.user_stats(u)
+        similarities, means = recommendmovie.vectorized_similarities(store, our_ratings, our_stats.mean, users,
+                                                                     measure, our_stats)
+        for v in users:
+            their_ratings, their_stats = store.user_vector(v), store.user_stats(v)
+            assert means[v] == their_stats.mean
+            try:
+                expected = python_similarity(measure, our_ratings, our_stats, their_ratings, their_stats)
+            except ZeroDivisionError:
+                assert np.isnan(similarities[v])
+            else:
+                assert similarities[v] == expected
+
+
+@pytest.mark.parametrize('argv, error', [(['99999', '5'], "user 99999 has no ratings"),
+                                         (['1', '5', '99999999'], "unknown movies: 99999999"),
+                                         (['1', '5', 't5'], "unknown movies: t5"),
+                                         (['-g', '1', 'tt5'], "unknown movies: tt5"),
+                                         (['--rate', 'tt5', '4', '1'], "unknown movies: tt5")])
+def test_predictions_report_unknown_ids_as_usage_errors(dataset, monkeypatch, capsys, argv, error):
+    monkeypatch.setattr('sys.argv', ['recommendmovie.py', '-f'] + argv)
+    with pytest.raises(SystemExit) as exit:
+        recommendmovie.main()
+    assert exit.value.code == 2
+    assert error in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('flag', ['-n', '--lsh', '--item-based', '--build-neighbours', '--factors'])
+def test_numpy_engines_are_usage_errors_without_numpy(dataset, monkeypatch, capsys, flag):
+    monkeypatch.setattr(recommendmovie, 'np', None)
+    monkeypatch.setattr('sys.argv', ['recommendmovie.py', '-f', flag, '1', '5'])
+    with pytest.raises(SystemExit) as exit:
+        recommendmovie.main()
+    assert exit.value.code == 2
+    assert "numpy to be installed" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('flags, options', [(['-c'], {'cosine': True}), (['-e', '-g'], {'euclidean': True,
+                                                                                     'use_genres': True})])
+def test_command_line_passes_options_through(dataset, movies, monkeypatch, capsys, flags, options):
+    movie_ids = list(movies)[:10]
+    monkeypatch.setattr('sys.argv', ['recommendmovie.py', '-f'] + flags + ['3'] + movie_ids)
+    recommendmovie.main()
+    expected = recommendmovie.predict_ratings(dataset, movies, '3', movie_ids, full=True,
+                                              **dict(recommendmovie.PREDICTION_OPTIONS, **options))
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split(' | ')[1] for line in lines] == [
+        "Not enough similar users to predict a rating" if expected.get(mid) is None
+        else "Predicted rating: {} stars".format(recommendmovie.round_stars(expected[mid])) for mid in movie_ids]
+
+    monkeypatch.setattr('sys.argv', ['recommendmovie.py', '-f', '--top', '5', '--min-support', '2'] + flags + ['3'])
+    recommendmovie.main()
+    expected = recommendmovie.recommend_movies(dataset, movies, '3', 5, True, min_support=2, **options)
+    assert [line.split(' | ')[0] for line in capsys.readouterr().out.splitlines()] == [str(movies[mid])
+                                                                                      for mid, _ in expected]
+
+
+@needs_numpy
+@pytest.mark.parametrize('cosine, euclidean', [(False, False), (True, False), (False, True)])
+def test_numpy_backend_predicts_like_python(dataset, movies, cosine, euclidean):
+    movie_ids = list(movies)[:60]
+    for user_id in ('1', '17', '64'):
+        python = recommendmovie.predict_ratings(dataset, movies, user_id, movie_ids, False, True, cosine, euclidean)
+        vectorized = recommendmovie.predict_ratings(dataset, movies, user_id, movie_ids, False, True, cosine,
+                                                    euclidean, backend='numpy')
+        assert python.keys() == vectorized.keys()
+        for mid, rating in python.items():
+            assert vectorized[mid] == pytest.approx(rating, rel=1e-9)
+
+
+def test_fused_rmse_matches_get_rating(dataset, movies):
+    store = dataset
+    users = [u for u in range(0, store.n_users, 15) if store.user_stats(u).count > 1]
+    recommendmovie._init_rmse_worker(movies)
+    fused = recommendmovie._rmse_for_users((True, users, 'python'))
+    for measure, cosine, euclidean in (('pearson', False, False), ('cosine', True, False),
+                                       ('euclidean', False, True)):
+        squared_error, predictions = 0, 0
+        for u in users:
+            our_ratings = store.user_vector(u)
+            for mid, real_rating in list(our_ratings.items()):
+                without = {other: rating for other, rating in our_ratings.items() if other != mid}
+                others = [store.user_vector(v) for v in store.movie_raters(store.movie_index(mid))[0] if v != u]
+                our_avg = sum(without.values()) / len(without)
+                try:
+                    predicted = recommendmovie.get_rating(mid, movies, without, others, our_avg, False, cosine,
+                                                          euclidean)
+                except ZeroDivisionError:
+                    continue
+                squared_error += (real_rating - predicted) ** 2
+                predictions += 1
+        assert fused[measure][1] == predictions
+        assert fused[measure][0] == pytest.approx(squared_error, rel=1e-9)
+
+
+def test_rmse_is_the_same_for_any_number_of_workers(dataset, movies):
+    serial = recommendmovie.calculate_rmse_for_each_distance_measure(50, movies, True, seed=3, workers=1)
+    parallel = recommendmovie.calculate_rmse_for_each_distance_measure(50, movies, True, seed=3, workers=2)
+    for measure, result in serial.items():
+        assert parallel[measure].rmse == result.rmse
+        assert parallel[measure].predictions == result.predictions
+    assert serial['pearson'].seconds == serial['genre'].seconds
+
+
+@needs_numpy
+def test_knn_seconds_are_the_summed_search_times(dataset, movies, monkeypatch):
+    shards = []
+
+    def knn_rmse_for_users(task):
+        shards.append(task)
+        return {measure + search: [0, 0, seconds, 0, 0] for measure in recommendmovie.LSH_MEASURES
+                for search, seconds in ((' knn', 2.0), (' lsh', 0.5))}
+    monkeypatch.setattr(recommendmovie, '_knn_rmse_for_users', knn_rmse_for_users)
+    results = recommendmovie.calculate_rmse_for_each_distance_measure(50, movies, True, seed=3, lsh=True, k=5)
+    assert len(shards) > 1
+    for measure in recommendmovie.LSH_MEASURES:
+        assert results[measure + ' knn'].seconds == 2.0 * len(shards)
+        assert results[measure + ' lsh'].seconds == 0.5 * len(shards)
+    assert results['pearson'].seconds == results['genre'].seconds
+
+
+def test_each_fused_measure_reports_its_own_rate(dataset, monkeypatch, capsys):
+    counts = {'cosine': 100, 'pearson': 200, 'euclidean': 300, 'genre': 50}
+    monkeypatch.setattr(recommendmovie, 'calculate_rmse_for_each_distance_measure', lambda *args, **kwargs: {
+        measure: recommendmovie.RmseResult(1.0, count, 4.0) for measure, count in counts.items()})
+    monkeypatch.setattr('sys.argv', ['recommendmovie.py', '-f', '-r', '-w', '1', '-s', '1'])
+    recommendmovie.main()
+    assert "predictions/s: Cosine 25.0, Pearson 50.0, Euclidean 75.0, Genre 12.5" in capsys.readouterr().out
+
+
+def test_malformed_delta_lines_are_skipped(dataset, movies, capsys):
+    store = dataset
+    mids = [mid for mid in movies if mid not in store.user_vector(store.user_index('6'))][:3]
+    recommendmovie.append_ratings(True, [(6, int(mids[0]), 4)])
+    with open(recommendmovie.dataset_file(recommendmovie.DELTA_LOG, True), 'a') as file:
+        file.write('6,{},four,0\n6,{},9,0\n6,{},3.5,0\n6,{}'.format(mids[0], mids[1], mids[2], mids[1]))
+    store = recommendmovie.load_rating_store(True)
+    ratings = store.user_vector(store.user_index('6'))
+    assert (ratings[mids[0]], ratings[mids[2]]) == (4, 3.5) and mids[1] not in ratings
+    assert capsys.readouterr().err.count("Skipping malformed line") == 2
+
+    recommendmovie.compact_ratings(True)
+    clear_caches()
+    store = recommendmovie.load_rating_store(True)
+    assert store.user_vector(store.user_index('6')) == ratings
+
+
+@pytest.mark.parametrize('rate', [['--rate', '5', 'four'], ['--rate', '5', '6'], ['--unrate', 'x5']])
+def test_invalid_ratings_are_usage_errors(dataset, monkeypatch, capsys, rate):
+    monkeypatch.setattr('sys.argv', ['recommendmovie.py', '-f'] + rate + ['1'])
+    with pytest.raises(SystemExit) as exit:
+        recommendmovie.main()
+    assert exit.value.code == 2
+    assert "error:" in capsys.readouterr().err
+    assert not os.path.exists(recommendmovie.dataset_file(recommendmovie.DELTA_LOG, True))
+
+
+def test_concurrent_compiles_write_a_whole_store(dataset):
+    before = [dataset.user_vector(u) for u in range(dataset.n_users)]
+    with multiprocessing.Pool(4) as pool:
+        pool.map(recommendmovie.compile_rating_store, [True] * 8, chunksize=1)
+    clear_caches()
+    store = recommendmovie.load_rating_store(True)
+    assert [store.user_vector(u) for u in range(store.n_users)] == before
+    assert not [name for name in os.listdir('ml-latest') if name.endswith('.tmp')]
+    umask = os.umask(0)
+    os.umask(umask)
+    assert os.stat(recommendmovie.dataset_file('ratings.bin', True)).st_mode & 0o777 == 0o666 & ~umask
+
+
+def test_delta_log_is_merged_and_compacted(dataset, movies):
+    store = dataset
+    user = store.user_index('5')
+    before = store.user_vector(user)
+    rated, unrated = next(iter(before)), next(mid for mid in movies if mid not in before)
+    recommendmovie.append_ratings(True, [(5, int(unrated), 4.5), (5, int(rated), None), (999, int(unrated), 2)])
+    with pytest.raises(ValueError):
+        recommendmovie.append_ratings(True, [(5, int(unrated), 4.2)])
+
+    store = recommendmovie.load_rating_store(True)
+    expected = dict(before)
+    del expected[rated]
+    expected[unrated] = 4.5
+    assert store.user_vector(store.user_index('5')) == expected
+    assert store.user_vector(store.user_index('999')) == {unrated: 2}
+    assert recommendmovie.user_statistics(expected) == store.user_stats(store.user_index('5'))
+
+    recommendmovie.compact_ratings(True)
+    assert not os.path.exists(recommendmovie.dataset_file(recommendmovie.DELTA_LOG, True))
+    clear_caches()
+    store = recommendmovie.load_rating_store(True)
+    assert store.user_vector(store.user_index('5')) == expected
+    assert store.user_vector(store.user_index('999')) == {unrated: 2}
+    with open(recommendmovie.dataset_file('ratings.csv', True)) as file:
+        keys = [(int(row['userId']), int(row['movieId'])) for row in csv.DictReader(file)]
+    assert keys == sorted(keys)
+
+
+@needs_numpy
+@pytest.mark.parametrize('measure', recommendmovie.LSH_MEASURES)
+def test_lsh_index_rehashes_users_from_the_delta_log(dataset, measure):
+    store = dataset
+    index = recommendmovie.load_lsh_index(measure, True, 4, 3)
+    emptied, rerated = store.user_index('7'), store.user_index('5')
+    recommendmovie.append_ratings(True, [(7, int(mid), None) for mid in store.user_vector(emptied)]
+                                  + [(5, int(mid), 0.5) for mid in store.user_vector(rerated)])
+    store = recommendmovie.load_rating_store(True)
+    assert store.user_stats(emptied).count == 0
+    index = recommendmovie.load_lsh_index(measure, True, 4, 3)
+    assert index.user_signatures(emptied) == [0] * 4
+    assert index.user_signatures(rerated) == recommendmovie.lsh_signatures(store, rerated, index.planes,
+                                                                           index.n_movies, 4, 3, measure == 'pearson')
+    for u in range(0, store.n_users, 10):
+        assert emptied not in index.user_neighbours(store, u, 10, 1)[0]
+
+
+@needs_numpy
+@pytest.mark.parametrize('measure', recommendmovie.LSH_MEASURES)
+def test_held_out_neighbours_are_found_without_the_rating(dataset, measure):
+    store = dataset
+    index = recommendmovie.load_lsh_index(measure, True, 4, 3)
+    u = store.user_index('12')
+    held_out = [(m, rating, recommendmovie.nearest_neighbours(store, u, 10, 2, [measure], m)[measure],
+                 index.user_neighbours(store, u, 10, 2, m)) for m, rating in list(zip(*store.user_row(u)))[:5]]
+    for m, rating, exact, approximate in held_out:
+        # the same neighbours are found with the rating deleted through the delta log
+        recommendmovie.append_ratings(True, [(12, int(store.movie_keys[m]), None)])
+        store = recommendmovie.load_rating_store(True)
+        index = recommendmovie.load_lsh_index(measure, True, 4, 3)
+        for expected, found in ((recommendmovie.nearest_neighbours(store, u, 10, 2, [measure])[measure], exact),
+                                (index.user_neighbours(store, u, 10, 2), approximate)):
+            assert found[0] == expected[0]
+            assert found[1] == pytest.approx(expected[1])
+        recommendmovie.append_ratings(True, [(12, int(store.movie_keys[m]), rating)])
+        store = recommendmovie.load_rating_store(True)
+
+
+@needs_numpy
+@pytest.mark.parametrize('cosine, euclidean', [(False, False), (True, False), (False, True)])
+@pytest.mark.parametrize('tf', [{}, {'augmented': True}, {'boolean': True}, {'logarithmic': False, 'smooth': False}])
+def test_genre_matrix_backends_agree(dataset, movies, cosine, euclidean, tf):
+    store = dataset
+    vectorized = recommendmovie.GenreMatrix(store, movies, 'numpy')
+    python = recommendmovie.GenreMatrix(store, movies, 'python')
+    assert python.counts == vectorized.counts
+    users = list(range(store.n_users))
+    for u in range(0, store.n_users, 20):
+        expected = vectorized.weights(vectorized.row(u), users, cosine, euclidean, backend='numpy', **tf)
+        assert python.weights(python.row(u), users, cosine, euclidean, **tf) == pytest.approx(expected)
+
+
+@needs_numpy
+@pytest.mark.parametrize('measure', recommendmovie.LSH_MEASURES)
+def test_lsh_index_hashes_users_like_lsh_signatures(dataset, measure):
+    store = dataset
+    index = recommendmovie.load_lsh_index(measure, True, 4, 3)
+    for u in range(0, store.n_users, 10):
+        assert index.user_signatures(u) == recommendmovie.lsh_signatures(store, u, index.planes, index.n_movies, 4, 3,
+                                                                         measure == 'pearson')
+
+
+def test_recommendations_are_unseen_ordered_and_clipped(dataset, movies):
+    store = dataset
+    for user_id in ('1', '30'):
+        seen = store.user_vector(store.user_index(user_id))
+        for min_support in (1, recommendmovie.MIN_SUPPORT):
+            recommendations = recommendmovie.recommend_movies(store, movies, user_id, 10, True,
+                                                              min_support=min_support)
+            assert recommendations
+            assert not seen.keys() & {mid for mid, _ in recommendations}
+            assert all(0.5 <= rating <= 5 for _, rating in recommendations)
+            ratings = [rating for _, rating in recommendations]
+            assert ratings == sorted(ratings, reverse=True)
+
+
+@needs_numpy
+@pytest.mark.parametrize('options', [{}, {'cosine': True}, {'euclidean': True, 'min_support': 1},
+                                     {'only_genres': ['Drama', 'Comedy']}])
+def test_recommendation_backends_agree(dataset, movies, options):
+    store = dataset
+    for user_id in ('2', '45'):
+        vectorized = recommendmovie.recommend_movies(store, movies, user_id, 15, True, backend='numpy', **options)
+        python = recommendmovie.recommend_movies(store, movies, user_id, 15, True, **options)
+        assert [mid for mid, _ in python] == [mid for mid, _ in vectorized]
+        assert [rating for _, rating in python] == pytest.approx([rating for _, rating in vectorized])
+
+
+@needs_numpy
+def test_euclidean_neighbour_index_weights_nearest_most(dataset):
+    store = dataset
+    recommendmovie.build_neighbour_indices(True, 10, 3, ['euclidean'], workers=1)
+    index = recommendmovie.load_neighbour_index('euclidean', True)
+    for u in range(0, store.n_users, 10):
+        users, weights = (view.tolist() for view in index.user_neighbours(u))
+        assert weights == sorted(weights, reverse=True)
+        assert all(0 < weight <= 1 for weight in weights)
+        ours = store.user_vector(u)
+        distances = [recommendmovie.euclidean_distance(ours, store.user_vector(v)) for v in users]
+        assert weights == pytest.approx([1 / (1 + d) for d in distances])
+
+
+@pytest.mark.parametrize('backend', ['python', pytest.param('numpy', marks=needs_numpy)])
+@pytest.mark.parametrize('measure', recommendmovie.NEIGHBOUR_MEASURES)
+def test_nearest_neighbours_are_the_most_similar_co_raters(dataset, measure, backend):
+    store = dataset
+    for u in range(0, store.n_users, 10):
+        ours, our_stats = store.user_vector(u), store.user_stats(u)
+        expected = {}
+        for v in range(store.n_users):
+            theirs = store.user_vector(v)
+            if v != u and len(ours.keys() & theirs.keys()) >= 3:
+                similarity = python_similarity(measure, ours, our_stats, theirs, store.user_stats(v))
+                expected[v] = 1 / (1 + similarity) if measure == 'euclidean' else similarity
+        neighbours, weights = recommendmovie.nearest_neighbours(store, u, 10, 3, [measure], backend=backend)[measure]
+        assert weights == sorted(weights, reverse=True)
+        assert weights == pytest.approx([expected[v] for v in neighbours])
+        assert weights[-1] == pytest.approx(sorted(expected.values(), reverse=True)[len(neighbours) - 1])
+
+
+@needs_numpy
+def test_item_based_prediction_is_the_weighted_sum_of_our_ratings(tiny_dataset):
+    store = tiny_dataset
+    matrix = recommendmovie.load_item_similarities('adjusted_cosine', True, 10, 2, workers=1)
+    # the mean-centered ratings of movie 10 by users 1-3 are (1, 1, -1), of movie 20 (1, 0, -1), of movie 30
+    # (-2, -2, 2) and of movie 40 (0, 1, 0), so movie 30 is dissimilar and dropped
+    similarity_20 = (1 + 0 + 1) / sqrt(3 * 2)
+    similarity_40 = (0 + 1 + 0) / sqrt(3 * 1)
+    neighbours, weights = matrix.movie_neighbours(store.movie_index('10'))
+    assert [store.movie_keys[m] for m in neighbours] == ['20', '40']
+    assert list(weights) == pytest.approx([similarity_20, similarity_40])
+    # user 4 rated movie 20 five stars and movie 40 three
+    expected = (5 * similarity_20 + 3 * similarity_40) / (similarity_20 + similarity_40)
+    assert recommendmovie.get_ratings_item_based(store, matrix, '4', ['10']) == {'10': pytest.approx(expected)}
+
+
+@needs_numpy
+def test_item_similarities_are_reused_until_the_ratings_change(tiny_dataset, monkeypatch):
+    builds = []
+    build = recommendmovie.build_item_similarities
+    monkeypatch.setattr(recommendmovie, 'build_item_similarities', lambda *args, **kwargs: builds.append(args) or
+                        build(*args, **kwargs))
+    recommendmovie.load_item_similarities('adjusted_cosine', True, 10, 2, workers=1)
+    recommendmovie._item_similarities.clear()
+    recommendmovie.load_item_similarities('adjusted_cosine', True, 10, 2, workers=1)
+    assert len(builds) == 1
+    recommendmovie.load_item_similarities('adjusted_cosine', True, 5, 2, workers=1)
+    assert len(builds) == 2
+
+    with open(recommendmovie.dataset_file('ratings.csv', True), 'a') as file:
+        file.write('4,10,2,0\n')
+    store = recommendmovie.load_rating_store(True)
+    matrix = recommendmovie.load_item_similarities('adjusted_cosine', True, 5, 2, workers=1)
+    assert len(builds) == 3
+    assert matrix.is_current(store, 5, 2)
+
+
+def test_catalogue_translates_web_ids(dataset, movies):
+    mid = list(movies)[10]
+    # benchmark.generate_dataset links each movie to IMDb ID 100000 + 7 * ID and TMDb ID 1000 + 3 * ID
+    assert movies.translate(['tt{:07d}'.format(100000 + 7 * int(mid)), '1'], 'imdb') == [mid, None]
+    assert movies.translate([str(1000 + 3 * int(mid))], 'tmdb') == [mid]
+    assert movies[mid].title.startswith('Synthetic Movie {},'.format(mid))
+
+
+def test_catalogue_indices_of_unknown_ids_are_negative(dataset, movies):
+    mids = [int(mid) for mid in movies][::7]
+    ids = {'movielens': [str(mid) for mid in mids] + ['0', '99999999'],
+           'imdb': ['tt{:07d}'.format(100000 + 7 * mid) for mid in mids] + ['tt{:07d}'.format(100003), 'tt1'],
+           'tmdb': [str(1000 + 3 * mid) for mid in mids] + ['1001', '99999999']}
+    for id_type, values in ids.items():
+        indices = movies.movie_indices(values, id_type)
+        assert [movies.movie_ids[i] for i in indices[:len(mids)]] == mids
+        assert indices[len(mids):] == [-1, -1]
+
+
+def test_score_pairs_matches_predict_ratings(dataset, movies):
+    store = dataset
+    pairs = [(str(u), mid) for u in (3, 3, 8, 50) for mid in list(movies)[u:u + 20]]
+    with open('pairs.csv', 'w') as file:
+        file.write('movieId,userId\n')
+        file.writelines('{},{}\n'.format(mid, uid) for uid, mid in pairs)
+    with open('pairs.jsonl', 'w') as file:
+        file.writelines(json.dumps({'user_id': int(uid), 'movie_id': int(mid)}) + '\n' for uid, mid in pairs)
+    assert recommendmovie.score_pairs('pairs.csv', 'scored.csv', True, workers=2, chunk_size=7) == len(pairs)
+    assert recommendmovie.score_pairs('pairs.jsonl', 'scored.jsonl', True, workers=1) == len(pairs)
+    with open('scored.csv') as file:
+        rows = list(csv.DictReader(file))
+    with open('scored.jsonl') as file:
+        objects = [json.loads(line) for line in file]
+    assert len(rows) == len(objects) == len(pairs) and any(row['rating'] for row in rows)
+    for (uid, mid), row, scored in zip(pairs, rows, objects):
+        expected = recommendmovie.predict_ratings(store, movies, uid, [mid], False, True, False, False).get(mid)
+        assert (row['userId'], row['movieId']) == (uid, mid)
+        assert row['rating'] == ('' if expected is None else str(expected))
+        assert scored == {'user_id': int(uid), 'movie_id': int(mid), 'rating': expected}
+
+    with open('short.csv', 'w') as file:
+        file.write('userId,movieId\n1,{}\n2\n'.format(mid))
+    with pytest.raises(ValueError, match='line 3'):
+        recommendmovie.score_pairs('short.csv', 'scored.csv', True, workers=1)
+
+
+@needs_numpy
+def test_factor_model_predicts_on_the_star_scale(dataset):
+    store = dataset
+    model = recommendmovie.load_factor_model(True, rank=4, iterations=3, workers=2)
+    assert model.is_current(store, 4, 3, recommendmovie.FACTOR_REGULARIZATION)
+    predictions = model.predict(store.user_index('1'))
+    assert len(predictions) == store.n_movies
+    assert ((predictions >= 0.5) & (predictions <= 5)).all()
+    again = recommendmovie.train_factors(True, 4, 3, recommendmovie.FACTOR_REGULARIZATION, workers=1)
+    assert np.allclose(again[1][:model.n_movies], model.movie_factors, atol=1e-5)
+
+
+@pytest.fixture
+def server(dataset):
+    """A PredictionServer for the dataset on a free port of localhost, with the factor model if numpy is installed"""
+    server = recommendmovie.PredictionServer(('127.0.0.1', 0), True, models=['factors'] if np is not None else [],
+                                             rank=4, iterations=2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, path, body):
+    """POST a JSON body to the server and return the status and the decoded reply"""
+    request = urllib.request.Request('http://127.0.0.1:{}{}'.format(server.server_address[1], path),
+                                     data=json.dumps(body).encode())
+    try:
+        with urllib.request.urlopen(request) as reply:
+            return reply.status, json.load(reply)
+    except urllib.error.HTTPError as error:
+        return error.code, json.load(error)
+
+
+def test_server_predicts_like_predict_ratings(server, movies):
+    movie_ids = list(movies)[:15]
+    for options in ({}, {'cosine': True}) + (({'factors': True},) if np is not None else ()):
+        status, reply = post(server, '/predict', dict(options, user_id=2, movie_ids=[int(mid) for mid in movie_ids]))
+        assert status == 200
+        assert any(prediction['rating'] is not None for prediction in reply['predictions'])
+        expected = recommendmovie.predict_ratings(server.store, movies, '2', movie_ids, full=True,
+                                                  **dict(recommendmovie.PREDICTION_OPTIONS, rank=4, iterations=2,
+                                                         **options))
+        assert [prediction['rating'] for prediction in reply['predictions']] == [expected.get(mid)
+                                                                                for mid in movie_ids]
+    status, reply = post(server, '/predict', {'user_id': 2, 'movie_ids': ['tt{:07d}'.format(100000 + 7 * 98)],
+                                              'id_type': 'imdb'})
+    assert status == 200 and reply['predictions'][0]['id'] == 'tt0100686'
+    assert server.stats()['requests'] == (4 if np is not None else 3)
+
+
+@pytest.mark.parametrize('body', [
+    {'user_id': 1, 'movie_ids': '98'},
+    {'user_id': 1, 'movie_ids': [98], 'k': 'x', 'item_based': True},
+    {'user_id': 1, 'movie_ids': [98], 'factors': True, 'rank': 0},
+    {'user_id': 1, 'movie_ids': [98], 'neighbours': True, 'genres': True},
+    {'user_id': 1, 'movie_ids': [98], 'backend': 'fortran'},
+    {'user_id': 1, 'movie_ids': [98], 'cosine': 1},
+    {'user_id': 1, 'movie_ids': [98], 'lsh': True},
+    {'user_id': 1, 'movie_ids': [98], 'id_type': 'netflix'},
+])
+def test_server_rejects_bad_requests(server, body):
+    status, reply = post(server, '/predict', body)
+    assert status == 400 and reply['error']
+    assert server.stats()['latency']['count'] == 1
+
+
+def test_server_reports_failures_as_json(server, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("broken")
+    monkeypatch.setattr(recommendmovie, 'predict_ratings', fail)
+    assert post(server, '/predict', {'user_id': 1, 'movie_ids': [98]}) == (500, {'error': "internal error: broken"})
+    assert server.stats()['latency']['count'] == 1
+
+
+def test_server_survives_a_failed_reload(server, monkeypatch):
+    load_rating_store = recommendmovie.load_rating_store
+
+    def fail(full):
+        monkeypatch.setattr(recommendmovie, 'load_rating_store', load_rating_store)
+        raise ValueError("bad line")
+    monkeypatch.setattr(recommendmovie, 'load_rating_store', fail)
+    assert post(server, '/predict', {'user_id': 1, 'movie_ids': [98]}) == (500, {'error': "internal error: bad line"})
+    assert post(server, '/predict', {'user_id': 1, 'movie_ids': [98]})[0] == 200
+    assert server.stats()['in_flight'] == 0
+
+
+def test_server_sees_new_ratings(server, movies):
+    mid = next(mid for mid in movies if mid not in server.store.user_vector(server.store.user_index('4')))
+    assert post(server, '/ratings', {'user_id': 4, 'ratings': {mid: 5}}) == (200, {'user_id': 4, 'recorded': 1})
+    post(server, '/predict', {'user_id': 4, 'movie_ids': [mid]})
+    assert server.store.user_vector(server.store.user_index('4'))[mid] == 5
+    assert post(server, '/ratings', {'user_id': 4, 'ratings': {mid: 7}})[0] == 400
+